@@ -142,6 +142,82 @@ COVERAGE_GS_KEY = ''
 
 COVERAGE_GS_JSON_FILE = ''
 
+# Requests per second to one spreadsheet from all workers sharing
+# COVERAGE_LOCK_DIR, up to COVERAGE_GS_BURST at once. 0 is unlimited
+COVERAGE_GS_RATE = 0.8
+COVERAGE_GS_BURST = 10
+
+# Sheet rows written per batch by the drain_sheet_outbox task
+COVERAGE_GS_OUTBOX_BATCH = 100
+
+# Backend used to merge lcov tracefiles:
+# 'lcov' run 'lcov -a' for every tracefile, 'native' merge in process
+COVERAGE_MERGE_BACKEND = 'lcov'
+
+# Backend used to convert lcov tracefiles between versions:
+# 'lcov' run 'lcov --diff' for every tracefile, 'native' convert in process
+COVERAGE_CONVERT_BACKEND = 'lcov'
+
+# SF: path prefix rewrite rules applied when tracefiles are merged or
+# rendered, like '/usr/coverage/:/mnt/coverage/;/builddir/build/:/mnt/coverage/'
+# Empty means use the default rules of the project helper
+COVERAGE_PATH_RULES = ''
+
+# Number of genhtml processes used to render a lcov report,
+# 1 runs a single genhtml, 0 uses one genhtml per cpu. Reports with more
+# than one top level source directory are split and rendered in parallel
+COVERAGE_REPORT_JOBS = 1
+
+# Directory to keep intermediate data between tasks, like per version
+# merged tracefiles. Empty means no cache
+COVERAGE_CACHE_DIR = ''
+
+# Disk budget of cached git checkouts in COVERAGE_CACHE_DIR, in bytes,
+# least recently used checkouts are removed first. 0 is unlimited
+COVERAGE_GIT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+# Disk budget of cached extracted rpm packages in COVERAGE_CACHE_DIR,
+# in bytes. 0 is unlimited
+COVERAGE_RPM_CACHE_SIZE = 5 * 1024 * 1024 * 1024
+
+# Merges of more tracefiles than this are spread over workers: batches
+# of this size are merged in parallel, then the results are merged
+# COVERAGE_REDUCE_FANOUT at a time until one is left. 0 disables it
+COVERAGE_REDUCE_BATCH = 0
+
+COVERAGE_REDUCE_FANOUT = 2
+
+# A running merge whose tasks are all queued counts as alive for this
+# many hours after the last step, then its files are queued again
+COVERAGE_MERGE_STALE_HOURS = 6
+
+# Merge uploads with the same content only once, CI reruns often
+# upload identical tracefiles
+COVERAGE_MERGE_SKIP_DUPLICATES = True
+
+# Scratch directory of tasks, every task works in its own sub directory.
+# Empty means a coveragepool directory in the system temporary directory
+COVERAGE_WORK_DIR = ''
+
+# Directory of the locks which serialize tasks updating the same report.
+# Use a directory shared by all hosts running workers, empty means a
+# locks directory in COVERAGE_WORK_DIR
+COVERAGE_LOCK_DIR = ''
+
+# Remove merge intermediates which are not used for this many days
+COVERAGE_MERGE_CACHE_DAYS = 7
+
+# Codec of stored tracefiles: 'gzip', 'lzma' or '' to store them as
+# they are. Tracefiles are decompressed on the fly when they are read
+COVERAGE_STORAGE_CODEC = 'gzip'
+
+# Chunked uploads which got no chunk for this many days are removed,
+# 0 keeps them
+COVERAGE_UPLOAD_SESSION_DAYS = 2
+
+# Max rows of a listfile page
+COVERAGE_LIST_PAGE_SIZE = 1000
+
 # Limit media directroy size, only support bytes
 # 0 is unlimited
 COVERAGE_MEDIA_LIMIT_SIZE = 0
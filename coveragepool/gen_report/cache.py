@@ -0,0 +1,253 @@
+"""
+Directory caches shared by the workers of one host
+"""
+import os
+import re
+import json
+import time
+import errno
+import fcntl
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from .utils import run_cmd
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """
+    flock based lock, works between processes of one host
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise e
+
+
+def dir_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            if not os.path.islink(fp):
+                total += os.path.getsize(fp)
+    return total
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def git_has_ref(git_dir, ref):
+    try:
+        run_cmd(['git', '--git-dir', git_dir, 'rev-parse', '--verify', '-q', ref])
+        return True
+    except Exception:
+        return False
+
+
+def update_git_base(git_repo, base_dir, tag=None):
+    """
+    Clone or pull the base repository. Only one worker does it at the
+    same time, workers which waited for it reuse its result. Tags
+    never move, so nothing is fetched if tag is already known.
+    """
+    base_dir = base_dir.rstrip('/')
+    git_dir = os.path.join(base_dir, '.git')
+    start = time.time()
+    stamp = base_dir + '.updated'
+    makedirs(os.path.dirname(base_dir))
+    with file_lock(base_dir + '.lock'):
+        if os.path.exists(git_dir):
+            if tag and git_has_ref(git_dir, 'refs/tags/%s' % tag):
+                return
+            if os.path.exists(stamp) and os.path.getmtime(stamp) >= start:
+                return
+            cmd = 'git --git-dir %s --work-tree %s pull' % (git_dir, base_dir)
+        else:
+            cmd = 'git clone %s %s' % (git_repo, base_dir)
+        run_cmd(cmd)
+        with open(stamp, 'w'):
+            pass
+
+
+class DirCache(object):
+    """
+    Directories keyed by a string and limited by a disk budget.
+
+    Entries in use are leased, every lease records the pid of its owner.
+    Entries without lease are evicted from the least recently used one
+    when the cache is over budget. Populating an entry is single flight,
+    other workers asking for the same key wait and reuse the result.
+
+    Subclasses implement populate() and may override remove().
+    """
+    def __init__(self, root, size_limit=0):
+        self.root = root
+        self.size_limit = int(size_limit or 0)
+        makedirs(root)
+        self.index_file = os.path.join(root, 'index.json')
+        self.lock_file = os.path.join(root, '.lock')
+
+    def populate(self, key, path):
+        raise NotImplementedError('populate')
+
+    def remove(self, key, path):
+        shutil.rmtree(path, True)
+
+    def entry_path(self, key):
+        return os.path.join(self.root, re.sub(r'[^A-Za-z0-9._+-]', '_', key))
+
+    def _load(self):
+        try:
+            with open(self.index_file) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, index):
+        tmp_file = tempfile.NamedTemporaryFile(
+            mode='w', suffix='.tmp', prefix='index-',
+            dir=self.root, delete=False)
+        json.dump(index, tmp_file)
+        tmp_file.close()
+        os.rename(tmp_file.name, self.index_file)
+
+    def _lease(self, key):
+        with file_lock(self.lock_file):
+            index = self._load()
+            entry = index.get(key)
+            if not entry or not os.path.exists(entry['path']):
+                return None
+            entry['leases'].append(os.getpid())
+            entry['atime'] = time.time()
+            self._save(index)
+            return entry['path']
+
+    def acquire(self, key):
+        """
+        Return the path of the entry, populate it if needed. Every
+        acquire() needs a release()
+        """
+        path = self._lease(key)
+        if path:
+            return path
+
+        path = self.entry_path(key)
+        with file_lock(path + '.lock'):
+            # Populated by another worker while waiting for the lock
+            leased_path = self._lease(key)
+            if leased_path:
+                return leased_path
+
+            if os.path.exists(path):
+                # Leftover of a broken populate
+                self.remove(key, path)
+            try:
+                self.populate(key, path)
+            except Exception as e:
+                if os.path.exists(path):
+                    self.remove(key, path)
+                raise e
+
+            size = dir_size(path)
+            with file_lock(self.lock_file):
+                index = self._load()
+                index[key] = {'path': path, 'size': size,
+                              'atime': time.time(), 'leases': [os.getpid()]}
+                self._save(index)
+
+        self.evict()
+        return path
+
+    def release(self, key):
+        with file_lock(self.lock_file):
+            index = self._load()
+            entry = index.get(key)
+            if entry and os.getpid() in entry['leases']:
+                entry['leases'].remove(os.getpid())
+                entry['atime'] = time.time()
+                self._save(index)
+        self.evict()
+
+    @contextmanager
+    def lease(self, key):
+        path = self.acquire(key)
+        try:
+            yield path
+        finally:
+            self.release(key)
+
+    def evict(self):
+        if not self.size_limit:
+            return
+
+        with file_lock(self.lock_file):
+            index = self._load()
+            for entry in index.values():
+                # Leases of dead workers
+                entry['leases'] = [pid for pid in entry['leases'] if _pid_alive(pid)]
+
+            total = sum(entry['size'] for entry in index.values())
+            for key, entry in sorted(index.items(), key=lambda x: x[1]['atime']):
+                if total <= self.size_limit:
+                    break
+                if entry['leases']:
+                    continue
+                self.remove(key, entry['path'])
+                total -= entry['size']
+                del index[key]
+            self._save(index)
+
+
+class GitCheckoutCache(DirCache):
+    """
+    git worktrees of one repository keyed by tag, all of them share the
+    objects of the base clone.
+
+    prepare(path) is called once on every new worktree, under the lock
+    of the entry, files it writes are shared by all the leases
+    """
+    def __init__(self, root, git_repo, base_dir, size_limit=0, prepare=None):
+        DirCache.__init__(self, root, size_limit)
+        self.git_repo = git_repo
+        self.prepare = prepare
+        self.base_dir = base_dir.rstrip('/')
+        self.git_dir = os.path.join(self.base_dir, '.git')
+        self.base_lock = self.base_dir + '.lock'
+
+    def update_base(self, tag=None):
+        update_git_base(self.git_repo, self.base_dir, tag)
+
+    def populate(self, key, path):
+        self.update_base(key)
+        with file_lock(self.base_lock):
+            run_cmd(['git', '--git-dir', self.git_dir, 'worktree', 'add',
+                     '--detach', path, key])
+        if self.prepare:
+            self.prepare(path)
+
+    def remove(self, key, path):
+        shutil.rmtree(path, True)
+        with file_lock(self.base_lock):
+            try:
+                run_cmd(['git', '--git-dir', self.git_dir, 'worktree', 'prune'])
+            except Exception:
+                # Pruned again by the next remove
+                pass
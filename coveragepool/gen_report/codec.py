@@ -0,0 +1,129 @@
+"""
+Compressed tracefiles
+
+Stored tracefiles may be compressed with gzip or xz. The codec is
+detected from the magic bytes, so plain and compressed files can be
+mixed and readers never need to know how a file was stored.
+"""
+import io
+import gzip
+import zlib
+import shutil
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+_MAGICS = ((b'\x1f\x8b', 'gzip'),
+           (b'\xfd7zXZ\x00', 'lzma'))
+
+
+def detect_bytes(data):
+    for magic, codec in _MAGICS:
+        if data.startswith(magic):
+            return codec
+    return None
+
+
+def detect(path):
+    """
+    Return the codec of the file, None if it is not compressed
+    """
+    with open(path, 'rb') as fp:
+        return detect_bytes(fp.read(6))
+
+
+def can_compress(codec):
+    return codec == 'gzip' or (codec == 'lzma' and lzma is not None)
+
+
+def _compressor(codec):
+    if codec == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif codec == 'lzma' and lzma:
+        return lzma.LZMACompressor()
+    raise Exception('Unsupport codec %s' % codec)
+
+
+class Decompressor(object):
+    """
+    Decompress a stream chunk by chunk, concatenated gzip members or xz
+    streams are decompressed one after the other like gzip -d does
+    """
+    def __init__(self, codec):
+        if codec not in ('gzip', 'lzma'):
+            raise Exception('Unsupport codec %s' % codec)
+        if codec == 'lzma' and not lzma:
+            raise Exception('Cannot decompress xz data, lzma module is missing')
+        self.codec = codec
+        self.obj = self._new()
+
+    def _new(self):
+        if self.codec == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        ret = []
+        while data:
+            if getattr(self.obj, 'eof', False):
+                self.obj = self._new()
+            ret.append(self.obj.decompress(data))
+            data = self.obj.unused_data
+            if data:
+                self.obj = self._new()
+        return b''.join(ret)
+
+
+def compress_chunks(chunks, fp, codec, keep_compressed=True):
+    """
+    Write chunks compressed with codec to fp, data which is already
+    compressed is written as it is unless keep_compressed is False
+    """
+    compressor = None
+    for chunk in chunks:
+        if compressor is None:
+            if keep_compressed and detect_bytes(chunk):
+                compressor = False
+            else:
+                compressor = _compressor(codec)
+        fp.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        fp.write(compressor.flush())
+
+
+def open_binary(path):
+    """
+    Open the file for reading, decompress it on the fly if needed
+    """
+    codec = detect(path)
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    elif codec == 'lzma':
+        if not lzma:
+            raise Exception('Cannot read %s, lzma module is missing' % path)
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def open_tracefile(path):
+    """
+    Open the tracefile as text, decompress it on the fly if needed
+    """
+    if detect(path) is None:
+        return open(path)
+    fp = open_binary(path)
+    if str is bytes:
+        # python2 str lines
+        return fp
+    return io.TextIOWrapper(fp)
+
+
+def copy_decompressed(src, dst):
+    """
+    For tools which need a real file, like coverage.py data files
+    """
+    with open_binary(src) as fsrc:
+        with open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst)
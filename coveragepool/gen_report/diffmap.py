@@ -0,0 +1,270 @@
+"""
+Map tracefile line numbers through a unified diff, like 'lcov --diff'
+
+Lines removed or changed by the diff lose their coverage data, other
+lines move with the offsets introduced by the diff hunks. The same
+mapping is applied to coverage.py data files (lines and arcs).
+"""
+import re
+from bisect import bisect_right
+from array import array
+
+from .lcov import FunctionRecord, load_tracefile
+
+_HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class LineMap(object):
+    """
+    Sorted breakpoints of old line numbers, every breakpoint gives the
+    offset of the following lines or None if they were removed
+    """
+    __slots__ = ('starts', 'deltas', 'new_path', 'deleted')
+
+    def __init__(self):
+        self.starts = [1]
+        self.deltas = [0]
+        self.new_path = None
+        self.deleted = False
+
+    def _add(self, line, delta):
+        if self.deltas[-1] == delta:
+            return
+        if self.starts[-1] == line:
+            self.starts.pop()
+            self.deltas.pop()
+            if self.deltas and self.deltas[-1] == delta:
+                return
+        self.starts.append(line)
+        self.deltas.append(delta)
+
+    def map(self, line):
+        delta = self.deltas[bisect_right(self.starts, line) - 1]
+        if delta is None:
+            return None
+        return line + delta
+
+
+def _strip_path(path, strip):
+    path = path.split('\t')[0].strip()
+    if path == '/dev/null':
+        return None
+    return '/'.join(path.split('/')[strip:])
+
+
+def parse_diff(lines, strip=1):
+    """
+    Parse a unified diff, return a dict of old path -> LineMap
+    """
+    maps = {}
+    line_map = None
+    old_path = None
+    old_line = new_line = old_left = new_left = 0
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if old_left > 0 or new_left > 0:
+            if line.startswith('\\'):
+                continue
+            if line.startswith('-'):
+                line_map._add(old_line, None)
+                old_line += 1
+                old_left -= 1
+            elif line.startswith('+'):
+                new_line += 1
+                new_left -= 1
+            else:
+                line_map._add(old_line, new_line - old_line)
+                old_line += 1
+                new_line += 1
+                old_left -= 1
+                new_left -= 1
+            if old_left <= 0 and new_left <= 0:
+                line_map._add(old_line, new_line - old_line)
+            continue
+
+        if line.startswith('--- '):
+            old_path = _strip_path(line[4:], strip)
+            line_map = None
+        elif line.startswith('+++ ') and old_path:
+            new_path = _strip_path(line[4:], strip)
+            line_map = maps[old_path] = LineMap()
+            if new_path is None:
+                line_map.deleted = True
+            elif new_path != old_path:
+                line_map.new_path = new_path
+        elif line_map is not None:
+            match = _HUNK_RE.match(line)
+            if not match:
+                continue
+            old_start, old_len, new_start, new_len = match.groups()
+            old_len = 1 if old_len is None else int(old_len)
+            new_len = 1 if new_len is None else int(new_len)
+            old_line = int(old_start)
+            new_line = int(new_start)
+            # Empty ranges point at the line before the hunk
+            if old_len == 0:
+                old_line += 1
+            if new_len == 0:
+                new_line += 1
+            line_map._add(old_line, new_line - old_line)
+            old_left = old_len
+            new_left = new_len
+
+    return maps
+
+
+def match_paths(paths, candidates):
+    """
+    Map every path to the longest candidate which is a path suffix of it,
+    paths without a match are left out
+    """
+    candidates = set(candidates)
+    ret = {}
+    for path in paths:
+        parts = path.split('/')
+        for i in range(len(parts)):
+            suffix = '/'.join(parts[i:])
+            if suffix in candidates:
+                ret[path] = suffix
+                break
+    return ret
+
+
+def convert_file(record, line_map):
+    lines = array('i')
+    hits = array('l')
+    checksums = None
+    for line, count in zip(record.lines, record.hits):
+        new = line_map.map(line)
+        if new is None:
+            continue
+        lines.append(new)
+        hits.append(count)
+        if record.checksums and line in record.checksums:
+            if checksums is None:
+                checksums = {}
+            checksums[new] = record.checksums[line]
+    record.lines = lines
+    record.hits = hits
+    record.checksums = checksums
+
+    functions = {}
+    for name, func in record.functions.items():
+        new = line_map.map(func.line)
+        if new is not None:
+            end = line_map.map(func.end) if func.end is not None else None
+            functions[name] = FunctionRecord(name, new, func.count, end)
+    record.functions = functions
+
+    branches = []
+    for line, block, branch, taken in record.branches.records():
+        new = line_map.map(line)
+        if new is not None:
+            branches.append((new, block, branch, taken))
+    record.branches.set(branches)
+
+
+def convert_data(data, maps):
+    """
+    Apply the parsed diff to a CoverageData in place
+    """
+    for test_name, files in data.tests.items():
+        matched = match_paths(list(files.keys()), maps.keys())
+        for path, diff_path in matched.items():
+            line_map = maps[diff_path]
+            record = files.pop(path)
+            if line_map.deleted:
+                continue
+            convert_file(record, line_map)
+            if line_map.new_path:
+                record.path = path[:len(path) - len(diff_path)] + line_map.new_path
+            data.add_file(record, test_name)
+
+
+def convert_tracefiles(tracefiles, diff_file, strip=1):
+    """
+    tracefiles is a list of (src_tf, tgt_tf), the diff is parsed only once
+    """
+    with open(diff_file) as fp:
+        maps = parse_diff(fp, strip)
+    for src_tf, tgt_tf in tracefiles:
+        data = load_tracefile(src_tf)
+        convert_data(data, maps)
+        data.save(tgt_tf)
+
+
+
+def _coverage_data(path, read=True):
+    """
+    coverage.py data of path, coverage.py is only needed by python
+    projects
+    """
+    from coverage import CoverageData
+    try:
+        # coverage.py 5 and later, the data is written to path directly
+        data = CoverageData(basename=path)
+        if read:
+            data.read()
+    except TypeError:
+        data = CoverageData()
+        if read:
+            data.read_file(path)
+    return data
+
+
+def coverage_source_paths(data_file):
+    return set(_coverage_data(data_file).measured_files())
+
+
+def _map_line(line, line_map):
+    return line_map.map(line)
+
+
+def _map_arc(arc, line_map):
+    """
+    Negative line numbers are the entry and exit of a code object
+    """
+    ret = []
+    for line in arc:
+        new = line_map.map(abs(line))
+        if new is None:
+            return None
+        ret.append(new if line > 0 else -new)
+    return tuple(ret)
+
+
+def convert_coverage_files(tracefiles, diff_file, strip=1):
+    """
+    Same as convert_tracefiles() for coverage.py data files
+    """
+    with open(diff_file) as fp:
+        maps = parse_diff(fp, strip)
+    for src_tf, tgt_tf in tracefiles:
+        data = _coverage_data(src_tf)
+        if data.has_arcs():
+            get_items, map_item, add_items = data.arcs, _map_arc, 'add_arcs'
+        else:
+            get_items, map_item, add_items = data.lines, _map_line, 'add_lines'
+
+        paths = data.measured_files()
+        matched = match_paths(paths, maps.keys())
+        items = {}
+        for path in paths:
+            line_map = maps.get(matched.get(path))
+            if line_map is None:
+                items[path] = list(get_items(path) or [])
+                continue
+            if line_map.deleted:
+                continue
+            new_path = path
+            if line_map.new_path:
+                new_path = path[:len(path) - len(matched[path])] + line_map.new_path
+            mapped = [map_item(item, line_map) for item in get_items(path) or []]
+            items[new_path] = [item for item in mapped if item is not None]
+
+        new_data = _coverage_data(tgt_tf, read=False)
+        getattr(new_data, add_items)(items)
+        if hasattr(new_data, 'write_file'):
+            new_data.write_file(tgt_tf)
+        else:
+            new_data.write()
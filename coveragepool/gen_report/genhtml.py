@@ -0,0 +1,161 @@
+"""
+Render a tracefile with several genhtml processes in parallel
+
+The tracefile is split by top level source directory, every shard is
+rendered by its own genhtml, and a cheap genhtml run on a summary
+tracefile (one fake file per directory carrying the directory totals)
+produces the top level pages. All runs share the same --prefix and
+--title, so the stitched report looks like a single genhtml run.
+"""
+import os
+import shutil
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from . import lcov
+from .utils import run_cmd
+
+SUMMARY_FILE = 'coveragepool-summary.c'
+
+
+def _shorten_prefix(path):
+    return '/'.join(path.split('/')[:-1])
+
+
+def genhtml_prefix(paths):
+    """
+    Same as get_prefix(1, ...) in genhtml: the parent directory which
+    removes the most characters from all paths, while every path keeps
+    at least one parent directory
+    """
+    prefixes = set()
+    for path in paths:
+        current = _shorten_prefix(path)
+        while current:
+            if current + '/' in prefixes:
+                break
+            prefixes.add(current + '/')
+            current = _shorten_prefix(current)
+
+    for path in paths:
+        prefixes.discard(os.path.dirname(path) + '/')
+
+    if not prefixes:
+        return None
+
+    def _weight(prefix):
+        return sum(len(path) - len(prefix) if path.startswith(prefix) else len(path)
+                   for path in paths)
+
+    # genhtml picks a random one on a tie, prefer the longest
+    prefix = min(prefixes, key=lambda x: (_weight(x), -len(x)))
+    return prefix[:-1]
+
+
+def _relative_dir(path, prefix):
+    dir_name = os.path.dirname(path)
+    if dir_name.startswith(prefix + '/'):
+        return dir_name[len(prefix) + 1:]
+    return dir_name
+
+
+def _write_summary_record(fp, path, summary):
+    fp.write('SF:%s\n' % path)
+    for i in range(summary['FNF']):
+        fp.write('FN:1,f%d\n' % i)
+        fp.write('FNDA:%d,f%d\n' % (1 if i < summary['FNH'] else 0, i))
+    for i in range(summary['BRF']):
+        fp.write('BRDA:1,0,%d,%d\n' % (i, 1 if i < summary['BRH'] else 0))
+    for i in range(summary['LF']):
+        fp.write('DA:%d,%d\n' % (i + 1, 1 if i < summary['LH'] else 0))
+    fp.write('end_of_record\n')
+
+
+def _run(args):
+    run_cmd(args)
+
+
+def gen_sharded_report(tracefile, output_dir, rewriter=None,
+                       extra_args=None, jobs=None):
+    """
+    Return False if the tracefile cannot be split in more than one shard,
+    the caller should run a single genhtml instead
+    """
+    data = lcov.load_tracefile(tracefile, rewriter)
+    files = data.merged_files()
+    prefix = genhtml_prefix(list(files.keys()))
+    if not prefix:
+        return False
+
+    shards = {}
+    dir_summary = {}
+    for path, record in files.items():
+        if not path.startswith(prefix + '/'):
+            # genhtml puts it in a directory named by its full path, the
+            # top level pages cannot be stitched from shards then
+            return False
+        rel_dir = _relative_dir(path, prefix)
+        shards.setdefault(rel_dir.split('/')[0], []).append(path)
+        total = dir_summary.setdefault(os.path.dirname(path), dict.fromkeys(
+            ('LF', 'LH', 'FNF', 'FNH', 'BRF', 'BRH'), 0))
+        for key, val in record.summary().items():
+            total[key] += val
+
+    if len(shards) < 2:
+        return False
+    files = None
+
+    test_names = sorted(data.tests.keys())
+    # The summary records are made up, they belong to no test
+    summary_name = test_names[0] if len(test_names) == 1 else ''
+    common_args = ['--prefix', prefix, '--title', os.path.basename(tracefile)]
+    common_args += list(extra_args or [])
+
+    tmp_dir = tempfile.mkdtemp(prefix='genhtml-')
+    try:
+        cmds = []
+        summary_tf = os.path.join(tmp_dir, 'summary.info')
+        with open(summary_tf, 'w') as fp:
+            for dir_name in sorted(dir_summary.keys()):
+                fp.write('TN:%s\n' % summary_name)
+                _write_summary_record(fp, os.path.join(dir_name, SUMMARY_FILE),
+                                      dir_summary[dir_name])
+        cmds.append(['genhtml', summary_tf, '--output-directory', output_dir,
+                     '--no-source'] + common_args)
+
+        shard_dirs = {}
+        for i, top_dir in enumerate(sorted(shards.keys())):
+            shard_tf = os.path.join(tmp_dir, 'shard-%d.info' % i)
+            shard_dirs[top_dir] = os.path.join(tmp_dir, 'shard-%d' % i)
+            with open(shard_tf, 'w') as fp:
+                for test_name in test_names:
+                    test_files = data.tests[test_name]
+                    for path in sorted(shards[top_dir]):
+                        if path in test_files:
+                            fp.write('TN:%s\n' % test_name)
+                            test_files[path].write(fp)
+            cmds.append(['genhtml', shard_tf, '--output-directory',
+                         shard_dirs[top_dir]] + common_args)
+        # The parsed data is not needed while genhtml runs
+        data = None
+
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        # Threads are enough to drive the genhtml processes, and celery
+        # worker processes are not allowed to fork a multiprocessing pool
+        pool = ThreadPool(min(jobs, len(cmds)))
+        try:
+            pool.map(_run, cmds)
+        finally:
+            pool.close()
+            pool.join()
+
+        for top_dir, shard_dir in shard_dirs.items():
+            target = os.path.join(output_dir, top_dir)
+            shutil.rmtree(target, True)
+            shutil.copytree(os.path.join(shard_dir, top_dir), target)
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    return True
@@ -0,0 +1,144 @@
+"""
+Generate sources which are not in the git tree but needed by genhtml
+
+Every step declares the files it reads and writes, paths are relative
+to the source dir. A step waits for the steps which write its inputs,
+the others run concurrently. Outputs are cached by the hash of the
+command and the content of the inputs, so the same sources are never
+generated twice.
+"""
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from .utils import run_cmd, run_cmd_output
+from .cache import makedirs
+
+
+class Step(object):
+    """
+    cmd is an argument list, '{dir}' in it is replaced by the source dir.
+    If stdout is set, the output of cmd is written to this file.
+    """
+    def __init__(self, cmd, inputs, outputs=(), stdout=None):
+        self.cmd = cmd
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.stdout = stdout
+        if stdout and stdout not in self.outputs:
+            self.outputs.append(stdout)
+
+    def key(self, src_dir):
+        h = hashlib.sha256()
+        h.update('\0'.join(self.cmd + [self.stdout or '']).encode('utf-8'))
+        for path in self.inputs:
+            h.update(b'\0' + path.encode('utf-8') + b'\0')
+            with open(os.path.join(src_dir, path), 'rb') as fp:
+                for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def run(self, src_dir):
+        cmd = [arg.format(dir=src_dir.rstrip('/')) for arg in self.cmd]
+        if self.stdout:
+            run_cmd_output(cmd, os.path.join(src_dir, self.stdout))
+        else:
+            run_cmd(cmd)
+
+
+def _copy_outputs(paths, src_dir, dst_dir):
+    for path in paths:
+        dst = os.path.join(dst_dir, path)
+        makedirs(os.path.dirname(dst))
+        shutil.copy2(os.path.join(src_dir, path), dst)
+
+
+def _run_step(step, src_dir, cache_dir):
+    if not cache_dir:
+        step.run(src_dir)
+        return
+
+    entry = os.path.join(cache_dir, step.key(src_dir))
+    if os.path.isdir(entry):
+        # Keep it away from prune_cache
+        os.utime(entry, None)
+        _copy_outputs(step.outputs, entry, src_dir)
+        return
+
+    step.run(src_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='tmp-', dir=cache_dir)
+    try:
+        _copy_outputs(step.outputs, src_dir, tmp_dir)
+        os.rename(tmp_dir, entry)
+    except OSError:
+        # Stored by another worker
+        shutil.rmtree(tmp_dir, True)
+
+
+def _levels(steps):
+    """
+    Group the steps in levels, the steps of one level only depend on
+    the steps of the former levels
+    """
+    producers = {}
+    for step in steps:
+        for path in step.outputs:
+            producers[path] = step
+
+    done = set()
+    pending = list(steps)
+    levels = []
+    while pending:
+        ready = [step for step in pending
+                 if all(producers[path] in done for path in step.inputs
+                        if path in producers)]
+        if not ready:
+            raise Exception('Dependency cycle in generate steps')
+        levels.append(ready)
+        done.update(ready)
+        pending = [step for step in pending if step not in done]
+    return levels
+
+
+def generate(steps, src_dir, cache_dir=None, jobs=None):
+    """
+    The outputs are written in src_dir, it must not be used by other
+    workers before generate() returns
+    """
+    if cache_dir:
+        cache_dir = os.path.join(cache_dir, 'gensrc')
+        makedirs(cache_dir)
+
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    # Threads are enough to drive the generator processes, and celery
+    # worker processes are not allowed to fork a multiprocessing pool
+    pool = ThreadPool(min(jobs, len(steps)) or 1)
+    try:
+        for level in _levels(steps):
+            pool.map(lambda step: _run_step(step, src_dir, cache_dir), level)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def prune_cache(cache_dir, max_days):
+    """
+    Remove outputs which have not been used for max_days
+    """
+    gensrc_dir = os.path.join(cache_dir, 'gensrc')
+    if not os.path.isdir(gensrc_dir):
+        return
+    deadline = time.time() - max_days * 24 * 3600
+    for name in os.listdir(gensrc_dir):
+        path = os.path.join(gensrc_dir, name)
+        try:
+            if os.path.getmtime(path) < deadline:
+                shutil.rmtree(path)
+        except OSError:
+            # Removed by another worker
+            pass
@@ -0,0 +1,188 @@
+"""
+Scan uploaded tracefiles once and collect metadata for CoverageFile
+"""
+import json
+import hashlib
+
+from .codec import open_binary, detect_bytes, Decompressor
+
+FORMAT_LCOV = 'lcov'
+FORMAT_COVERAGE_PY = 'coverage.py'
+FORMAT_UNKNOWN = 'unknown'
+
+_SQLITE_MAGIC = b'SQLite format 3\x00'
+_COVERAGE_PY_MAGIC = b'!coverage.py:'
+# Longest magic of the compressed formats, see codec.py
+_CODEC_MAGIC_SIZE = 6
+
+
+def path_roots(paths):
+    """
+    Group paths by their first directory, return the longest common
+    directory of each group, like:
+    ['/a/b/src/x.c', '/a/b/tools/y.c', '/c/z.c'] -> ['/a/b/', '/c/']
+    """
+    groups = {}
+    for path in paths:
+        parts = path.split('/')[:-1]
+        if not parts:
+            continue
+        first = parts[1] if len(parts) > 1 and not parts[0] else parts[0]
+        common = groups.get(first)
+        if common is None:
+            groups[first] = parts
+            continue
+        i = 0
+        while i < len(common) and i < len(parts) and common[i] == parts[i]:
+            i += 1
+        groups[first] = common[:i]
+
+    return sorted('/'.join(parts) + '/' for parts in groups.values())
+
+
+class TracefileScanner(object):
+    """
+    Feed the content chunk by chunk, then get the metadata from close().
+    Compressed content is decompressed first, so the content hash of a
+    tracefile is the same however it was uploaded.
+    """
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.format = None
+        self.paths = []
+        self.lines_found = 0
+        self.lines_hit = 0
+        self._rest = b''
+        self._data = []
+        self._head = b''
+        # None until the head is seen, False for plain content
+        self._decompressor = None
+        self._unreadable = False
+
+    def feed(self, chunk):
+        if self._decompressor is None:
+            self._head += chunk
+            if len(self._head) < _CODEC_MAGIC_SIZE:
+                return
+            chunk = self._start()
+        self._feed(self._decompress(chunk))
+
+    def _decompress(self, chunk):
+        if self._decompressor:
+            return self._decompressor.decompress(chunk)
+        return chunk
+
+    def _start(self):
+        head = self._head
+        self._head = b''
+        self._decompressor = False
+        codec = detect_bytes(head)
+        if codec:
+            try:
+                self._decompressor = Decompressor(codec)
+            except Exception:
+                # Nothing can be known about the content
+                self.format = FORMAT_UNKNOWN
+                self._unreadable = True
+        return head
+
+    def _feed(self, chunk):
+        self.sha256.update(chunk)
+        if self.format is None:
+            self._rest += chunk
+            head = self._rest.lstrip()
+            if len(head) < len(_SQLITE_MAGIC):
+                return
+            if head.startswith(_SQLITE_MAGIC):
+                self.format = FORMAT_COVERAGE_PY
+                self._rest = b''
+                return
+            elif head.startswith(_COVERAGE_PY_MAGIC):
+                self.format = FORMAT_COVERAGE_PY
+                self._data.append(self._rest)
+                self._rest = b''
+                return
+            self.format = FORMAT_LCOV
+            chunk = self._rest
+            self._rest = b''
+        elif self.format == FORMAT_COVERAGE_PY:
+            if self._data:
+                self._data.append(chunk)
+            return
+        elif self.format != FORMAT_LCOV:
+            return
+
+        lines = (self._rest + chunk).split(b'\n')
+        self._rest = lines.pop()
+        for line in lines:
+            self._scan_line(line)
+
+    def _scan_line(self, line):
+        if line.startswith(b'SF:'):
+            self.paths.append(line[3:].rstrip(b'\r').decode('utf-8', 'replace'))
+        elif line.startswith(b'DA:'):
+            fields = line[3:].split(b',')
+            self.lines_found += 1
+            if len(fields) > 1 and fields[1].strip() not in (b'0', b''):
+                self.lines_hit += 1
+
+    def _scan_coverage_py(self):
+        """
+        coverage.py < 5 json data file, only executed lines are recorded
+        """
+        content = b''.join(self._data)
+        self._data = []
+        try:
+            data = json.loads(content[len(_COVERAGE_PY_MAGIC):].decode('utf-8').split('!', 1)[-1])
+        except ValueError:
+            return
+        lines = data.get('lines') or {}
+        arcs = data.get('arcs') or {}
+        self.paths = list(set(lines.keys()) | set(arcs.keys()))
+        if lines:
+            self.lines_hit = sum(len(i) for i in lines.values())
+        self.lines_found = None
+
+    def close(self):
+        if self._decompressor is None:
+            self._feed(self._decompress(self._start()))
+        if self._unreadable:
+            return self._metadata(None, None, None)
+        if self.format is None:
+            if self._rest.strip():
+                self.format = FORMAT_LCOV
+            else:
+                self.format = FORMAT_UNKNOWN
+        if self.format == FORMAT_LCOV and self._rest:
+            self._scan_line(self._rest)
+            self._rest = b''
+        if self.format == FORMAT_COVERAGE_PY:
+            if self._data:
+                self._scan_coverage_py()
+            else:
+                # sqlite data file, nothing can be known without coverage.py
+                return self._metadata(None, None, None)
+        if self.format == FORMAT_LCOV and not self.paths:
+            self.lines_found = self.lines_hit = 0
+
+        return self._metadata(len(self.paths), self.lines_found, self.lines_hit)
+
+    def _metadata(self, source_count, lines_found, lines_hit):
+        return {'file_format': self.format,
+                'source_count': source_count,
+                'lines_found': lines_found,
+                'lines_hit': lines_hit,
+                'content_hash': self.sha256.hexdigest(),
+                'path_roots': ';'.join(path_roots(self.paths))}
+
+
+def scan_chunks(chunks):
+    scanner = TracefileScanner()
+    for chunk in chunks:
+        scanner.feed(chunk)
+    return scanner.close()
+
+
+def scan_tracefile(file_path, chunk_size=64 * 1024):
+    with open_binary(file_path) as fp:
+        return scan_chunks(iter(lambda: fp.read(chunk_size), b''))
@@ -0,0 +1,437 @@
+"""
+Native lcov tracefile helpers
+
+Tracefile format: see geninfo(1), section "FILES"
+"""
+import os
+import operator
+import tempfile
+from array import array
+
+from .codec import open_tracefile
+
+
+def _merge_sorted(lines1, hits1, lines2, hits2):
+    """
+    Merge two sorted (line, hit) array pairs, hits of the same line are added
+    """
+    if not lines2:
+        return lines1, hits1
+    if not lines1:
+        return array('i', lines2), array('l', hits2)
+    if lines1 == lines2:
+        return lines1, array('l', map(operator.add, hits1, hits2))
+    if lines1[-1] < lines2[0]:
+        return lines1 + lines2, hits1 + hits2
+    if lines2[-1] < lines1[0]:
+        return lines2 + lines1, hits2 + hits1
+
+    # The dict, the sort and the array copies run in C, only the lines
+    # of the second pair are visited in Python
+    merged = dict(zip(lines1, hits1))
+    get = merged.get
+    for line, count in zip(lines2, hits2):
+        merged[line] = get(line, 0) + count
+    lines = array('i', sorted(merged))
+    return lines, array('l', map(merged.__getitem__, lines))
+
+
+def _add_taken(taken1, taken2):
+    if taken1 < 0:
+        return taken2
+    if taken2 < 0:
+        return taken1
+    return taken1 + taken2
+
+
+class FunctionRecord(object):
+    """
+    end is the last line of the function, only lcov 2.x records it
+    """
+    __slots__ = ('name', 'line', 'count', 'end')
+
+    def __init__(self, name, line, count=0, end=None):
+        self.name = name
+        self.line = line
+        self.count = count
+        self.end = end
+
+
+class BranchData(object):
+    """
+    BRDA records of one source file sorted by (line, block, branch) in
+    parallel arrays, taken is -1 if the branch block was never executed
+    ('-' in tracefile)
+    """
+    __slots__ = ('lines', 'blocks', 'branches', 'taken')
+
+    def __init__(self):
+        self.lines = array('i')
+        self.blocks = array('i')
+        self.branches = array('i')
+        self.taken = array('l')
+
+    def __len__(self):
+        return len(self.lines)
+
+    def keys(self):
+        return list(zip(self.lines, self.blocks, self.branches))
+
+    def records(self):
+        return zip(self.lines, self.blocks, self.branches, self.taken)
+
+    def hit(self):
+        return len(self.taken) - self.taken.count(0) - self.taken.count(-1)
+
+    def set(self, records):
+        """
+        Set from (line, block, branch, taken) tuples which may be unsorted
+        and contain duplicates
+        """
+        tmp = {}
+        for line, block, branch, taken in records:
+            key = (line, block, branch)
+            tmp[key] = _add_taken(tmp.get(key, -1), taken)
+        keys = sorted(tmp)
+        self.lines = array('i', [key[0] for key in keys])
+        self.blocks = array('i', [key[1] for key in keys])
+        self.branches = array('i', [key[2] for key in keys])
+        self.taken = array('l', map(tmp.__getitem__, keys))
+
+    def merge(self, other):
+        if not other.lines:
+            return
+        if not self.lines:
+            self.lines = array('i', other.lines)
+            self.blocks = array('i', other.blocks)
+            self.branches = array('i', other.branches)
+            self.taken = array('l', other.taken)
+        elif self.keys() == other.keys():
+            self.taken = array('l', map(_add_taken, self.taken, other.taken))
+        else:
+            self.set(list(self.records()) + list(other.records()))
+
+
+class FileCoverage(object):
+    """
+    Coverage data of one source file, line numbers and hit counts are
+    kept sorted by line number in two parallel arrays
+    """
+    __slots__ = ('path', 'lines', 'hits', 'checksums', 'functions', 'branches')
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = array('i')
+        self.hits = array('l')
+        # Only filled when the tracefile contains DA checksums
+        self.checksums = None
+        self.functions = {}
+        self.branches = BranchData()
+
+    def set_lines(self, lines, hits):
+        """
+        Set line data from two unsorted lists which may contain duplicates
+        """
+        if all(lines[i] < lines[i + 1] for i in range(len(lines) - 1)):
+            self.lines = array('i', lines)
+            self.hits = array('l', hits)
+            return
+
+        tmp = {}
+        for line, count in zip(lines, hits):
+            tmp[line] = tmp.get(line, 0) + count
+        self.lines = array('i', sorted(tmp.keys()))
+        self.hits = array('l', [tmp[line] for line in self.lines])
+
+    def merge(self, other):
+        self.lines, self.hits = _merge_sorted(self.lines, self.hits,
+                                              other.lines, other.hits)
+        if other.checksums:
+            if self.checksums is None:
+                self.checksums = {}
+            for line, checksum in other.checksums.items():
+                self.checksums.setdefault(line, checksum)
+
+        for name, func in other.functions.items():
+            exist = self.functions.get(name)
+            if exist is None:
+                self.functions[name] = FunctionRecord(name, func.line, func.count,
+                                                      func.end)
+            else:
+                exist.count += func.count
+                if exist.end is None:
+                    exist.end = func.end
+
+        self.branches.merge(other.branches)
+
+    def summary(self):
+        lh = len(self.hits) - self.hits.count(0)
+        fnh = len([f for f in self.functions.values() if f.count > 0])
+        brh = self.branches.hit()
+        return {'LF': len(self.lines), 'LH': lh,
+                'FNF': len(self.functions), 'FNH': fnh,
+                'BRF': len(self.branches), 'BRH': brh}
+
+    def write(self, fp):
+        summary = self.summary()
+        fp.write('SF:%s\n' % self.path)
+        functions = sorted(self.functions.values(), key=lambda x: (x.line, x.name))
+        for func in functions:
+            if func.end is None:
+                fp.write('FN:%d,%s\n' % (func.line, func.name))
+            else:
+                fp.write('FN:%d,%d,%s\n' % (func.line, func.end, func.name))
+        for func in functions:
+            fp.write('FNDA:%d,%s\n' % (func.count, func.name))
+        fp.write('FNF:%d\n' % summary['FNF'])
+        fp.write('FNH:%d\n' % summary['FNH'])
+        if self.branches:
+            for line, block, branch, taken in self.branches.records():
+                taken = '-' if taken < 0 else taken
+                fp.write('BRDA:%d,%d,%d,%s\n' % (line, block, branch, taken))
+            fp.write('BRF:%d\n' % summary['BRF'])
+            fp.write('BRH:%d\n' % summary['BRH'])
+        checksums = self.checksums or {}
+        for line, count in zip(self.lines, self.hits):
+            if line in checksums:
+                fp.write('DA:%d,%d,%s\n' % (line, count, checksums[line]))
+            else:
+                fp.write('DA:%d,%d\n' % (line, count))
+        fp.write('LF:%d\n' % summary['LF'])
+        fp.write('LH:%d\n' % summary['LH'])
+        fp.write('end_of_record\n')
+
+
+class PathRewriter(object):
+    """
+    Rewrite SF: path prefixes of a tracefile while it is read, rules are
+    (src_prefix, tgt_prefix) pairs applied one after another
+    """
+    def __init__(self, rules=None):
+        self.rules = [(src, tgt) for src, tgt in rules or [] if src]
+
+    @classmethod
+    def from_string(cls, rules_str):
+        """
+        rules_str format: 'src_prefix:tgt_prefix;src_prefix2:tgt_prefix2'
+        """
+        rules = []
+        if rules_str:
+            for rule in rules_str.split(';'):
+                if not rule.strip():
+                    continue
+                if ':' not in rule:
+                    raise Exception('Invalid path rule: %s' % rule)
+                src, tgt = rule.split(':', 1)
+                rules.append((src.strip(), tgt.strip()))
+        return cls(rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+    __nonzero__ = __bool__
+
+    def extend(self, rules):
+        return PathRewriter(self.rules + list(rules))
+
+    def rewrite(self, path):
+        for src, tgt in self.rules:
+            if path.startswith(src):
+                path = tgt + path[len(src):]
+        return path
+
+    def iter_lines(self, lines):
+        if not self.rules:
+            for line in lines:
+                yield line
+            return
+
+        for line in lines:
+            if line.startswith('SF:'):
+                line = 'SF:%s\n' % self.rewrite(line[3:].rstrip('\r\n'))
+            yield line
+
+
+def iter_records(lines):
+    """
+    Parse lcov tracefile lines, yield (test_name, FileCoverage) for
+    every SF: section. Summary records (FNF, FNH, BRF, BRH, LF, LH)
+    are skipped, they are recomputed when the record is written.
+    """
+    test_name = ''
+    record = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        if line == 'end_of_record':
+            if record is not None:
+                record.set_lines(da_lines, da_hits)
+                record.branches.set(branches)
+                yield test_name, record
+            record = None
+            continue
+
+        tag, _, value = line.partition(':')
+        if tag == 'TN':
+            test_name = value.strip()
+        elif tag == 'SF':
+            record = FileCoverage(value)
+            da_lines = []
+            da_hits = []
+            branches = []
+        elif record is None:
+            continue
+        elif tag == 'DA':
+            fields = value.split(',')
+            da_lines.append(int(fields[0]))
+            da_hits.append(int(fields[1]))
+            if len(fields) > 2:
+                if record.checksums is None:
+                    record.checksums = {}
+                record.checksums.setdefault(int(fields[0]), fields[2])
+        elif tag == 'FN':
+            # lcov 1.x 'FN:line,name', lcov 2.x 'FN:line,end_line,name',
+            # function names never start with a digit
+            fields = value.split(',', 2)
+            end = None
+            if len(fields) == 3 and fields[1].isdigit():
+                end = int(fields[1])
+                name = fields[2]
+            else:
+                name = value.split(',', 1)[1]
+            func = record.functions.get(name)
+            if func is None:
+                record.functions[name] = FunctionRecord(name, int(fields[0]), end=end)
+            elif func.line == 0:
+                # Created by an FNDA record before its FN
+                func.line = int(fields[0])
+                func.end = end
+        elif tag == 'FNDA':
+            count, name = value.split(',', 1)
+            func = record.functions.get(name)
+            if func is None:
+                # FNDA without FN, keep it so the hit is not lost
+                func = record.functions[name] = FunctionRecord(name, 0)
+            func.count += int(count)
+        elif tag == 'BRDA':
+            line_no, block, branch, taken = value.split(',')
+            taken = -1 if taken == '-' else int(taken)
+            branches.append((int(line_no), int(block), int(branch), taken))
+
+    if record is not None:
+        record.set_lines(da_lines, da_hits)
+        record.branches.set(branches)
+        yield test_name, record
+
+
+class CoverageData(object):
+    """
+    Coverage data of a whole tracefile, records are kept per test name
+    (TN:) and source file path like lcov does
+    """
+    def __init__(self):
+        self.tests = {}
+
+    @property
+    def test_names(self):
+        return set(self.tests.keys())
+
+    def add_file(self, record, test_name=''):
+        files = self.tests.setdefault(test_name, {})
+        exist = files.get(record.path)
+        if exist is None:
+            files[record.path] = record
+        else:
+            exist.merge(record)
+
+    def load(self, lines):
+        for test_name, record in iter_records(lines):
+            self.add_file(record, test_name)
+
+    def read(self, tracefile, rewriter=None):
+        with open_tracefile(tracefile) as fp:
+            if rewriter:
+                self.load(rewriter.iter_lines(fp))
+            else:
+                self.load(fp)
+
+    def merge(self, other):
+        for test_name, other_files in other.tests.items():
+            files = self.tests.setdefault(test_name, {})
+            for record in other_files.values():
+                if record.path not in files:
+                    files[record.path] = FileCoverage(record.path)
+                files[record.path].merge(record)
+
+    def merged_files(self):
+        """
+        Records of all the tests merged by source file path, the records
+        are shared with the data if there is only one test
+        """
+        if len(self.tests) == 1:
+            return dict(list(self.tests.values())[0])
+        files = {}
+        for test_files in self.tests.values():
+            for path, record in test_files.items():
+                if path not in files:
+                    files[path] = FileCoverage(path)
+                files[path].merge(record)
+        return files
+
+    def summary(self):
+        ret = {'LF': 0, 'LH': 0, 'FNF': 0, 'FNH': 0, 'BRF': 0, 'BRH': 0}
+        for record in self.merged_files().values():
+            for key, val in record.summary().items():
+                ret[key] += val
+        return ret
+
+    def dump(self, fp):
+        for test_name in sorted(self.tests.keys()):
+            files = self.tests[test_name]
+            for path in sorted(files.keys()):
+                fp.write('TN:%s\n' % test_name)
+                files[path].write(fp)
+
+    def save(self, tracefile):
+        """
+        Write to a temporary file first, so tracefile can also be
+        one of the inputs
+        """
+        dir_name = os.path.dirname(os.path.abspath(tracefile))
+        tmp_file = tempfile.NamedTemporaryFile(
+            mode='w', suffix='.tmp', prefix='tracefile-',
+            dir=dir_name, delete=False)
+        try:
+            self.dump(tmp_file)
+            tmp_file.close()
+            os.rename(tmp_file.name, tracefile)
+        except Exception as e:
+            tmp_file.close()
+            if os.path.exists(tmp_file.name):
+                os.unlink(tmp_file.name)
+            raise e
+
+
+def load_tracefile(tracefile, rewriter=None):
+    data = CoverageData()
+    data.read(tracefile, rewriter)
+    return data
+
+
+def source_paths(tracefile):
+    """
+    Return the set of SF: paths in tracefile
+    """
+    paths = set()
+    with open_tracefile(tracefile) as fp:
+        for line in fp:
+            if line.startswith('SF:'):
+                paths.add(line[3:].rstrip('\r\n'))
+    return paths
+
+
+def merge_tracefiles(tracefiles, merged_tracefile, rewriter=None):
+    data = CoverageData()
+    for tracefile in tracefiles:
+        data.read(tracefile, rewriter)
+    data.save(merged_tracefile)
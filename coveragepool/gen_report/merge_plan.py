@@ -0,0 +1,150 @@
+"""
+Plan merges of tracefiles from different versions
+
+Uploads of the same version are merged into one intermediate tracefile
+first, every intermediate is converted once to the target version and
+the results are merged at last, so the number of conversions depends
+on the number of versions instead of the number of uploads.
+Intermediates are kept in the cache dir and reused by later merges.
+"""
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+
+from .utils import version_prefix
+
+# Settings which change the merged or converted tracefiles, see
+# load_settings() in gen_report/tasks.py
+CONFIG_KEYS = ('path_rules', 'merge_backend', 'convert_backend', 'tag_fmt', 'git_repo')
+
+
+def _hash(items):
+    return hashlib.sha256('\n'.join(items).encode('utf-8')).hexdigest()
+
+
+def prune_cache(cache_dir, max_days):
+    """
+    Remove intermediates which have not been used for max_days
+    """
+    merge_dir = os.path.join(cache_dir, 'merge')
+    if not os.path.isdir(merge_dir):
+        return
+    deadline = time.time() - max_days * 24 * 3600
+    for name in os.listdir(merge_dir):
+        path = os.path.join(merge_dir, name)
+        try:
+            if os.path.getmtime(path) < deadline:
+                os.unlink(path)
+        except OSError:
+            # Removed by another worker
+            pass
+
+
+class MergePlanner(object):
+    """
+    Uploads are grouped by version_prefix(). Cached intermediates are
+    keyed by the helper and the CONFIG_KEYS of params too, so changed
+    project settings never reuse stale ones.
+    """
+    def __init__(self, helper, tgt_version, cache_dir=None, params=None):
+        self.helper = helper
+        self.tgt_version = tgt_version
+        self.tgt_prefix = version_prefix(tgt_version)
+        params = params or {}
+        self.config = [type(helper).__name__] + ['%s=%s' % (key, params.get(key) or '')
+                                                 for key in CONFIG_KEYS]
+        self.tracefiles = []
+        self.groups = {}
+        self.tmp_files = []
+        if cache_dir:
+            self.cache_dir = os.path.join(cache_dir, 'merge')
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+        else:
+            self.cache_dir = None
+
+    def add_tracefile(self, version, tracefile, content_key=None):
+        """
+        content_key identifies the tracefile content, like the content
+        hash scanned at upload time, the path is used if it is not known
+        """
+        prefix = version_prefix(version)
+        if prefix == self.tgt_prefix:
+            self.tracefiles.append(tracefile)
+        else:
+            self.groups.setdefault(prefix, []).append(
+                (content_key or tracefile, tracefile, version))
+
+    def add_coverage_file(self, obj):
+        self.add_tracefile(obj.version, obj.coveragefile.path, obj.content_hash)
+
+    def _lookup(self, kind, key):
+        if not self.cache_dir:
+            return None, None
+        path = os.path.join(self.cache_dir, '%s-%s.info' % (kind, key))
+        if os.path.exists(path):
+            # Keep it away from prune_cache
+            os.utime(path, None)
+            return path, path
+        return None, path
+
+    def _store(self, tmp_path, path):
+        if not path:
+            self.tmp_files.append(tmp_path)
+            return tmp_path
+        # Write in the cache dir first, so rename is atomic
+        tmp_file = tempfile.NamedTemporaryFile(
+            suffix='.tmp', prefix='tmp-', dir=self.cache_dir, delete=False)
+        tmp_file.close()
+        shutil.move(tmp_path, tmp_file.name)
+        os.rename(tmp_file.name, path)
+        return path
+
+    def _merge_group(self, prefix, items):
+        key = _hash(self.config + [prefix] + sorted(i[0] for i in items))
+        if len(items) == 1:
+            return key, items[0][1]
+
+        cached, path = self._lookup('merged', key)
+        if cached:
+            return key, cached
+
+        tmp_file = tempfile.NamedTemporaryFile(
+            mode='w', suffix='.tmp', prefix='tracefile-', delete=False)
+        tmp_file.close()
+        os.unlink(tmp_file.name)
+        self.helper.merge_tracefile([i[1] for i in items], tmp_file.name)
+        if not os.path.exists(tmp_file.name):
+            # No valid tracefile in this version
+            return key, None
+        return key, self._store(tmp_file.name, path)
+
+    def prepare(self):
+        """
+        Return the tracefiles of the target version to merge
+        """
+        ret = list(self.tracefiles)
+        for prefix in sorted(self.groups.keys()):
+            key, merged = self._merge_group(prefix, self.groups[prefix])
+            if not merged:
+                continue
+            # Versions of one prefix only differ in the arch
+            version = min(i[2] for i in self.groups[prefix])
+
+            cached, path = self._lookup('converted', _hash([key, self.tgt_version]))
+            if cached:
+                ret.append(cached)
+                continue
+            converted = self.helper.convert_tracefiles(version, self.tgt_version,
+                                                       [merged])[0]
+            if converted:
+                ret.append(self._store(converted, path))
+        return ret
+
+    def clean_up(self):
+        for tmp_file in self.tmp_files:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+        self.tmp_files = []
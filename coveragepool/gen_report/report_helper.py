@@ -1,12 +1,26 @@
 import os
 import re
 import shutil
+import hashlib
 import tempfile
-import subprocess
 from contextlib import contextmanager
-from .utils import run_cmd, parse_package_name, check_package_version, trans_distro_info
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+from .utils import run_cmd, run_cmd_input, parse_package_name, check_package_version, trans_distro_info
+from . import lcov
+from . import genhtml
+from . import diffmap
+from . import gensrc
+from . import codec
+from .cache import DirCache, GitCheckoutCache, file_lock, git_has_ref, update_git_base
+from .rpmfile import extract_rpm_stream
 
 class BaseCoverageHelper(object):
+    # Base clones of the git repositories
+    git_base_dir = '/usr/share/coveragepool/'
+
     def prepare_env(self):
         raise NotImplementedError('prepare_env')
     def periodic_check(self):
@@ -15,8 +29,14 @@ class BaseCoverageHelper(object):
         raise NotImplementedError('gen_report')
     def merge_tracefile(self):
         raise NotImplementedError('merge_report')
-    def convert_tracefile(self):
-        raise NotImplementedError('convert_tracefile')
+    def convert_tracefile(self, src_ver, tgt_ver, tracefile):
+        return self.convert_tracefiles(src_ver, tgt_ver, [tracefile])[0]
+    def convert_tracefiles(self, src_ver, tgt_ver, tracefiles):
+        """
+        Convert tracefiles from src_ver to tgt_ver, return the converted
+        tracefiles in the same order, None for the invalid ones
+        """
+        raise NotImplementedError('convert_tracefiles')
 
 class BaseCoverageEnv(object):
     def prepare_env(self):
@@ -42,29 +62,69 @@ class RpmCoverageEnv(BaseCoverageEnv):
         run_cmd(pre_cmd)
         run_cmd(cmd)
 
+def extract_rpm(package, work_dir, path_filters=None):
+    """
+    Extract the payload of package in work_dir, package is a package
+    name for yumdownloader or the path of a local .rpm file. The package
+    is streamed from the mirror and only entries matching path_filters
+    are written, see extract_rpm_stream()
+    """
+    if package.endswith('.rpm') and os.path.isfile(package):
+        fp = open(package, 'rb')
+    else:
+        cmd = 'yumdownloader -q --urls %s' % package
+        out = run_cmd(cmd)
+        fp = urlopen(out.decode('utf-8').strip())
+    try:
+        extract_rpm_stream(fp, work_dir, path_filters)
+    finally:
+        fp.close()
+
+class RpmPayloadCache(DirCache):
+    """
+    Extracted package payloads keyed by the NVRA of the packages and
+    the path filters: 'pkg1 pkg2|filter1 filter2'
+    """
+    def populate(self, key, path):
+        packages, _, path_filters = key.partition('|')
+        # Extract aside and rename, so a half extracted tree is never seen
+        tmp_work_dir = tempfile.mkdtemp(prefix='tmp-', dir=self.root)
+        try:
+            for package in packages.split(' '):
+                extract_rpm(package, tmp_work_dir, path_filters.split())
+            os.rename(tmp_work_dir, path)
+        except Exception as e:
+            shutil.rmtree(tmp_work_dir, True)
+            raise e
+
 class Rpm2cpioCoverageEnv(BaseCoverageEnv):
-    def __init__(self):
+    """
+    With cache_dir the extracted packages are shared with other tasks
+    and kept in the cache after clean_up_env()
+    """
+    def __init__(self, cache_dir=None, cache_size=0):
         self.tmp_work_dir = None
+        self.cache = None
+        self.leased_key = None
+        if cache_dir:
+            self.cache = RpmPayloadCache(os.path.join(cache_dir, 'rpm'), cache_size)
+
+    def prepare_env(self, packages, path_filters=None):
+        """
+        path_filters: only extract the files matching these glob patterns
+        """
+        if self.cache:
+            key = ' '.join(sorted(packages))
+            if path_filters:
+                key += '|' + ' '.join(sorted(path_filters))
+            self.tmp_work_dir = self.cache.acquire(key)
+            self.leased_key = key
+            return self.tmp_work_dir
 
-    def prepare_env(self, packages):
         tmp_work_dir = tempfile.mkdtemp()
         for package in packages:
             try:
-                cmd = 'yumdownloader -q --urls %s' % package
-                out = run_cmd(cmd)
-
-                old_path = os.getcwd()
-                try:
-                    os.chdir(tmp_work_dir)
-                    pkg = '%s.rpm' % package
-                    cmd = 'wget %s -O %s' % (out[:-1], pkg)
-                    run_cmd(cmd)
-                    p = subprocess.Popen(('rpm2cpio', pkg), stdout=subprocess.PIPE)
-                    subprocess.check_output(('cpio', '-ivdm'), stdin=p.stdout, stderr=subprocess.STDOUT)
-                    os.remove(pkg)
-                finally:
-                    os.chdir(old_path)
-
+                extract_rpm(package, tmp_work_dir, path_filters)
             except Exception as e:
                 shutil.rmtree(tmp_work_dir)
                 raise e
@@ -73,20 +133,22 @@ class Rpm2cpioCoverageEnv(BaseCoverageEnv):
         return tmp_work_dir
 
     def clean_up_env(self):
+        if self.cache:
+            if self.leased_key:
+                self.cache.release(self.leased_key)
+                self.leased_key = None
+            return
+
         if self.tmp_work_dir:
             shutil.rmtree(self.tmp_work_dir)
 
 def prepare_git_repo(git_repo, base_dir, work_dir, commit=None):
-    if os.path.exists(base_dir):
-        git_dir = os.path.join(base_dir, '.git')
-        cmd = 'git --git-dir %s --work-tree %s pull' % (git_dir, base_dir)
-    else:
-        cmd = 'git clone %s %s' % (git_repo, base_dir)
-
-    run_cmd(cmd)
+    update_git_base(git_repo, base_dir, commit)
     if os.path.exists(work_dir):
         shutil.rmtree(work_dir)
-    shutil.copytree(base_dir, work_dir)
+    # Do not copy while another task pulls
+    with file_lock(base_dir.rstrip('/') + '.lock'):
+        shutil.copytree(base_dir, work_dir)
 
     if commit:
         git_dir = os.path.join(work_dir, '.git')
@@ -94,22 +156,65 @@ def prepare_git_repo(git_repo, base_dir, work_dir, commit=None):
         run_cmd(cmd2)
 
 class GitCoverageEnv(BaseCoverageEnv):
-    def __init__(self, name, work_dir, git_repo, base_dir='/usr/share/coveragepool/'):
+    """
+    With cache_dir the checkout is a shared git worktree from the cache
+    and work_dir is changed to point to it after prepare_env(). Without
+    work_dir the checkout is made in a private temporary dir.
+    prepare(work_dir) is called on new checkouts only, cached worktrees
+    keep what it wrote
+    """
+    def __init__(self, name, work_dir, git_repo, base_dir='/usr/share/coveragepool/',
+                 cache_dir=None, cache_size=0, prepare=None):
         self.name = name
         self.work_dir = work_dir
-        self.git_dir = os.path.join(work_dir, '.git')
+        self.git_dir = os.path.join(work_dir, '.git') if work_dir else None
         self.git_repo = git_repo
         self.Base_dir = os.path.join(base_dir, name)
+        self.cache = None
+        self.leased_tag = None
+        self.own_work_dir = False
+        self.prepare = prepare
+        if cache_dir:
+            self.cache = GitCheckoutCache(os.path.join(cache_dir, 'git', name),
+                                          git_repo, self.Base_dir, cache_size,
+                                          prepare)
 
     def prepare_env(self, git_tag):
-        prepare_git_repo(self.git_repo, self.Base_dir, self.work_dir, git_tag)
+        if not self.cache:
+            if not self.work_dir:
+                self.work_dir = tempfile.mkdtemp(prefix='%s-' % self.name) + '/'
+                self.git_dir = os.path.join(self.work_dir, '.git')
+                self.own_work_dir = True
+            prepare_git_repo(self.git_repo, self.Base_dir, self.work_dir, git_tag)
+            if self.prepare:
+                self.prepare(self.work_dir)
+            return
 
-    def get_git_diff(self, src_tag, tgt_tag):
-        cmd = 'git --git-dir %s --work-tree %s diff %s %s' % (self.git_dir,
-                self.work_dir, src_tag, tgt_tag)
-        out = run_cmd(cmd)
+        self.work_dir = os.path.join(self.cache.acquire(git_tag), '')
+        self.git_dir = os.path.join(self.work_dir, '.git')
+        self.leased_tag = git_tag
+
+    def list_files(self, git_tag):
+        cmd = 'git --git-dir %s --work-tree %s ls-tree -r --name-only %s' % (self.git_dir,
+                self.work_dir, git_tag)
+        return run_cmd(cmd).decode('utf-8').splitlines()
+
+    def get_git_diff(self, src_tag, tgt_tag, paths=None):
+        """
+        Limit the diff to paths if it is not None
+        """
+        args = ['git', '--git-dir', self.git_dir, '--work-tree', self.work_dir,
+                'diff', src_tag, tgt_tag]
+        if paths is not None:
+            args += ['--'] + sorted(paths)
+
+        if paths is not None and not paths:
+            # No pathspec would diff the whole tree
+            out = b''
+        else:
+            out = run_cmd(args)
         tmp_file = tempfile.NamedTemporaryFile(
-            mode='w', suffix='.tmp', prefix='diff-',
+            mode='wb', suffix='.tmp', prefix='diff-',
             delete=False)
         tmp_file.write(out)
         tmp_file.close()
@@ -117,104 +222,348 @@ class GitCoverageEnv(BaseCoverageEnv):
         return tmp_file.name
 
     def clean_up_env(self):
-        if os.path.exists(self.work_dir):
+        if self.cache:
+            if self.leased_tag:
+                self.cache.release(self.leased_tag)
+                self.leased_tag = None
+            return
+
+        # The work_dir of the caller is left to it
+        if self.own_work_dir and os.path.exists(self.work_dir):
             shutil.rmtree(self.work_dir)
+        self.own_work_dir = False
+
+def version_git_tag(tag_fmt, version_name):
+    """
+    Return the package name and the git tag of a package version
+    """
+    name, version, release, arch = parse_package_name(version_name)
+    release = release.replace('.virtcov', '')
+    return name, tag_fmt.format(name, version, release, arch)
+
+@contextmanager
+def version_diff(name, git_repo, src_tag, tgt_tag, source_paths,
+                 base_dir, cache_dir=None, cache_size=0, prepare=None):
+    """
+    Yield the git diff from src_tag to tgt_tag, limited to the files of
+    source_paths. All the tracefiles of src_tag share one checkout and
+    diff
+    """
+    env = GitCoverageEnv(name, None, git_repo, base_dir, cache_dir=cache_dir,
+                         cache_size=cache_size, prepare=prepare)
+    tmp_diff = None
+    try:
+        env.prepare_env(src_tag)
+        # Only files in the tracefiles matter, keep the diff small
+        repo_paths = diffmap.match_paths(source_paths, env.list_files(src_tag))
+        tmp_diff = env.get_git_diff(src_tag, tgt_tag, set(repo_paths.values()))
+        yield tmp_diff
+    finally:
+        env.clean_up_env()
+        if tmp_diff and os.path.exists(tmp_diff):
+            os.unlink(tmp_diff)
+
+def _tmp_tracefile():
+    tmp_file = tempfile.NamedTemporaryFile(
+        mode='w', suffix='.tmp', prefix='diff-',
+        delete=False)
+    tmp_file.close()
+    return tmp_file.name
+
+def _patch_key(parent_key, patch):
+    h = hashlib.sha256(parent_key.encode('utf-8'))
+    h.update(patch)
+    return h.hexdigest()
+
+class PatchedTreeCache(GitCheckoutCache):
+    """
+    Upstream worktrees with the dist-git patch series applied, keyed by
+    'upstream_tag dist_git_tag series_hash'.
+
+    The commit after every applied patch is kept as a ref in the base
+    repository, named by the hash of the upstream commit and the patch
+    prefix. A new series starts from its longest prefix which was
+    applied before and only applies the patches after it. The refs of a
+    populated entry are listed in '<entry>.refs' and deleted with it.
+    """
+    ref_fmt = 'refs/coveragepool/patched/%s'
+
+    def __init__(self, root, name, git_repo, base_dir,
+                 dist_git_repo, dist_base_dir, patch_names, size_limit=0):
+        GitCheckoutCache.__init__(self, root, git_repo, base_dir, size_limit)
+        self.name = name
+        self.dist_git_repo = dist_git_repo
+        self.dist_base_dir = dist_base_dir.rstrip('/')
+        self.dist_git_dir = os.path.join(self.dist_base_dir, '.git')
+        self.patch_names = patch_names
+
+    def update_dist_base(self, tag=None):
+        update_git_base(self.dist_git_repo, self.dist_base_dir, tag)
+
+    def _show(self, tag, path):
+        return run_cmd(['git', '--git-dir', self.dist_git_dir, 'show',
+                        '%s:%s' % (tag, path)])
+
+    def read_series(self, dist_git_tag):
+        """
+        Return the patches of the spec file at dist_git_tag in order
+        """
+        spec = self._show(dist_git_tag, '%s.spec' % self.name).decode('utf-8')
+        return [self._show(dist_git_tag, patch_name)
+                for patch_name in self.patch_names(spec)]
+
+    def series_hash(self, patches):
+        return _patch_key('', b''.join(hashlib.sha256(patch).digest()
+                                       for patch in patches))
+
+    def populate(self, key, path):
+        git_tag, dist_git_tag, _ = key.split(' ')
+        self.update_base(git_tag)
+        self.update_dist_base(dist_git_tag)
+        patches = self.read_series(dist_git_tag)
+
+        commit = run_cmd(['git', '--git-dir', self.git_dir, 'rev-parse',
+                          '%s^{commit}' % git_tag]).decode('utf-8').strip()
+        prefix_keys = []
+        for patch in patches:
+            prefix_keys.append(_patch_key(prefix_keys[-1] if prefix_keys else commit,
+                                          patch))
+
+        start = 0
+        # remove() deletes refs under the same lock
+        with file_lock(self.base_lock):
+            for i in range(len(patches), 0, -1):
+                ref = self.ref_fmt % prefix_keys[i - 1]
+                if git_has_ref(self.git_dir, ref):
+                    start = i
+                    commit = ref
+                    break
+            run_cmd(['git', '--git-dir', self.git_dir, 'worktree', 'add',
+                     '--detach', path, commit])
+        try:
+            for i in range(start, len(patches)):
+                run_cmd_input(['git', '-C', path, 'am', '-3'], [patches[i]])
+                run_cmd(['git', '-C', path, 'update-ref',
+                         self.ref_fmt % prefix_keys[i], 'HEAD'])
+        except Exception as e:
+            # Drop the worktree with the state of the failed git am
+            self.remove(key, path)
+            raise e
+
+        # The refs of a failed series are kept, they are valid prefixes
+        with open(path + '.refs', 'w') as fp:
+            fp.write(''.join('%s\n' % (self.ref_fmt % i) for i in prefix_keys))
+
+    def remove(self, key, path):
+        with file_lock(self.base_lock):
+            try:
+                run_cmd(['git', '--git-dir', self.git_dir, 'worktree', 'remove',
+                         '--force', path])
+            except Exception:
+                # Not registered, pruned below
+                pass
+        GitCheckoutCache.remove(self, key, path)
+
+        refs_file = path + '.refs'
+        if not os.path.exists(refs_file):
+            return
+        with open(refs_file) as fp:
+            refs = fp.read().split()
+        with file_lock(self.base_lock):
+            for ref in refs:
+                try:
+                    run_cmd(['git', '--git-dir', self.git_dir, 'update-ref', '-d', ref])
+                except Exception:
+                    # Deleted with another entry of the same prefix
+                    pass
+        os.unlink(refs_file)
 
 class DistGitCoverageEnv(BaseCoverageEnv):
+    """
+    With cache_dir the patched tree is a shared git worktree from the
+    cache and work_dir is changed to point to it after prepare_env()
+    """
+    def __init__(self, cache_dir=None, cache_size=0):
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.cache = None
+        self.leased_key = None
+        self.work_dir = None
+        self.own_work_dir = False
+
     @staticmethod
-    def apply_patch(name, dist_work_dir, work_dir):
+    def patch_names(spec):
         """
         If not work as expected, override this function
         """
+        names = []
+        for line in spec.splitlines():
+            match = re.match(r"^Patch([0-9]+): (.+)", line)
+            if match:
+                names.append(match.groups()[1].strip())
+        return names
+
+    @classmethod
+    def apply_patch(cls, name, dist_work_dir, work_dir):
         spec_file = os.path.join(dist_work_dir, '%s.spec' % name)
         git_dir = os.path.join(work_dir, '.git')
         with open(spec_file) as fp:
-            lines = fp.readlines()
-        for line in lines:
-            match = re.match(r"^Patch([0-9]+): (.+)", line)
-            if match:
-                _, patch_name = match.groups()
-                patch_file = os.path.join(dist_work_dir, patch_name)
-                cmd = 'git --git-dir %s --work-tree %s am -3 %s' % (git_dir, work_dir, patch_file)
-                run_cmd(cmd)
+            patch_names = cls.patch_names(fp.read())
+        for patch_name in patch_names:
+            patch_file = os.path.join(dist_work_dir, patch_name)
+            cmd = 'git --git-dir %s --work-tree %s am -3 %s' % (git_dir, work_dir, patch_file)
+            run_cmd(cmd)
 
     def prepare_env(self, name, work_dir, git_repo,
                     git_tag, dist_git_repo, dist_git_tag,
                     base_dir='/usr/share/coveragepool/'):
-        Base_dir = os.path.join(base_dir, name)
-        prepare_git_repo(git_repo, Base_dir, work_dir, git_tag)
-        Base_dir = os.path.join(base_dir, '%s-dist-git' % name)
-        dist_work_dir = tempfile.mkdtemp()
-        prepare_git_repo(dist_git_repo, Base_dir, dist_work_dir, dist_git_tag)
-        self.apply_patch(name, dist_work_dir, work_dir)
+        if not self.cache_dir:
+            if not work_dir:
+                work_dir = tempfile.mkdtemp(prefix='%s-' % name) + '/'
+                self.own_work_dir = True
+            self.work_dir = work_dir
+            Base_dir = os.path.join(base_dir, name)
+            prepare_git_repo(git_repo, Base_dir, work_dir, git_tag)
+            Base_dir = os.path.join(base_dir, '%s-dist-git' % name)
+            dist_work_dir = tempfile.mkdtemp()
+            try:
+                prepare_git_repo(dist_git_repo, Base_dir, dist_work_dir, dist_git_tag)
+                self.apply_patch(name, dist_work_dir, work_dir)
+            finally:
+                shutil.rmtree(dist_work_dir, True)
+            return
+
+        self.cache = PatchedTreeCache(
+            os.path.join(self.cache_dir, 'patched', name), name,
+            git_repo, os.path.join(base_dir, name),
+            dist_git_repo, os.path.join(base_dir, '%s-dist-git' % name),
+            self.patch_names, self.cache_size)
+        self.cache.update_dist_base(dist_git_tag)
+        series_hash = self.cache.series_hash(self.cache.read_series(dist_git_tag))
+        key = '%s %s %s' % (git_tag, dist_git_tag, series_hash)
+        self.work_dir = os.path.join(self.cache.acquire(key), '')
+        self.leased_key = key
+
+    def clean_up_env(self):
+        if self.cache:
+            if self.leased_key:
+                self.cache.release(self.leased_key)
+                self.leased_key = None
+            return
+
+        # The work_dir of the caller is left to it
+        if self.own_work_dir and os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        self.own_work_dir = False
 
 class CCoverageHelper(BaseCoverageHelper):
     """
     Use LCOV to generate report
     """
-    def replace_tracefile(self, file_path, src, tgt, check_all=True):
-        # Work around someone's stupid patch :D
-        with open(file_path) as fp:
-            lines = fp.readlines()
-
-        for i, line in enumerate(lines):
-            if 'SF:' not in line:
-                continue
-            if src in line:
-                lines[i] = line.replace(src, tgt)
-            elif tgt in line:
-                if not check_all:
-                    return
-
-        with open(file_path, 'w') as fp:
-            fp.writelines(lines)
+    # Rules used when project and settings do not set path_rules
+    default_path_rules = ''
+
+    def __init__(self, config_params=None):
+        if config_params is None:
+            config_params = {}
+        # 'lcov': chain 'lcov -a' per tracefile, 'native': merge in process
+        self.merge_backend = config_params.get('merge_backend') or 'lcov'
+        # 'lcov': run 'lcov --diff' per tracefile, 'native': convert in process
+        self.convert_backend = config_params.get('convert_backend') or 'lcov'
+        path_rules = config_params.get('path_rules') or self.default_path_rules
+        self.path_rewriter = lcov.PathRewriter.from_string(path_rules)
+        # 1: single genhtml, 0: one genhtml per cpu, N: N genhtml in parallel
+        report_jobs = config_params.get('report_jobs')
+        self.report_jobs = 1 if report_jobs is None else int(report_jobs)
 
     def valid_tracefile(self, file_path):
-        with open(file_path) as fp:
-            lines = fp.readlines()
-
-        for i, line in enumerate(lines):
-            if 'SF:' in line:
-                return True
+        with codec.open_tracefile(file_path) as fp:
+            for line in fp:
+                if 'SF:' in line:
+                    return True
 
         return False
 
-    def copy_replace_tracefile(self, file_path, src, tgt, check_all=True):
-        with open(file_path) as fp:
-            tmp_file = tempfile.NamedTemporaryFile(
-                mode='w', suffix='.tmp', prefix='tracefile-',
-                delete=False)
-            tmp_file.write(fp.read())
-            tmp_file.close()
-
-        self.replace_tracefile(tmp_file.name, src, tgt, check_all)
-        return tmp_file.name
+    def gen_report(self, tracefile, output_dir, ig_err_src=False, rewriter=None):
+        """
+        rewriter is applied to SF: lines which are streamed to genhtml,
+        so the tracefile itself is never modified
+        """
+        if rewriter is None:
+            rewriter = self.path_rewriter
 
-    def gen_report(self, tracefile, output_dir, ig_err_src=False):
-        cmd = 'genhtml %s --output-directory %s' % (tracefile, output_dir)
+        extra_args = []
         if ig_err_src:
             # TODO: find a way to not use this work around when the source is from git
-            cmd += ' --ignore-errors source'
-        run_cmd(cmd)
+            extra_args += ['--ignore-errors', 'source']
+
+        if self.report_jobs != 1:
+            if genhtml.gen_sharded_report(tracefile, output_dir, rewriter,
+                                          extra_args, self.report_jobs):
+                return
+
+        args = ['genhtml', tracefile, '--output-directory', output_dir] + extra_args
+        if not rewriter and not codec.detect(tracefile):
+            run_cmd(args)
+            return
+
+        args[1] = '/dev/stdin'
+        # genhtml uses the tracefile name as title by default
+        args += ['--title', os.path.basename(tracefile)]
+        with codec.open_tracefile(tracefile) as fp:
+            run_cmd_input(args, rewriter.iter_lines(fp) if rewriter else fp)
 
     def merge_tracefile(self, tracefiles, merged_tracefile):
+        rewriter = self.path_rewriter
+        if self.merge_backend == 'native':
+            lcov.merge_tracefiles(tracefiles, merged_tracefile, rewriter)
+            return
+        elif self.merge_backend != 'lcov':
+            raise Exception('Unsupport merge backend %s' % self.merge_backend)
+
         first = True
         for i in tracefiles:
-            cmd = 'lcov -a %s' % i
+            # Rewritten or compressed tracefiles are streamed to lcov
+            stream = rewriter or codec.detect(i)
+            cmd = 'lcov -a %s' % (i if not stream else '/dev/stdin')
             if not first:
                 cmd += ' -a %s' % merged_tracefile
             else:
                 first = False
             cmd += ' -o %s' % merged_tracefile
-            run_cmd(cmd)
+            if not stream:
+                run_cmd(cmd)
+                continue
+            with codec.open_tracefile(i) as fp:
+                run_cmd_input(cmd, rewriter.iter_lines(fp) if rewriter else fp)
 
-    def convert_tracefile(self, src_tf, tgt_tf, diff_file, strip=1):
-        cmd = 'lcov --diff %s %s -o %s --strip=%d' % (src_tf, diff_file, tgt_tf, strip)
-        run_cmd(cmd)
+    def convert_with_diff(self, tracefiles, diff_file, strip=1):
+        """
+        tracefiles is a list of (src_tf, tgt_tf) converted with the same diff
+        """
+        if self.convert_backend == 'native':
+            diffmap.convert_tracefiles(tracefiles, diff_file, strip)
+            return
+        elif self.convert_backend != 'lcov':
+            raise Exception('Unsupport convert backend %s' % self.convert_backend)
+
+        for src_tf, tgt_tf in tracefiles:
+            if not codec.detect(src_tf):
+                cmd = 'lcov --diff %s %s -o %s --strip=%d' % (src_tf, diff_file, tgt_tf, strip)
+                run_cmd(cmd)
+                continue
+            cmd = 'lcov --diff /dev/stdin %s -o %s --strip=%d' % (diff_file, tgt_tf, strip)
+            with codec.open_tracefile(src_tf) as fp:
+                run_cmd_input(cmd, fp)
 
 class PythonCoverageHelper(BaseCoverageHelper):
     def __init__(self):
         self.cfg_file = None
+        # Needed by convert_tracefiles()
+        self.tag_fmt = None
+        self.git_repo = None
+        self.cache_dir = None
+        self.git_cache_size = None
 
     def gen_config_file(self, config_list):
         """
@@ -238,60 +587,85 @@ class PythonCoverageHelper(BaseCoverageHelper):
         tmp_file.close()
         self.cfg_file = tmp_file.name
 
-    def gen_report(self, tracefile, output_dir, ig_err_src=False):
-        run_cmd('coverage erase')
-
-        with open(tracefile) as fp:
-            tmp_file = tempfile.NamedTemporaryFile(
-                mode='w', suffix='.tmp', prefix='tracefile-',
-                delete=False)
-            tmp_file.write(fp.read())
-            tmp_file.close()
-
-        cmd = 'coverage combine'
-        if self.cfg_file:
-            cmd += ' --rcfile=%s' % self.cfg_file
-        cmd += ' %s' % tmp_file.name
-        run_cmd(cmd)
+    @contextmanager
+    def _combine(self, tracefiles):
+        """
+        Combine copies of tracefiles (combine removes its inputs) in a
+        private data file, yield the environment pointing to it
+        """
+        data_dir = tempfile.mkdtemp(prefix='coverage-')
+        try:
+            env = {'COVERAGE_FILE': os.path.join(data_dir, '.coverage')}
+            cmd = 'coverage combine'
+            if self.cfg_file:
+                cmd += ' --rcfile=%s' % self.cfg_file
+            for i, tracefile in enumerate(tracefiles):
+                tmp_file = os.path.join(data_dir, 'tracefile-%d' % i)
+                # coverage.py needs plain data files
+                codec.copy_decompressed(tracefile, tmp_file)
+                cmd += ' %s' % tmp_file
+            run_cmd(cmd, env)
+            yield env
+        finally:
+            shutil.rmtree(data_dir, True)
 
-        cmd = 'coverage html -d %s' % output_dir
-        if ig_err_src:
-            cmd += ' -i'
-        run_cmd(cmd)
+    def gen_report(self, tracefile, output_dir, ig_err_src=False):
+        with self._combine([tracefile]) as env:
+            cmd = 'coverage html -d %s' % output_dir
+            if ig_err_src:
+                cmd += ' -i'
+            run_cmd(cmd, env)
 
     def merge_tracefile(self, tracefiles, merged_tracefile):
-        run_cmd('coverage erase')
+        with self._combine(tracefiles) as env:
+            shutil.copy(env['COVERAGE_FILE'], merged_tracefile)
 
-        cmd = 'coverage combine'
-        tmp_trace_files = []
-        if self.cfg_file:
-            cmd += ' --rcfile=%s' % self.cfg_file
-        for i in tracefiles:
-            with open(i) as fp:
-                tmp_file = tempfile.NamedTemporaryFile(
-                    mode='w', suffix='.tmp', prefix='tracefile-',
-                    delete=False)
-                tmp_file.write(fp.read())
-                tmp_file.close()
-            cmd += ' %s' % tmp_file.name
-            tmp_trace_files.append(tmp_file.name)
+    def convert_tracefiles(self, src_ver, tgt_ver, tracefiles):
+        """
+        Convert coverage.py data files with the git diff of the versions,
+        see LibvirtCoverageHelper.convert_tracefiles()
+        """
+        if not self.tag_fmt or not self.git_repo:
+            raise Exception('Not support convert trace file')
+        name, src_git_tag = version_git_tag(self.tag_fmt, src_ver)
+        _, tgt_git_tag = version_git_tag(self.tag_fmt, tgt_ver)
 
+        data_dir = tempfile.mkdtemp(prefix='coverage-')
+        converted = []
         try:
-            run_cmd(cmd)
+            data_files = []
+            source_paths = set()
+            for i, tracefile in enumerate(tracefiles):
+                data_file = os.path.join(data_dir, 'tracefile-%d' % i)
+                # coverage.py needs plain data files
+                codec.copy_decompressed(tracefile, data_file)
+                data_files.append(data_file)
+                source_paths.update(diffmap.coverage_source_paths(data_file))
+
+            with version_diff(name, self.git_repo, src_git_tag, tgt_git_tag,
+                              source_paths, self.git_base_dir, self.cache_dir,
+                              self.git_cache_size) as tmp_diff:
+                converted = [_tmp_tracefile() for i in data_files]
+                diffmap.convert_coverage_files(list(zip(data_files, converted)), tmp_diff)
+            return converted
         except Exception as e:
-            for trace_file in tmp_trace_files:
-                os.unlink(trace_file)
+            for tmp_tracefile in converted:
+                if os.path.exists(tmp_tracefile):
+                    os.unlink(tmp_tracefile)
             raise e
-
-        shutil.copy('.coverage', merged_tracefile)
-
-    def convert_tracefile(self, src_tf, tgt_tf, diff_file):
-        raise Exception('Not support convert trace file')
+        finally:
+            shutil.rmtree(data_dir, True)
 
 class LibvirtCoverageHelper(CCoverageHelper):
+    default_path_rules = '/usr/coverage/:/mnt/coverage/;/builddir/build/:/mnt/coverage/'
+
     def __init__(self, config_params):
+        CCoverageHelper.__init__(self, config_params)
         self.tag_fmt = config_params.get('tag_fmt')
         self.git_repo = config_params.get('git_repo')
+        self.cache_dir = config_params.get('cache_dir')
+        self.git_cache_size = config_params.get('git_cache_size')
+        self.rpm_cache_size = config_params.get('rpm_cache_size')
         self.env = None
         self.old_src_dir = None
         self.new_src_dir = None
@@ -309,40 +683,51 @@ class LibvirtCoverageHelper(CCoverageHelper):
         if name != 'libvirt':
             raise Exception('This is not libvirt report: %s' % name)
 
+        # Source dir in the tracefiles, it is mapped to the prepared one
         work_dir = '/mnt/coverage/BUILD/libvirt-%s/' % version
+        self.env = Rpm2cpioCoverageEnv(self.cache_dir, self.rpm_cache_size)
         try:
-            self.env = Rpm2cpioCoverageEnv()
             if 'el6' in release:
-                tmp_work_dir = self.env.prepare_env(
-                        ['libvirt-devel-%s-%s' % (version, release)])
                 src_dir = 'usr/share/doc/libvirt-devel-%s/gcno/' % version
-            elif 'el7' in release:
                 tmp_work_dir = self.env.prepare_env(
-                        ['libvirt-docs-%s-%s' % (version, release)])
+                        ['libvirt-devel-%s-%s' % (version, release)], [src_dir])
+            elif 'el7' in release:
                 src_dir = 'usr/share/doc/libvirt-docs-%s/gcno/' % version
-            elif 'el8' in release:
                 tmp_work_dir = self.env.prepare_env(
-                        ['libvirt-docs-%s-%s' % (version, release)])
+                        ['libvirt-docs-%s-%s' % (version, release)], [src_dir])
+            elif 'el8' in release:
                 src_dir = 'usr/share/doc/libvirt-docs/gcno/'
+                tmp_work_dir = self.env.prepare_env(
+                        ['libvirt-docs-%s-%s' % (version, release)], [src_dir])
             else:
                 raise Exception('Unsupport distro type')
-
-            self.old_src_dir = work_dir
             self.new_src_dir = os.path.join(tmp_work_dir, src_dir)
-            yield
         except Exception as e:
             #TODO: logging
+            self.env.clean_up_env()
 
-            # Git base
-            self.env = GitCoverageEnv(name, work_dir, git_repo)
-            git_tag = tag_fmt.format(name, version, release, arch)
-            self.env.prepare_env(git_tag)
-            self._extra_prepare(work_dir)
+            # Git base, checkout in a private dir or a cached worktree,
+            # sources are generated once when the worktree is populated
+            # as other workers may lease it at the same time
+            self.env = GitCoverageEnv(name, None, git_repo, self.git_base_dir,
+                                      cache_dir=self.cache_dir,
+                                      cache_size=self.git_cache_size,
+                                      prepare=self._extra_prepare)
+            try:
+                git_tag = tag_fmt.format(name, version, release, arch)
+                self.env.prepare_env(git_tag)
+            except Exception as e:
+                self.env.clean_up_env()
+                self.env = None
+                raise e
+            self.new_src_dir = os.path.join(self.env.work_dir, '')
 
+        self.old_src_dir = work_dir
+        try:
             yield
         finally:
-            if self.env:
-                self.env.clean_up_env()
+            self.env.clean_up_env()
+            self.env = None
 
     def periodic_check(self):
         raise NotImplementedError('periodic_check')
@@ -351,143 +736,88 @@ class LibvirtCoverageHelper(CCoverageHelper):
         work_tracefiles = []
         for tracefile in tracefiles:
             if CCoverageHelper.valid_tracefile(self, tracefile):
-                CCoverageHelper.replace_tracefile(self, tracefile, '/usr/coverage/', '/mnt/coverage/')
-                CCoverageHelper.replace_tracefile(self, tracefile, '/builddir/build/', '/mnt/coverage/')
                 work_tracefiles.append(tracefile)
         CCoverageHelper.merge_tracefile(self, work_tracefiles, merged_tracefile)
 
-    def convert_tracefile(self, src_ver, tgt_ver, tracefile):
-        tag_fmt = self.tag_fmt
-        git_repo = self.git_repo
-        if not CCoverageHelper.valid_tracefile(self, tracefile):
-            return
-
-        name, version, release, arch = parse_package_name(src_ver)
-        release = release.replace('.virtcov', '')
-        src_git_tag = tag_fmt.format(name, version, release, arch)
-        name, version, release, arch = parse_package_name(tgt_ver)
-        release = release.replace('.virtcov', '')
-        tgt_git_tag = tag_fmt.format(name, version, release, arch)
-
-        work_dir = '/mnt/coverage/BUILD/libvirt-%s/' % version
-        self.env = GitCoverageEnv(name, work_dir, git_repo)
-        tmp_diff = None
+    def convert_tracefiles(self, src_ver, tgt_ver, tracefiles):
+        """
+        Convert tracefiles from src_ver to tgt_ver with a single checkout
+        and diff, return the converted tracefiles in the same order, None
+        for the invalid ones
+        """
+        valid_tracefiles = [tracefile for tracefile in tracefiles
+                            if CCoverageHelper.valid_tracefile(self, tracefile)]
+        if not valid_tracefiles:
+            return [None] * len(tracefiles)
+
+        name, src_git_tag = version_git_tag(self.tag_fmt, src_ver)
+        _, tgt_git_tag = version_git_tag(self.tag_fmt, tgt_ver)
+        source_paths = set()
+        for tracefile in valid_tracefiles:
+            source_paths.update(lcov.source_paths(tracefile))
+
+        converted = {}
         try:
-            self.env.prepare_env(src_git_tag)
-            tmp_diff = self.env.get_git_diff(src_git_tag, tgt_git_tag)
-            tmp_file = tempfile.NamedTemporaryFile(
-                mode='w', suffix='.tmp', prefix='diff-',
-                delete=False)
-            tmp_file.close()
-            CCoverageHelper.convert_tracefile(self, tracefile, tmp_file.name, tmp_diff)
-            return tmp_file.name
-        finally:
-            if self.env:
-                self.env.clean_up_env()
-            if tmp_diff and os.path.exists(tmp_diff):
-                os.unlink(tmp_diff)
+            # Same worktrees as prepare_env(), they must get the generated sources
+            with version_diff(name, self.git_repo, src_git_tag, tgt_git_tag,
+                              source_paths, self.git_base_dir, self.cache_dir,
+                              self.git_cache_size, self._extra_prepare) as tmp_diff:
+                for tracefile in valid_tracefiles:
+                    converted[tracefile] = _tmp_tracefile()
+                CCoverageHelper.convert_with_diff(self, list(converted.items()), tmp_diff)
+            return [converted.get(tracefile) for tracefile in tracefiles]
+        except Exception as e:
+            for tmp_tracefile in converted.values():
+                if os.path.exists(tmp_tracefile):
+                    os.unlink(tmp_tracefile)
+            raise e
 
     def gen_report(self, tracefile, output_dir):
+        rewriter = self.path_rewriter
         if self.new_src_dir:
-            try:
-                tmp_tracefile = CCoverageHelper.copy_replace_tracefile(self, tracefile,
-                                                                       self.old_src_dir, self.new_src_dir)
-                CCoverageHelper.gen_report(self, tmp_tracefile, output_dir, True)
-            finally:
-                if os.path.exists(tmp_tracefile):
-                    os.unlink(tmp_tracefile)
-        else:
-            CCoverageHelper.gen_report(self, tracefile, output_dir, True)
+            rewriter = rewriter.extend([(self.old_src_dir, self.new_src_dir)])
+        CCoverageHelper.gen_report(self, tracefile, output_dir, True, rewriter)
 
     def _extra_prepare(self, work_dir):
-        cmd = 'perl -w %s -k remote REMOTE %s' % (os.path.join(work_dir, 'src/rpc/gendispatch.pl'),
-                                                  os.path.join(work_dir, 'src/remote/remote_protocol.x'))
-        out = run_cmd(cmd)
-        with open(os.path.join(work_dir, 'src/remote/remote_client_bodies.h'), 'w') as fp:
-            fp.write(out)
-
-        cmd = 'perl -w %s -k qemu QEMU %s' % (os.path.join(work_dir, 'src/rpc/gendispatch.pl'),
-                                              os.path.join(work_dir, 'src/remote/qemu_protocol.x'))
-        out = run_cmd(cmd)
-        with open(os.path.join(work_dir, 'src/remote/qemu_client_bodies.h'), 'w') as fp:
-            fp.write(out)
-
-        cmd = 'perl -w %s -b remote REMOTE %s' % (os.path.join(work_dir, 'src/rpc/gendispatch.pl'),
-                                                  os.path.join(work_dir, 'src/remote/remote_protocol.x'))
-        out = run_cmd(cmd)
-        with open(os.path.join(work_dir, 'daemon/remote_dispatch.h'), 'w') as fp:
-            fp.write(out)
+        gensrc.generate(self.gensrc_steps(), work_dir, self.cache_dir)
 
-        cmd = 'perl -w %s -b qemu QEMU %s' % (os.path.join(work_dir, 'src/rpc/gendispatch.pl'),
-                                              os.path.join(work_dir, 'src/remote/qemu_protocol.x'))
-        out = run_cmd(cmd)
-        with open(os.path.join(work_dir, 'daemon/qemu_dispatch.h'), 'w') as fp:
-            fp.write(out)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -h %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/remote/remote_protocol.x'),
-                         os.path.join(work_dir, 'src/remote/remote_protocol.h'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -c %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/remote/remote_protocol.x'),
-                         os.path.join(work_dir, 'src/remote/remote_protocol.c'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -h %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/remote/qemu_protocol.x'),
-                         os.path.join(work_dir, 'src/remote/qemu_protocol.h'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -c %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/remote/qemu_protocol.x'),
-                         os.path.join(work_dir, 'src/remote/qemu_protocol.c'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -h %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/rpc/virkeepaliveprotocol.x'),
-                         os.path.join(work_dir, 'src/rpc/virkeepaliveprotocol.h'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -c %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/rpc/virkeepaliveprotocol.x'),
-                         os.path.join(work_dir, 'src/rpc/virkeepaliveprotocol.c'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -h %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/rpc/virnetprotocol.x'),
-                         os.path.join(work_dir, 'src/rpc/virnetprotocol.h'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -c %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/rpc/virnetprotocol.x'),
-                         os.path.join(work_dir, 'src/rpc/virnetprotocol.c'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -h %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/lxc/lxc_protocol.x'),
-                         os.path.join(work_dir, 'src/lxc/lxc_protocol.h'),)
-        out = run_cmd(cmd)
-
-        cmd_fmt = 'perl -w %s /usr/bin/rpcgen -c %s %s'
-        cmd = cmd_fmt % (os.path.join(work_dir, 'src/rpc/genprotocol.pl'),
-                         os.path.join(work_dir, 'src/lxc/lxc_protocol.x'),
-                         os.path.join(work_dir, 'src/lxc/lxc_protocol.c'),)
-        out = run_cmd(cmd)
+    @staticmethod
+    def gensrc_steps():
+        """
+        Sources generated by the libvirt build which are not in git
+        """
+        gendispatch = 'src/rpc/gendispatch.pl'
+        genprotocol = 'src/rpc/genprotocol.pl'
+        steps = []
+        for mode, out_fmt in (('-k', 'src/remote/%s_client_bodies.h'),
+                              ('-b', 'daemon/%s_dispatch.h')):
+            for name in ('remote', 'qemu'):
+                protocol = 'src/remote/%s_protocol.x' % name
+                steps.append(gensrc.Step(
+                    ['perl', '-w', '{dir}/' + gendispatch, mode, name,
+                     name.upper(), '{dir}/' + protocol],
+                    [gendispatch, protocol], stdout=out_fmt % name))
+
+        for protocol in ('src/remote/remote_protocol', 'src/remote/qemu_protocol',
+                         'src/rpc/virkeepaliveprotocol', 'src/rpc/virnetprotocol',
+                         'src/lxc/lxc_protocol'):
+            for ext in ('h', 'c'):
+                output = '%s.%s' % (protocol, ext)
+                steps.append(gensrc.Step(
+                    ['perl', '-w', '{dir}/' + genprotocol, '/usr/bin/rpcgen',
+                     '-' + ext, '{dir}/%s.x' % protocol, '{dir}/' + output],
+                    [genprotocol, protocol + '.x'], [output]))
+        return steps
 
 class VirtinstCoverageHelper(PythonCoverageHelper):
     def __init__(self, config_params):
+        # Partial merges combine without prepare_env()
+        PythonCoverageHelper.__init__(self)
         self.tag_fmt = config_params.get('tag_fmt')
         self.git_repo = config_params.get('git_repo')
+        self.cache_dir = config_params.get('cache_dir')
+        self.git_cache_size = config_params.get('git_cache_size')
+        self.rpm_cache_size = config_params.get('rpm_cache_size')
         self.env = None
 
     @contextmanager
@@ -497,15 +827,15 @@ class VirtinstCoverageHelper(PythonCoverageHelper):
 
         name, version, release, arch = parse_package_name(version_name)
 
-        self.env = Rpm2cpioCoverageEnv()
+        self.env = Rpm2cpioCoverageEnv(self.cache_dir, self.rpm_cache_size)
         try:
             if 'el6' in release:
                 tmp_work_dir = self.env.prepare_env(
-                        ['python-virtinst-%s-%s' % (version, release)])
+                        ['python-virtinst-%s-%s' % (version, release)], ['usr/'])
             elif 'el7' in release:
                 tmp_work_dir = self.env.prepare_env(
                         ['virt-install-%s-%s' % (version, release),
-                         'virt-manager-common-%s-%s' % (version, release)])
+                         'virt-manager-common-%s-%s' % (version, release)], ['usr/'])
             else:
                 raise Exception('Unsupport distro type')
 
@@ -0,0 +1,294 @@
+"""
+Stream the cpio payload out of a rpm package and extract selected files
+
+Package layout: lead (96 bytes), signature header (padded to 8 bytes),
+header, compressed cpio payload (newc format).
+See: http://ftp.rpm.org/max-rpm/s1-rpm-file-format-rpm-file-format.html
+"""
+import os
+import stat
+import zlib
+import errno
+import struct
+import fnmatch
+import threading
+import subprocess
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+_TAG_PAYLOADFORMAT = 1124
+_TAG_PAYLOADCOMPRESSOR = 1125
+_TYPE_STRING = 6
+_CHUNK_SIZE = 64 * 1024
+# Decompress with a command when the python module is missing (no lzma
+# on python 2)
+_COMMANDS = {
+    'xz': ['xz', '-dc'],
+    'lzma': ['xz', '-dc', '--format=lzma'],
+    'zstd': ['zstd', '-dc'],
+}
+
+
+def _read_exact(fp, size):
+    data = b''
+    while len(data) < size:
+        chunk = fp.read(size - len(data))
+        if not chunk:
+            raise Exception('Unexpected end of rpm file')
+        data += chunk
+    return data
+
+
+def _read_header(fp, pad=False):
+    """
+    Return a dict of tag -> value for the string tags of a header
+    """
+    magic = _read_exact(fp, 8)
+    if magic[:4] != _HEADER_MAGIC:
+        raise Exception('Invalid rpm header')
+    nindex, hsize = struct.unpack('>II', _read_exact(fp, 8))
+    index = _read_exact(fp, 16 * nindex)
+    store = _read_exact(fp, hsize)
+    if pad and hsize % 8:
+        _read_exact(fp, 8 - hsize % 8)
+
+    ret = {}
+    for i in range(nindex):
+        tag, tag_type, offset, _ = struct.unpack('>iiii', index[i * 16:i * 16 + 16])
+        if tag_type == _TYPE_STRING:
+            ret[tag] = store[offset:store.index(b'\x00', offset)].decode('utf-8')
+    return ret
+
+
+def _decompressor(compressor):
+    if compressor == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compressor == 'bzip2' and bz2:
+        return bz2.BZ2Decompressor()
+    elif compressor in ('xz', 'lzma') and lzma:
+        return lzma.LZMADecompressor()
+    elif compressor == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise Exception('Unsupport rpm payload compressor %s' % compressor)
+
+
+class _PayloadReader(object):
+    """
+    File like reader which decompresses the payload while it is read
+    """
+    def __init__(self, fp, compressor):
+        self.fp = fp
+        self.proc = None
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+        try:
+            self.decompressor = _decompressor(compressor)
+        except Exception as e:
+            if compressor not in _COMMANDS:
+                raise e
+            self.decompressor = None
+            self._start_command(_COMMANDS[compressor])
+
+    def _start_command(self, cmd):
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError:
+            raise Exception('Unsupport rpm payload compressor, %s not found' % cmd[0])
+        self.feeder = threading.Thread(target=self._feed)
+        self.feeder.daemon = True
+        self.feeder.start()
+        self.source = self.proc.stdout
+
+    def _feed(self):
+        try:
+            while True:
+                chunk = self.fp.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.proc.stdin.write(chunk)
+        except (IOError, OSError):
+            # The reader stopped before the end of the payload
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def close(self):
+        if not self.proc:
+            return
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.feeder.join()
+        self.proc.wait()
+        self.proc = None
+
+    def read(self, size):
+        while len(self.buf) - self.pos < size and not self.eof:
+            if self.proc:
+                chunk = self.source.read(_CHUNK_SIZE)
+            else:
+                chunk = self.fp.read(_CHUNK_SIZE)
+            if not chunk:
+                self.eof = True
+                break
+            if self.decompressor:
+                chunk = self.decompressor.decompress(chunk)
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, _CHUNK_SIZE))
+            if not data:
+                raise Exception('Unexpected end of rpm payload')
+            size -= len(data)
+
+
+def _match(name, path_filters):
+    if not path_filters:
+        return True
+    parts = name.split('/')
+    for path_filter in path_filters:
+        filter_parts = path_filter.strip('/').split('/')
+        if len(parts) < len(filter_parts):
+            # Parent dirs of the wanted subtree
+            if fnmatch.fnmatch(name, '/'.join(filter_parts[:len(parts)])):
+                return True
+            continue
+        if fnmatch.fnmatch('/'.join(parts[:len(filter_parts)]), '/'.join(filter_parts)):
+            return True
+    return False
+
+
+def _safe_path(work_dir, name):
+    parts = name.split('/')
+    if not name or name.startswith('/') or '..' in parts:
+        raise Exception('Unsafe path in rpm payload: %s' % name)
+    return os.path.join(work_dir, name)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise e
+
+
+def extract_payload(reader, work_dir, path_filters=None):
+    """
+    Extract the matched entries of a newc cpio stream, return the number
+    of extracted entries
+    """
+    count = 0
+    # Hard links: data is stored with the last link only
+    links = {}
+    while True:
+        header = reader.read(110)
+        if len(header) < 110:
+            raise Exception('Unexpected end of cpio payload')
+        magic = header[:6]
+        if magic not in (b'070701', b'070702'):
+            raise Exception('Unsupport cpio format %s' % magic)
+        fields = [int(header[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+        ino, mode, _, _, nlink, mtime, filesize, devmajor, devminor, _, _, namesize, _ = fields
+
+        name = reader.read(namesize)[:-1].decode('utf-8')
+        reader.read((4 - (110 + namesize) % 4) % 4)
+        data_pad = (4 - filesize % 4) % 4
+        if name == 'TRAILER!!!':
+            break
+        if name.startswith('./'):
+            name = name[2:]
+
+        if not name or name == '.' or not _match(name, path_filters):
+            reader.skip(filesize + data_pad)
+            continue
+
+        path = _safe_path(work_dir, name)
+        _makedirs(os.path.dirname(path))
+        if stat.S_ISDIR(mode):
+            _makedirs(path)
+            os.chmod(path, stat.S_IMODE(mode))
+        elif stat.S_ISLNK(mode):
+            target = reader.read(filesize).decode('utf-8')
+            reader.skip(data_pad)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(target, path)
+        elif stat.S_ISREG(mode):
+            link_key = (ino, devmajor, devminor)
+            if nlink > 1 and filesize == 0:
+                links.setdefault(link_key, []).append(path)
+                reader.skip(data_pad)
+                continue
+            with open(path, 'wb') as fp:
+                left = filesize
+                while left > 0:
+                    data = reader.read(min(left, _CHUNK_SIZE))
+                    if not data:
+                        raise Exception('Unexpected end of cpio payload')
+                    fp.write(data)
+                    left -= len(data)
+            reader.skip(data_pad)
+            os.chmod(path, stat.S_IMODE(mode))
+            os.utime(path, (mtime, mtime))
+            for link in links.pop(link_key, []):
+                if os.path.lexists(link):
+                    os.unlink(link)
+                os.link(path, link)
+        else:
+            # Device nodes and fifos are not needed
+            reader.skip(filesize + data_pad)
+            continue
+        count += 1
+
+    # Hard links without data are empty files
+    for paths in links.values():
+        for path in paths:
+            open(path, 'wb').close()
+    return count
+
+
+def extract_rpm_stream(fp, work_dir, path_filters=None):
+    """
+    Extract files of the rpm package read from fp into work_dir.
+    path_filters is a list of glob patterns of directories or files like
+    'usr/share/doc/libvirt-docs*/gcno/', everything else is skipped
+    without touching the disk.
+    """
+    lead = _read_exact(fp, 96)
+    if lead[:4] != _LEAD_MAGIC:
+        raise Exception('Not a rpm package')
+    _read_header(fp, pad=True)
+    header = _read_header(fp)
+
+    payload_format = header.get(_TAG_PAYLOADFORMAT, 'cpio')
+    if payload_format != 'cpio':
+        raise Exception('Unsupport rpm payload format %s' % payload_format)
+    compressor = header.get(_TAG_PAYLOADCOMPRESSOR, 'gzip')
+    reader = _PayloadReader(fp, compressor)
+    try:
+        return extract_payload(reader, work_dir, path_filters)
+    finally:
+        reader.close()
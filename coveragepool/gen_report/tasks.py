@@ -1,11 +1,15 @@
 from __future__ import absolute_import, unicode_literals
-from celery import shared_task, Task
+from celery import shared_task, Task, chord
 from celery.decorators import task, periodic_task
 from celery.task.schedules import crontab
 from celery.utils.log import get_task_logger
 
 import os
+import json
+import uuid
 import shutil
+import hashlib
+import datetime
 from dateutil import parser
 import time
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "coveragepool.settings")
@@ -13,30 +17,83 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "coveragepool.settings")
 import django
 django.setup()
 from django.conf import settings
-
-from upload.google_api import GoogleSheetMGR
-from upload.models import CoverageFile, CoverageReport, Project
+from django.db import transaction
+from django.db.models import Sum
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from upload.google_api import get_gsmgr, TokenBucket, bucket_path
+from upload.models import CoverageFile, CoverageReport, Project, PendingMerge, StorageUsage
+from upload.models import UploadSession, SheetOutbox
 from .utils import run_cmd, parse_package_name, check_package_version, trans_distro_info
+from .utils import version_prefix
+from .merge_plan import MergePlanner, prune_cache
+from . import gensrc
 from . import report_helper
+from .workspace import task_dir, task_output_dir, lock_resource, release_task, lock_root
+from .workspace import drop_lock
+from .cache import makedirs
 
 logger = get_task_logger(__name__)
 
-def prepare_gsmgr(project=None, sheet=None):
-    gs_key = getattr(settings, "COVERAGE_GS_KEY", None)
-    gs_json_file = getattr(settings, "COVERAGE_GS_JSON_FILE", None)
-
+def sheet_limiter(gs_key):
+    """
+    Requests to one spreadsheet share COVERAGE_GS_RATE, the bucket is in
+    the lock dir so all workers on the host see it
+    """
+    rate = float(getattr(settings, "COVERAGE_GS_RATE", 0) or 0)
+    if not rate:
+        return None
+    makedirs(lock_root())
+    return TokenBucket(bucket_path(lock_root(), gs_key), rate,
+                       int(getattr(settings, "COVERAGE_GS_BURST", 1) or 1))
+
+def sheet_target(project=None):
+    """
+    Return (gs_key, gs_json_file) of the project sheet
+    """
     if project:
-        gs_key = project.gs_key
-        gs_json_file = project.gs_json_file
+        return project.gs_key, project.gs_json_file
+    return (getattr(settings, "COVERAGE_GS_KEY", None),
+            getattr(settings, "COVERAGE_GS_JSON_FILE", None))
+
+def prepare_gsmgr(project=None, sheet=None):
+    gs_key, gs_json_file = sheet_target(project)
 
     if gs_key:
-        gs = GoogleSheetMGR(gs_key, json_file=gs_json_file, sheet=sheet)
+        # Authorized clients and sheet headers are reused by the process
+        gs = get_gsmgr(gs_key, sheet=sheet, json_file=gs_json_file,
+                       limiter=sheet_limiter(gs_key))
     else:
         # TODO: logging
         return
 
     return gs
 
+def queue_sheet_rows(project, rows, sheet=None, update=False):
+    """
+    Write rows to the project sheet after the transaction commits, rows
+    are dicts of column -> value with an Id. If update is True, only
+    rows which are in the sheet are changed.
+    """
+    gs_key, gs_json_file = sheet_target(project)
+    if not gs_key or not rows:
+        return
+    SheetOutbox.objects.bulk_create([SheetOutbox(gs_key=gs_key,
+                                                 gs_json_file=gs_json_file,
+                                                 sheet=sheet or 0,
+                                                 row_key=str(row['Id']),
+                                                 data=json.dumps(row),
+                                                 update=update) for row in rows])
+    transaction.on_commit(lambda: drain_sheet_outbox.delay())
+
+def pending_sheet_rows(gs):
+    """
+    Ids of the rows of the worksheet which are not written yet
+    """
+    return set(SheetOutbox.objects.filter(gs_key=gs.key, sheet=gs.sheet or 0
+                                          ).values_list('row_key', flat=True))
+
 def load_settings(project=None):
     ret = {}
     set_list = dir(settings)
@@ -68,19 +125,22 @@ class CallbackTask(Task):
         logger.info("Success")
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         logger.info("Fail")
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        # After the callbacks, which still use the task dir and locks
+        release_task(task_id)
 
 class CoverageReportCB(CallbackTask):
     def on_success(self, retval, task_id, args, kwargs):
         super(CoverageReportCB, self).on_success(retval, task_id, args, kwargs)
-        obj_id, output_dir = args
+        obj_id = args[0]
+        output_dir = args[1] if len(args) > 1 else kwargs.get('output_dir')
+        output_dir = task_output_dir(task_id, output_dir)
         obj = CoverageFile.objects.get(id=obj_id)
 
         params = load_settings(obj.project)
         base_url = params['base_url']
         base_dir = params['base_dir']
 
-        gs = prepare_gsmgr(obj.project)
-
         if not base_dir:
             return
 
@@ -102,33 +162,30 @@ class CoverageReportCB(CallbackTask):
             cr.url = url
             cr.save()
 
-            if gs:
-                if url:
-                    gs.search_update_by_dict({'Id': obj.id},
-                                             {'Coverage Report': url})
-                else:
-                    gs.search_update_by_dict({'Id': obj.id},
-                                             {'Coverage Report': 'Sucess'})
+            queue_sheet_rows(obj.project, [{'Id': obj.id,
+                                            'Coverage Report': url or 'Sucess'}],
+                             update=True)
         except Exception as detail:
             cr.delete()
             logger.error('Fail to finish successed work: %s' % detail)
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         super(CoverageReportCB, self).on_failure(exc, task_id, args, kwargs, einfo)
-        obj_id, output_dir = args
+        obj_id = args[0]
         obj = CoverageFile.objects.get(id=obj_id)
-        gs = prepare_gsmgr(obj.project)
-        if gs:
-            gs.search_update_by_dict({'Id': obj.id},
-                                     {'Coverage Report': 'Fail to generate report'})
+        queue_sheet_rows(obj.project, [{'Id': obj.id,
+                                        'Coverage Report': 'Fail to generate report'}],
+                         update=True)
 
-@task(base=CoverageReportCB)
-def gen_coverage_report(obj_id, output_dir):
+@task(base=CoverageReportCB, bind=True)
+def gen_coverage_report(self, obj_id, output_dir=None):
+    output_dir = task_output_dir(self.request.id, output_dir)
     shutil.rmtree(output_dir, True)
-    # TODO: Ensuring a task is only executed one at a time
     obj = CoverageFile.objects.get(id=obj_id)
     if not obj.project:
         raise Exception('Not support CoverageFile without project')
+    if obj.is_empty():
+        raise Exception('CoverageFile %d has no coverage data' % obj.id)
     params = load_settings(obj.project)
     helper = load_helper_cls(obj.project.name, params)
     with helper.prepare_env(obj.version):
@@ -137,22 +194,27 @@ def gen_coverage_report(obj_id, output_dir):
 class MergeCoverageReportCB(CallbackTask):
     def on_success(self, retval, task_id, args, kwargs):
         super(MergeCoverageReportCB, self).on_success(retval, task_id, args, kwargs)
-        if len(args) > 2:
-            obj_ids, output_dir, mobj_id = args
-        else:
-            obj_ids, output_dir = args
-            mobj_id = None
+        # Coalesced merges return the ids they merged
+        obj_ids = args[0] if retval is None else retval
+        output_dir = args[1] if len(args) > 1 else kwargs.get('output_dir')
+        output_dir = task_output_dir(task_id, output_dir)
+        mobj_id = args[2] if len(args) > 2 else kwargs.get('merge_id')
+        if not obj_ids:
+            return
 
         objs = [CoverageFile.objects.get(id=obj_id) for obj_id in obj_ids]
         # TODO: need check if all have one project ?
         obj = objs[0]
 
+        if mobj_id and not os.path.exists(output_dir):
+            # Nothing new in the files, the report is kept as it is
+            CoverageReport.objects.get(id=mobj_id).coverage_files.add(*objs)
+            return
+
         params = load_settings(obj.project)
         base_url = params['base_url']
         base_dir = params['base_dir']
 
-        gs = prepare_gsmgr(obj.project, sheet=1)
-
         if not base_dir:
             return
 
@@ -184,20 +246,17 @@ class MergeCoverageReportCB(CallbackTask):
 
             if cr.tracefile:
                 old_tracefile = cr.tracefile.path
-            cr.save_tracefile('/tmp/merge.tracefile')
+            cr.save_tracefile(os.path.join(task_dir(task_id), 'merge.tracefile'))
             cr.save()
 
-            if gs:
-                info_dict = {"Id": cr.id,
-                             "Name": cr.name,
-                             "Version": cr.version,
-                             "Date": cr.date.strftime("%Y-%m-%d %H:%M:%S"),
-                             "Merged from": '\n'.join([obj.name for obj in cr.coverage_files.all()]),
-                             "Coverage Report": url}
-                if not mobj_id:
-                    gs.add_new_row_by_dict(info_dict)
-                else:
-                    gs.search_update_by_dict({'Id': mobj_id}, info_dict)
+            info_dict = {"Id": cr.id,
+                         "Name": cr.name,
+                         "Version": cr.version,
+                         "Date": cr.date.strftime("%Y-%m-%d %H:%M:%S"),
+                         "Merged from": '\n'.join([obj.name for obj in cr.coverage_files.all()]),
+                         "Coverage Report": url}
+            # Rows of existing reports are only updated
+            queue_sheet_rows(obj.project, [info_dict], sheet=1, update=bool(mobj_id))
 
             if old_path:
                 shutil.rmtree(old_path, True)
@@ -219,106 +278,418 @@ class MergeCoverageReportCB(CallbackTask):
                 for obj in objs:
                     cr.coverage_files.remove(obj)
 
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        # Reduced merges hand the running merge over to the final task
+        if PendingMerge.objects.filter(task_id=task_id).delete()[0]:
+            mobj_id = args[2] if len(args) > 2 else kwargs.get('merge_id')
+            # Merges claimed while this one was running wait for it
+            if PendingMerge.objects.filter(report_id=mobj_id, running=False).exists():
+                merge_coverage_report.delay(None, None, mobj_id)
+        drop_lock(merge_lease(task_id))
+        super(MergeCoverageReportCB, self).after_return(status, retval, task_id,
+                                                        args, kwargs, einfo)
+
+def check_merge_request(report, obj_ids):
+    ext_obj_ids = [i.id for i in report.coverage_files.all()]
+    if set(ext_obj_ids) & set(obj_ids):
+        raise Exception("Found unexpected merge request, %s already "
+                        "been merged in CoverageReport obj (id %d)" %
+                        (str(list(set(ext_obj_ids) & set(obj_ids))), report.id))
+
+def request_merge(report_id, obj_ids):
+    """
+    Coalesce merge requests of a report: the CoverageFiles are added to
+    the queued merge of the report, a merge is only queued if there is
+    none. Files already merged or queued are ignored.
+    """
+    with transaction.atomic():
+        # Serialize with other requests and claim_merge() of this report
+        report = CoverageReport.objects.select_for_update().get(id=report_id)
+        busy_ids = set(report.coverage_files.values_list('id', flat=True))
+        pending = PendingMerge.objects.filter(report=report, running=False).first()
+        if pending:
+            busy_ids.update(pending.coverage_files.values_list('id', flat=True))
+        new_ids = [i for i in obj_ids if i not in busy_ids]
+        if not new_ids:
+            return
+
+        if not pending:
+            pending = PendingMerge.objects.create(report=report)
+            transaction.on_commit(
+                lambda: merge_coverage_report.delay(None, None, report_id))
+        pending.coverage_files.add(*new_ids)
+
+def merge_lease(task_id):
+    """
+    Lock held by the task working on a running merge
+    """
+    return 'merge-%s' % task_id
+
+def merge_stale_date():
+    hours = float(getattr(settings, "COVERAGE_MERGE_STALE_HOURS", 6) or 6)
+    return datetime.datetime.now() - datetime.timedelta(hours=hours)
+
+def touch_merge(task_id):
+    """
+    Mark the running merge of task_id alive, tasks of a reduced merge
+    call it at every step
+    """
+    PendingMerge.objects.filter(task_id=task_id).update(date=datetime.datetime.now())
+
+def merge_alive(pending, task_id):
+    if PendingMerge.objects.filter(id=pending.id, reduced=True,
+                                   date__gt=merge_stale_date()).exists():
+        # Steps of a reduced merge wait in the queue without the lease
+        return True
+    return not lock_resource(task_id, merge_lease(pending.task_id), blocking=False)
+
+def claim_merge(report_id, task_id):
+    """
+    Take the queued merge of the report, return the ids of its files.
+    The task holds the lease of the merge until it is done. A running
+    merge whose lease is free is from a dead worker, its files are
+    queued again. Reduced merges are dead if they also did no step for
+    COVERAGE_MERGE_STALE_HOURS. Return [] if a running merge is alive,
+    it queues the merge again when it is done.
+    """
+    lock_resource(task_id, merge_lease(task_id))
+    with transaction.atomic():
+        report = CoverageReport.objects.select_for_update().get(id=report_id)
+        pending = PendingMerge.objects.filter(report=report, running=False).first()
+        for dead in PendingMerge.objects.filter(report=report, running=True):
+            if merge_alive(dead, task_id):
+                logger.info('Merge %s of report %d is running' % (dead.task_id, report_id))
+                return []
+            logger.info('Queue files of dead merge %s again' % dead.task_id)
+            if not pending:
+                pending = PendingMerge.objects.create(report=report)
+            pending.coverage_files.add(*dead.coverage_files.all())
+            dead.delete()
+            drop_lock(merge_lease(dead.task_id))
+        if not pending:
+            return []
+        pending.running = True
+        pending.task_id = task_id
+        pending.date = datetime.datetime.now()
+        pending.save()
+        # Files merged by a former run
+        merged_ids = set(report.coverage_files.values_list('id', flat=True))
+        return [i for i in pending.coverage_files.values_list('id', flat=True)
+                if i not in merged_ids]
+
+def requeue_merges():
+    """
+    Queue the merges which wait for a running merge which never ended
+    """
+    report_ids = set(PendingMerge.objects.filter(running=False, date__lt=merge_stale_date())
+                     .values_list('report_id', flat=True))
+    for report_id in report_ids:
+        merge_coverage_report.delay(None, None, report_id)
+
+def skip_duplicate(obj, seen_hashes):
+    """
+    Return True if the content of CoverageFile obj is in seen_hashes,
+    add it otherwise. Reruns upload the same content again and again,
+    see COVERAGE_MERGE_SKIP_DUPLICATES
+    """
+    if not getattr(settings, "COVERAGE_MERGE_SKIP_DUPLICATES", True) or not obj.content_hash:
+        return False
+    if obj.content_hash in seen_hashes:
+        logger.info('Skip CoverageFile %d, same content is already merged' % obj.id)
+        return True
+    seen_hashes.add(obj.content_hash)
+    return False
+
+def merged_hashes(report):
+    return set(report.coverage_files.exclude(content_hash=None)
+               .values_list('content_hash', flat=True))
+
+def report_tracefiles(report):
+    """
+    Tracefiles which hold the current data of a merged report
+    """
+    if not report.tracefile:
+        seen_hashes = set()
+        return [i.coveragefile.path for i in report.coverage_files.all()
+                if not i.is_empty() and not skip_duplicate(i, seen_hashes)]
+    else:
+        return [report.tracefile.path]
+
+def _partial_name(root_id):
+    return 'merge-partial/%s/%s.info' % (root_id, uuid.uuid4().hex)
+
+def _remove_partials(name):
+    shutil.rmtree(os.path.dirname(default_storage.path(name)), True)
+
+def _prune_partials(max_days):
+    """
+    Remove results of tree reduced merges which never finished
+    """
+    partial_dir = default_storage.path('merge-partial')
+    if not os.path.isdir(partial_dir):
+        return
+    deadline = time.time() - max_days * 24 * 3600
+    for name in os.listdir(partial_dir):
+        path = os.path.join(partial_dir, name)
+        if os.path.getmtime(path) < deadline:
+            shutil.rmtree(path, True)
+
+@task(base=CallbackTask, bind=True)
+def merge_partial(self, project_id, tracefiles, partials, root_id):
+    """
+    Merge tracefiles and partial results (media names) of the tree
+    reduced merge root_id, return the media name of the result or None
+    if there is no valid tracefile
+    """
+    touch_merge(root_id)
+    project = Project.objects.get(id=project_id)
+    helper = load_helper_cls(project.name, load_settings(project))
+    tmp_tracefile = os.path.join(task_dir(self.request.id), 'partial.tracefile')
+    helper.merge_tracefile(list(tracefiles) + [default_storage.path(i) for i in partials],
+                           tmp_tracefile)
+    name = None
+    if os.path.exists(tmp_tracefile):
+        with open(tmp_tracefile, 'rb') as fp:
+            name = default_storage.save(_partial_name(root_id), File(fp))
+    for partial in partials:
+        default_storage.delete(partial)
+    return name
+
+@task(base=CallbackTask, bind=True)
+def reduce_merge(self, names, project_id, root_id, fanout, final_args, carried=()):
+    """
+    Chord callback of one level of the tree: merge the results in groups
+    of fanout in parallel until one is left, then queue the final
+    merge_coverage_report with it, root_id is the id of the final task
+    """
+    touch_merge(root_id)
+    names = [i for i in list(names) + list(carried) if i]
+    if not names:
+        raise Exception('No valid tracefile found in merge %s' % root_id)
+    if len(names) == 1:
+        merge_coverage_report.apply_async(final_args, {'partial': names[0]},
+                                          task_id=root_id)
+        return
 
-@task(base=MergeCoverageReportCB)
-def merge_coverage_report(obj_ids, output_dir, merge_id=None):
+    groups = [names[i:i + fanout] for i in range(0, len(names), fanout)]
+    header = [merge_partial.s(project_id, [], group, root_id)
+              for group in groups if len(group) > 1]
+    carried = [group[0] for group in groups if len(group) == 1]
+    chord(header)(reduce_merge.s(project_id, root_id, fanout, final_args, carried))
+
+def start_reduce_merge(project_id, tracefiles, root_id, batch_size, fanout, final_args):
+    """
+    Merge tracefiles on several workers: leaves merge batches of
+    batch_size tracefiles, the results are merged fanout by fanout, see
+    reduce_merge(). Results are exchanged through the media store.
+    root_id is the id of the final merge_coverage_report task.
+    """
+    header = [merge_partial.s(project_id, tracefiles[i:i + batch_size], [], root_id)
+              for i in range(0, len(tracefiles), batch_size)]
+    chord(header)(reduce_merge.s(project_id, root_id, max(fanout, 2), final_args))
+
+@task(base=MergeCoverageReportCB, bind=True)
+def merge_coverage_report(self, obj_ids, output_dir=None, merge_id=None, partial=None):
+    """
+    obj_ids None merges the files queued by request_merge() in the report
+    merge_id, the merged ids are returned to the callback.
+    With more files than COVERAGE_REDUCE_BATCH the merge of obj_ids is
+    spread over workers and this task is queued again with partial, the
+    media name of the result.
+    """
     only_version = None
+    report_files = []
     coverage_files = []
+    seen_hashes = set()
+    final_args = [obj_ids, output_dir, merge_id]
+    output_dir = task_output_dir(self.request.id, output_dir)
     shutil.rmtree(output_dir, True)
-    tmp_tracefile = '/tmp/merge.tracefile'
+    tmp_tracefile = os.path.join(task_dir(self.request.id), 'merge.tracefile')
 
     if merge_id:
+        # Held until the callback saved the report
+        lock_resource(self.request.id, 'report-%d' % merge_id)
+        if partial:
+            # Lease of the merge handed over by the first task
+            lock_resource(self.request.id, merge_lease(self.request.id))
+            touch_merge(self.request.id)
+        if obj_ids is None:
+            obj_ids = claim_merge(merge_id, self.request.id)
+            if not obj_ids:
+                return obj_ids
+            final_args[0] = obj_ids
         obj = CoverageReport.objects.get(id=merge_id)
-        ext_obj_ids = [i.id for i in obj.coverage_files.all()]
-        if set(ext_obj_ids) & set(obj_ids):
-            raise Exception("Found unexpected merge request, %s already "
-                            "been merged in CoverageReport obj (id %d)" %
-                            (str(list(set(ext_obj_ids) & set(obj_ids))), merge_id))
-
-        only_version = '.'.join(obj.version.split('.')[:-1])
-        if not obj.tracefile:
-            coverage_files.extend([i.coveragefile.path for i in obj.coverage_files.all()])
-        else:
-            coverage_files.append(obj.tracefile.path)
-
-    #TODO: support convert report
-    for obj_id in obj_ids:
-        obj = CoverageFile.objects.get(id=obj_id)
-        coverage_files.append(obj.coveragefile.path)
-        if only_version:
-            if only_version != '.'.join(obj.version.split('.')[:-1]):
-                raise Exception('Not support merge different coverage: %s != %s',
-                                only_version, '.'.join(obj.version.split('.')[:-1]))
-        else:
-            only_version = '.'.join(obj.version.split('.')[:-1])
+        check_merge_request(obj, obj_ids)
+        only_version = version_prefix(obj.version)
+        report_files = report_tracefiles(obj)
+        seen_hashes = merged_hashes(obj)
+
+    if partial:
+        # Files were checked before the reduce merge
+        obj = CoverageFile.objects.get(id=obj_ids[-1])
+        coverage_files.append(default_storage.path(partial))
+    else:
+        for obj_id in obj_ids:
+            obj = CoverageFile.objects.get(id=obj_id)
+            if obj.is_empty():
+                logger.info('Skip CoverageFile %d without coverage data' % obj.id)
+                continue
+            if skip_duplicate(obj, seen_hashes):
+                continue
+            coverage_files.append(obj.coveragefile.path)
+            if only_version:
+                if only_version != version_prefix(obj.version):
+                    raise Exception('Not support merge different coverage: %s != %s' %
+                                    (only_version, version_prefix(obj.version)))
+            else:
+                only_version = version_prefix(obj.version)
 
     if not obj:
         return
+    if not coverage_files:
+        if merge_id:
+            # Empty or already merged content only, the callback records
+            # the files as merged so they are not requested again
+            logger.info('Nothing new to merge in report %d' % merge_id)
+            return obj_ids
+        raise Exception('No coverage data found in CoverageFile %s' % str(obj_ids))
 
     # TODO: check have the same project
     if not obj.project:
         raise Exception('Not support CoverageFile without project')
     params = load_settings(obj.project)
     helper = load_helper_cls(obj.project.name, params)
-    with helper.prepare_env(obj.version):
-        helper.merge_tracefile(coverage_files, tmp_tracefile)
-        helper.gen_report(tmp_tracefile, output_dir)
 
-@task(base=MergeCoverageReportCB)
-def merge_convert_coverage_report(obj_ids, output_dir, merge_id):
-    tgt_version = None
-    coverage_files = []
-    tmp_coverage_files = []
+    batch_size = int(params.get('reduce_batch') or 0)
+    if not partial and batch_size and len(coverage_files) > batch_size:
+        root_id = str(uuid.uuid4())
+        # The final task finishes the running merge, it stays in the
+        # table and blocks other merges of the report until then
+        PendingMerge.objects.filter(task_id=self.request.id).update(
+            task_id=root_id, reduced=True, date=datetime.datetime.now())
+        start_reduce_merge(obj.project.id, coverage_files, root_id,
+                           batch_size, int(params.get('reduce_fanout') or 2),
+                           final_args)
+        # Nothing is merged yet, the callback runs with the final task
+        return []
+
+    try:
+        with helper.prepare_env(obj.version):
+            helper.merge_tracefile(report_files + coverage_files, tmp_tracefile)
+            helper.gen_report(tmp_tracefile, output_dir)
+    finally:
+        if partial:
+            _remove_partials(partial)
+    return obj_ids
+
+@task(base=MergeCoverageReportCB, bind=True)
+def merge_convert_coverage_report(self, obj_ids, output_dir, merge_id):
+    output_dir = task_output_dir(self.request.id, output_dir)
     shutil.rmtree(output_dir, True)
-    tmp_tracefile = '/tmp/merge.tracefile'
+    tmp_tracefile = os.path.join(task_dir(self.request.id), 'merge.tracefile')
 
+    # Held until the callback saved the report
+    lock_resource(self.request.id, 'report-%d' % merge_id)
     obj = CoverageReport.objects.get(id=merge_id)
-    ext_obj_ids = [i.id for i in obj.coverage_files.all()]
-    if set(ext_obj_ids) & set(obj_ids):
-        raise Exception("Found unexpected merge request, %s already "
-                        "been merged in CoverageReport obj (id %d)" %
-                        (str(list(set(ext_obj_ids) & set(obj_ids))), merge_id))
-
-    tgt_version = '.'.join(obj.version.split('.')[:-1])
-    if not obj.tracefile:
-        coverage_files.extend([i.coveragefile.path for i in obj.coverage_files.all()])
-    else:
-        coverage_files.append(obj.tracefile.path)
+    check_merge_request(obj, obj_ids)
 
     if not obj.project:
         raise Exception('Not support CoverageReport without project')
     params = load_settings(obj.project)
     helper = load_helper_cls(obj.project.name, params)
 
-    try:
-        for obj_id in obj_ids:
-            tmp_obj = CoverageFile.objects.get(id=obj_id)
-            if tgt_version != '.'.join(tmp_obj.version.split('.')[:-1]):
-                tmp_trace_file = helper.convert_tracefile(tmp_obj.version,
-                                                         obj.version,
-                                                         tmp_obj.coveragefile.path)
-                if tmp_trace_file:
-                    coverage_files.append(tmp_trace_file)
-                    tmp_coverage_files.append(tmp_trace_file)
-            else:
-                coverage_files.append(tmp_obj.coveragefile.path)
+    # Uploads of other versions are merged per version first, then every
+    # version is converted once, see gen_report/merge_plan.py
+    planner = MergePlanner(helper, obj.version, params.get('cache_dir'), params)
+    for tracefile in report_tracefiles(obj):
+        planner.add_tracefile(obj.version, tracefile)
+    seen_hashes = merged_hashes(obj)
+    for obj_id in obj_ids:
+        tmp_obj = CoverageFile.objects.get(id=obj_id)
+        if tmp_obj.is_empty():
+            logger.info('Skip CoverageFile %d without coverage data' % tmp_obj.id)
+            continue
+        if skip_duplicate(tmp_obj, seen_hashes):
+            continue
+        planner.add_coverage_file(tmp_obj)
 
+    try:
+        coverage_files = planner.prepare()
         with helper.prepare_env(obj.version):
             helper.merge_tracefile(coverage_files, tmp_tracefile)
             helper.gen_report(tmp_tracefile, output_dir)
     finally:
-        for trace_file in tmp_coverage_files:
-            if os.path.exists(trace_file):
-                os.unlink(trace_file)
+        planner.clean_up()
 
 #
 # Periodic Tasks
 #
 
+def _drain_spreadsheet(gs_key, batch_size):
+    """
+    Write the outbox rows of one spreadsheet in id order, a batch is one
+    read and one write per worksheet. Rows are removed once they are
+    written, a batch which fails is written again by a later run.
+    """
+    while True:
+        entries = list(SheetOutbox.objects.filter(gs_key=gs_key).order_by('id')[:batch_size])
+        if not entries:
+            return
+
+        # (sheet, json file) -> Id -> merged row, in the order of the entries
+        worksheets = {}
+        appends = {}
+        for entry in entries:
+            target = (entry.sheet, entry.gs_json_file)
+            rows = worksheets.setdefault(target, {})
+            if entry.row_key not in rows:
+                rows[entry.row_key] = {'order': entry.id, 'data': {}}
+            rows[entry.row_key]['data'].update(json.loads(entry.data))
+            if not entry.update:
+                appends.setdefault(target, set()).add(entry.row_key)
+
+        for target, rows in worksheets.items():
+            sheet, gs_json_file = target
+            gs = get_gsmgr(gs_key, sheet=sheet or None, json_file=gs_json_file,
+                           limiter=sheet_limiter(gs_key))
+            dict_list = [row['data'] for row in sorted(rows.values(), key=lambda i: i['order'])]
+            gs.upsert_rows_by_dict('Id', dict_list, appends.get(target, set()))
+
+        SheetOutbox.objects.filter(id__in=[entry.id for entry in entries]).delete()
+
+@periodic_task(run_every=(crontab(minute='*')), name="drain_sheet_outbox",
+               ignore_result=True, bind=True)
+def drain_sheet_outbox(self):
+    """
+    Queued by every change of the outbox, and run every minute to retry
+    the rows which failed
+    """
+    batch_size = int(getattr(settings, "COVERAGE_GS_OUTBOX_BATCH", 0) or 100)
+    try:
+        for gs_key in set(SheetOutbox.objects.values_list('gs_key', flat=True)):
+            # One writer per spreadsheet keeps the rows in order, a busy
+            # one is being drained by another worker
+            name = 'sheet-%s' % hashlib.sha1(gs_key.encode('utf-8')).hexdigest()
+            if not lock_resource(self.request.id, name, blocking=False):
+                continue
+            try:
+                _drain_spreadsheet(gs_key, batch_size)
+            except Exception as detail:
+                logger.error('Fail to write sheet %s: %s' % (gs_key, detail))
+    finally:
+        release_task(self.request.id)
+
 @periodic_task(run_every=(crontab(minute='*/15')), name="rescan_table", ignore_result=True)
 def rescan_table():
-    def _check_obj(objs, table, gs):
+    def _check_obj(objs, gs):
+        # In this order: a row which is not in the outbox any more is
+        # in the table, and the row of a new object is in one of them
+        objs = list(objs)
+        pending = pending_sheet_rows(gs)
+        table = gs.get_all_values()
         for obj in objs:
+            if str(obj.id) in pending:
+                continue
             infos = gs.search_info_by_dict({'Id': obj.id}, table)
             if infos:
                 if infos[0]['Name'] != obj.name:
@@ -351,22 +722,99 @@ def rescan_table():
             new_objs = [i for i in cf_objs if i not in s_exist_cfs]
             if not new_objs:
                 continue
-            merge_coverage_report.delay([i.id for i in new_objs], '/tmp/tmpdir', obj.id)
+            request_merge(obj.id, [i.id for i in new_objs])
 
     def _rescan_table_internal(project):
         objs = CoverageFile.objects.filter(project=project)
         gs = prepare_gsmgr(project)
         if gs:
-            table = gs.get_all_values()
-            _check_obj(objs, table, gs)
+            _check_obj(objs, gs)
 
         objs = CoverageReport.objects.filter(project=project)
         gs = prepare_gsmgr(project, sheet=1)
         if gs:
-            table = gs.get_all_values()
-            _check_obj(objs, table, gs)
+            _check_obj(objs, gs)
             _update_merge_report(objs)
 
     for project in Project.objects.all():
         _rescan_table_internal(project)
+    requeue_merges()
+
+    cache_dir = getattr(settings, "COVERAGE_CACHE_DIR", None)
+    if cache_dir:
+        max_days = getattr(settings, "COVERAGE_MERGE_CACHE_DAYS", 7)
+        prune_cache(cache_dir, max_days)
+        gensrc.prune_cache(cache_dir, max_days)
+    _prune_partials(getattr(settings, "COVERAGE_MERGE_CACHE_DAYS", 7))
     #_rescan_table_internal(None)
+
+@periodic_task(run_every=(crontab(minute=0, hour=3)), name="reconcile_storage_usage", ignore_result=True)
+def reconcile_storage_usage():
+    """
+    Recount the storage usage from the files, fix drifts of the ledger
+    kept by upload/models.py
+    """
+    def _size(field_file):
+        try:
+            return field_file.size if field_file else 0
+        except (IOError, OSError):
+            return 0
+
+    # Sizes are checked without lock, files are never changed in place
+    blobs = set()
+    for obj in CoverageFile.objects.all():
+        size = _size(obj.coveragefile)
+        if obj.file_size != size:
+            CoverageFile.objects.filter(id=obj.id).update(file_size=size)
+        blobs.add(obj.coveragefile.name)
+    for obj in CoverageReport.objects.all():
+        size = _size(obj.tracefile)
+        if obj.tracefile_size != size:
+            CoverageReport.objects.filter(id=obj.id).update(tracefile_size=size)
+
+    with transaction.atomic():
+        usages = dict((i.project_id, i) for i in StorageUsage.objects.select_for_update())
+        sizes = dict((i, 0) for i in usages.keys())
+        for row in CoverageReport.objects.values('project').annotate(size=Sum('tracefile_size')):
+            sizes[row['project']] = sizes.get(row['project'], 0) + (row['size'] or 0)
+        # Shared files are counted once, for their first upload
+        counted = set()
+        for row in CoverageFile.objects.order_by('id').values_list(
+                'project', 'coveragefile', 'file_size'):
+            project_id, name, size = row
+            if name in counted:
+                continue
+            counted.add(name)
+            sizes[project_id] = sizes.get(project_id, 0) + (size or 0)
+
+        for project_id, size in sizes.items():
+            usage = usages.get(project_id)
+            if not usage:
+                StorageUsage.objects.create(project_id=project_id, size=size)
+            elif usage.size != size:
+                logger.info('Fix storage usage of project %s: %d -> %d' %
+                            (project_id, usage.size, size))
+                StorageUsage.objects.filter(id=usage.id).update(size=size)
+
+    # Shared files left by concurrent deletes of their last uploads. Skip
+    # recent ones, they may belong to uploads which are not committed yet
+    blob_dir = default_storage.path('coveragefile/blobs')
+    if os.path.isdir(blob_dir):
+        deadline = time.time() - 24 * 3600
+        for name in os.listdir(blob_dir):
+            path = os.path.join(blob_dir, name)
+            if 'coveragefile/blobs/' + name in blobs or os.path.getmtime(path) > deadline:
+                continue
+            if CoverageFile.objects.filter(coveragefile='coveragefile/blobs/' + name).exists():
+                continue
+            logger.info('Remove unused coverage file %s' % name)
+            os.unlink(path)
+
+    # Chunked uploads which were given up, the staged files are removed
+    # with the sessions
+    session_days = int(getattr(settings, 'COVERAGE_UPLOAD_SESSION_DAYS', 0) or 0)
+    if session_days:
+        deadline = datetime.datetime.now() - datetime.timedelta(days=session_days)
+        for session in UploadSession.objects.filter(date__lt=deadline):
+            logger.info('Remove idle upload session %s' % session.token)
+            session.delete()
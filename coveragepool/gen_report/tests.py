@@ -1,3 +1,1323 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+
+import os
+import sys
+import shutil
+import io
+import gzip
+import struct
+import hashlib
+import datetime
+import time
+import tempfile
+import threading
+import subprocess
+
+from . import genhtml
+from . import rpmfile
+from . import gensrc
+from . import lcov
+from .ingest import scan_chunks
+from .utils import run_cmd
+from . import report_helper
+from .report_helper import GitCoverageEnv, DistGitCoverageEnv, LibvirtCoverageHelper
+from .report_helper import VirtinstCoverageHelper
+from .cache import DirCache, GitCheckoutCache
+from .merge_plan import MergePlanner
+from . import workspace
+from . import tasks
+from .tasks import claim_merge, merge_lease, merge_coverage_report
+from upload.models import CoverageFile, CoverageReport, PendingMerge, Project
+from django.core.files.storage import default_storage
+
+try:
+    from coverage.data import CoverageData
+except ImportError:
+    CoverageData = None
 
 # Create your tests here.
+
+# Writes index.html in the output directory and a page per source file
+# in the directory genhtml would use
+FAKE_GENHTML = '''#!%s
+import os
+import sys
+
+args = sys.argv[1:]
+output_dir = args[args.index('--output-directory') + 1]
+prefix = args[args.index('--prefix') + 1] if '--prefix' in args else ''
+tracefile = [i for i in args if i.endswith('.info')][0]
+paths = [line[3:].strip() for line in open(tracefile) if line.startswith('SF:')]
+if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+with open(os.path.join(output_dir, 'index.html'), 'w') as fp:
+    fp.write('\\n'.join(sorted(paths)))
+for path in paths:
+    if prefix and path.startswith(prefix + '/'):
+        path = path[len(prefix) + 1:]
+    page = os.path.join(output_dir, path.lstrip('/') + '.gcov.html')
+    if not os.path.isdir(os.path.dirname(page)):
+        os.makedirs(os.path.dirname(page))
+    open(page, 'w').close()
+'''
+
+# coverage command of the coverage.py the tests run with
+COVERAGE_CMD = '''#!%s
+import sys
+from coverage.cmdline import main
+sys.exit(main())
+'''
+
+
+def install_script(bin_dir, name, content):
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    script = os.path.join(bin_dir, name)
+    with open(script, 'w') as fp:
+        fp.write(content % sys.executable)
+    os.chmod(script, 0o755)
+
+
+def make_git_repo(path, tags):
+    """
+    tags is a list of (tag, {file: content}), committed in order
+    """
+    os.makedirs(path)
+    git = ['git', '-C', path, '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    run_cmd(['git', 'init', '-q', path])
+    for tag, files in tags:
+        for name, content in files.items():
+            file_path = os.path.join(path, name)
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'w') as fp:
+                fp.write(content)
+        run_cmd(git + ['add', '-A'])
+        run_cmd(git + ['commit', '-q', '-m', tag])
+        run_cmd(git + ['tag', tag])
+    return path
+
+
+def write_tracefile(path, sources):
+    with open(path, 'w') as fp:
+        for source in sources:
+            fp.write('TN:\nSF:%s\nDA:1,1\nDA:2,0\nend_of_record\n' % source)
+
+
+TRACEFILE_T1 = """TN:t1
+SF:/src/a.c
+FN:3,main
+FN:10,15,helper
+FNDA:1,main
+FNDA:2,orphan
+FNF:2
+FNH:1
+BRDA:4,0,0,1
+BRDA:4,0,1,-
+BRF:2
+BRH:1
+DA:3,1,abc
+DA:4,1
+DA:10,0
+LF:3
+LH:2
+end_of_record
+"""
+
+TRACEFILE_T2 = """TN:t2
+SF:/src/a.c
+FN:3,main
+FNDA:2,main
+BRDA:4,0,1,3
+DA:4,2
+DA:5,1
+end_of_record
+TN:t2
+SF:/src/b.c
+DA:1,0
+end_of_record
+"""
+
+
+class LcovTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def dump(self, data):
+        fp = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        data.dump(fp)
+        return fp.getvalue()
+
+    def test_iter_records(self):
+        records = list(lcov.iter_records(TRACEFILE_T1.splitlines(True)))
+        self.assertEqual(len(records), 1)
+        test_name, record = records[0]
+        self.assertEqual(test_name, 't1')
+        self.assertEqual(record.path, '/src/a.c')
+        self.assertEqual(list(record.lines), [3, 4, 10])
+        self.assertEqual(list(record.hits), [1, 1, 0])
+        self.assertEqual(record.checksums, {3: 'abc'})
+        self.assertEqual(record.functions['main'].count, 1)
+        self.assertIsNone(record.functions['main'].end)
+        self.assertEqual((record.functions['helper'].line, record.functions['helper'].end),
+                         (10, 15))
+        # FNDA without FN keeps its hits
+        self.assertEqual(record.functions['orphan'].count, 2)
+        self.assertEqual(list(record.branches.records()),
+                         [(4, 0, 0, 1), (4, 0, 1, -1)])
+
+    def test_iter_records_duplicates(self):
+        lines = ['SF:/src/a.c\n', 'FNDA:1,f\n', 'FN:7,f\n', 'DA:5,1\n', 'DA:2,1\n',
+                 'DA:5,2\n', 'BRDA:2,0,0,1\n', 'BRDA:2,0,0,-\n', 'BRDA:2,0,0,2\n']
+        test_name, record = list(lcov.iter_records(lines))[0]
+        self.assertEqual(test_name, '')
+        self.assertEqual(list(record.lines), [2, 5])
+        self.assertEqual(list(record.hits), [1, 3])
+        self.assertEqual((record.functions['f'].line, record.functions['f'].count), (7, 1))
+        self.assertEqual(list(record.branches.records()), [(2, 0, 0, 3)])
+
+    def test_dump(self):
+        data = lcov.CoverageData()
+        data.load(TRACEFILE_T1.splitlines(True))
+        self.assertEqual(self.dump(data), """TN:t1
+SF:/src/a.c
+FN:0,orphan
+FN:3,main
+FN:10,15,helper
+FNDA:2,orphan
+FNDA:1,main
+FNDA:0,helper
+FNF:3
+FNH:2
+BRDA:4,0,0,1
+BRDA:4,0,1,-
+BRF:2
+BRH:1
+DA:3,1,abc
+DA:4,1
+DA:10,0
+LF:3
+LH:2
+end_of_record
+""")
+
+    def test_merge_same_test(self):
+        data = lcov.CoverageData()
+        data.load(TRACEFILE_T1.splitlines(True))
+        other = lcov.CoverageData()
+        other.load(TRACEFILE_T2.replace('TN:t2', 'TN:t1').splitlines(True))
+        data.merge(other)
+        self.assertEqual(data.test_names, set(['t1']))
+        record = data.tests['t1']['/src/a.c']
+        self.assertEqual(list(record.lines), [3, 4, 5, 10])
+        self.assertEqual(list(record.hits), [1, 3, 1, 0])
+        self.assertEqual(record.checksums, {3: 'abc'})
+        self.assertEqual(record.functions['main'].count, 3)
+        self.assertEqual(list(record.branches.records()),
+                         [(4, 0, 0, 1), (4, 0, 1, 3)])
+        self.assertEqual(data.summary(), {'LF': 5, 'LH': 3, 'FNF': 3, 'FNH': 2,
+                                          'BRF': 2, 'BRH': 2})
+
+    def test_merge_tests_kept(self):
+        data = lcov.CoverageData()
+        data.load(TRACEFILE_T1.splitlines(True))
+        data.load(TRACEFILE_T2.splitlines(True))
+        self.assertEqual(data.test_names, set(['t1', 't2']))
+        self.assertEqual(list(data.tests['t1']['/src/a.c'].hits), [1, 1, 0])
+        self.assertEqual(list(data.tests['t2']['/src/a.c'].hits), [2, 1])
+        merged = data.merged_files()
+        self.assertEqual(list(merged['/src/a.c'].lines), [3, 4, 5, 10])
+        self.assertEqual(list(merged['/src/a.c'].hits), [1, 3, 1, 0])
+        # Not changed by merged_files()
+        self.assertEqual(list(data.tests['t1']['/src/a.c'].hits), [1, 1, 0])
+        out = self.dump(data)
+        self.assertEqual([line for line in out.splitlines() if line[:3] in ('TN:', 'SF:')],
+                         ['TN:t1', 'SF:/src/a.c', 'TN:t2', 'SF:/src/a.c',
+                          'TN:t2', 'SF:/src/b.c'])
+
+    def record(self, lines, hits, branches=()):
+        record = lcov.FileCoverage('/src/a.c')
+        record.set_lines(lines, hits)
+        record.branches.set(branches)
+        return record
+
+    def test_merge_lines(self):
+        cases = [
+            # Disjoint, before and after
+            (([1, 2], [1, 0]), ([5, 9], [2, 3]), [1, 2, 5, 9], [1, 0, 2, 3]),
+            (([5, 9], [2, 3]), ([1, 2], [1, 0]), [1, 2, 5, 9], [1, 0, 2, 3]),
+            # Interleaved without common lines
+            (([1, 5], [1, 1]), ([2, 9], [2, 2]), [1, 2, 5, 9], [1, 2, 1, 2]),
+            # Overlapping
+            (([1, 2, 5], [1, 0, 4]), ([2, 5, 7], [3, 1, 0]), [1, 2, 5, 7], [1, 3, 5, 0]),
+            # Same lines
+            (([1, 2], [1, 0]), ([1, 2], [0, 6]), [1, 2], [1, 6]),
+            # Subset and empty
+            (([1, 2, 3], [1, 1, 1]), ([2], [5]), [1, 2, 3], [1, 6, 1]),
+            (([], []), ([3, 4], [1, 0]), [3, 4], [1, 0]),
+            (([3, 4], [1, 0]), ([], []), [3, 4], [1, 0]),
+        ]
+        for first, second, lines, hits in cases:
+            record = self.record(*first)
+            other = self.record(*second)
+            record.merge(other)
+            self.assertEqual((list(record.lines), list(record.hits)), (lines, hits))
+            # The other record is not changed
+            self.assertEqual(list(other.lines), second[0])
+            self.assertEqual(list(other.hits), second[1])
+
+    def test_merge_branches(self):
+        record = self.record([1], [1], [(4, 0, 1, -1), (4, 0, 0, 2)])
+        record.merge(self.record([1], [1], [(4, 0, 0, 1), (4, 0, 1, 0)]))
+        self.assertEqual(list(record.branches.records()), [(4, 0, 0, 3), (4, 0, 1, 0)])
+        record.merge(self.record([1], [1], [(2, 1, 0, -1), (4, 0, 1, 5)]))
+        self.assertEqual(list(record.branches.records()),
+                         [(2, 1, 0, -1), (4, 0, 0, 3), (4, 0, 1, 5)])
+        self.assertEqual(record.summary()['BRF'], 3)
+        self.assertEqual(record.summary()['BRH'], 2)
+
+    def test_merge_tracefiles(self):
+        t1 = self.write('t1.info', TRACEFILE_T1)
+        t2 = self.write('t2.info', TRACEFILE_T2)
+        with gzip.open(os.path.join(self.tmp_dir, 't2.info.gz'), 'wb') as fp:
+            fp.write(TRACEFILE_T2.encode('utf-8'))
+        merged = os.path.join(self.tmp_dir, 'merged.info')
+        lcov.merge_tracefiles([t1, t2], merged)
+        with open(merged) as fp:
+            expected = fp.read()
+
+        # Same output when the output is one of the inputs, and from
+        # compressed input
+        lcov.merge_tracefiles([t1, t2 + '.gz'], t1)
+        with open(t1) as fp:
+            self.assertEqual(fp.read(), expected)
+        self.assertFalse([i for i in os.listdir(self.tmp_dir) if i.endswith('.tmp')])
+
+        # Merged output reads back to the same data
+        data = lcov.load_tracefile(merged)
+        self.assertEqual(self.dump(data), expected)
+        self.assertIn('FN:10,15,helper\n', expected)
+        self.assertIn('DA:3,1,abc\n', expected)
+        self.assertIn('BRDA:4,0,1,3\n', expected)
+
+    def test_merge_tracefiles_rewriter(self):
+        t2 = self.write('t2.info', TRACEFILE_T2)
+        merged = os.path.join(self.tmp_dir, 'merged.info')
+        lcov.merge_tracefiles([t2], merged, lcov.PathRewriter([('/src/', '/build/')]))
+        self.assertEqual(lcov.source_paths(merged), set(['/build/a.c', '/build/b.c']))
+
+
+class PathRewriterTest(SimpleTestCase):
+    def test_from_string(self):
+        rewriter = lcov.PathRewriter.from_string(' /a/ : /b/ ;;  ;/c/:/d/;')
+        self.assertEqual(rewriter.rules, [('/a/', '/b/'), ('/c/', '/d/')])
+        # Only the first ':' splits, an empty target removes the prefix
+        rewriter = lcov.PathRewriter.from_string('/a/:c:/b/;/e/:')
+        self.assertEqual(rewriter.rules, [('/a/', 'c:/b/'), ('/e/', '')])
+
+    def test_from_string_empty(self):
+        for rules_str in (None, '', ' ', ';', ' : '):
+            rewriter = lcov.PathRewriter.from_string(rules_str)
+            self.assertFalse(rewriter)
+            self.assertEqual(list(rewriter.iter_lines(['SF:/a/x.c\n'])), ['SF:/a/x.c\n'])
+
+    def test_from_string_invalid(self):
+        self.assertRaises(Exception, lcov.PathRewriter.from_string, '/a/:/b/;/c/')
+
+    def test_chained(self):
+        rewriter = lcov.PathRewriter([('/a/', '/b/'), ('/b/', '/c/')])
+        self.assertEqual(rewriter.rewrite('/a/x.c'), '/c/x.c')
+        self.assertEqual(rewriter.rewrite('/b/x.c'), '/c/x.c')
+        # Rules are not applied again after the last one
+        rewriter = lcov.PathRewriter([('/b/', '/c/'), ('/a/', '/b/')])
+        self.assertEqual(rewriter.rewrite('/a/x.c'), '/b/x.c')
+
+    def test_iter_lines(self):
+        rewriter = lcov.PathRewriter([('/a/', '/b/')])
+        lines = ['TN:\n', 'SF:/a/x.c\r\n', 'DA:1,1\n', 'SF:/z/a/y.c\n']
+        self.assertEqual(list(rewriter.iter_lines(lines)),
+                         ['TN:\n', 'SF:/b/x.c\n', 'DA:1,1\n', 'SF:/z/a/y.c\n'])
+
+    def test_libvirt_default(self):
+        helper = LibvirtCoverageHelper({})
+        # Both build roots end up in the checkout, through the rule
+        # added for the prepared sources
+        rewriter = helper.path_rewriter.extend(
+            [('/mnt/coverage/BUILD/libvirt-4.5.0/', '/src/libvirt/')])
+        self.assertEqual(rewriter.rewrite('/usr/coverage/BUILD/libvirt-4.5.0/src/a.c'),
+                         '/src/libvirt/src/a.c')
+        self.assertEqual(rewriter.rewrite('/builddir/build/BUILD/libvirt-4.5.0/src/a.c'),
+                         '/src/libvirt/src/a.c')
+        self.assertEqual(rewriter.rewrite('/usr/include/stdio.h'), '/usr/include/stdio.h')
+
+    @override_settings(COVERAGE_PATH_RULES='/settings/:/s/')
+    def test_project_override(self):
+        params = tasks.load_settings(Project(name='libvirt'))
+        helper = tasks.load_helper_cls('libvirt', params)
+        self.assertEqual(helper.path_rewriter.rules, [('/settings/', '/s/')])
+
+        params = tasks.load_settings(Project(name='libvirt', path_rules='/p/:/q/'))
+        helper = tasks.load_helper_cls('libvirt', params)
+        self.assertEqual(helper.path_rewriter.rules, [('/p/', '/q/')])
+        self.assertEqual(helper.path_rewriter.rewrite('/usr/coverage/a.c'), '/usr/coverage/a.c')
+
+    @override_settings(COVERAGE_PATH_RULES='')
+    def test_helper_default(self):
+        params = tasks.load_settings(Project(name='libvirt'))
+        helper = tasks.load_helper_cls('libvirt', params)
+        self.assertEqual(helper.path_rewriter.rules,
+                         [('/usr/coverage/', '/mnt/coverage/'),
+                          ('/builddir/build/', '/mnt/coverage/')])
+
+
+class GenShardedReportTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        install_script(bin_dir, 'genhtml', FAKE_GENHTML)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.old_path
+        self.tracefile = os.path.join(self.tmp_dir, 'test.info')
+        self.output_dir = os.path.join(self.tmp_dir, 'report')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.tmp_dir, True)
+
+    def test_shards_are_stitched(self):
+        write_tracefile(self.tracefile, ['/src/proj/a/x.c', '/src/proj/b/y.c'])
+        self.assertTrue(genhtml.gen_sharded_report(self.tracefile, self.output_dir, jobs=2))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'index.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'a', 'x.c.gcov.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'b', 'y.c.gcov.html')))
+
+    def test_path_out_of_prefix(self):
+        write_tracefile(self.tracefile, ['/src/proj/a/x.c', '/src/proj/b/y.c',
+                                         '/usr/include/stdio.h'])
+        os.makedirs(self.output_dir)
+        open(os.path.join(self.output_dir, 'keep'), 'w').close()
+        self.assertFalse(genhtml.gen_sharded_report(self.tracefile, self.output_dir, jobs=2))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'keep')))
+
+
+class GitCoverageEnvTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo = make_git_repo(os.path.join(self.tmp_dir, 'repo'),
+                                  [('v1', {'src/a.c': 'a\n', 'src/b.c': 'b\n'}),
+                                   ('v2', {'src/a.c': 'a\nA\n'})])
+        self.env = GitCoverageEnv('proj', None, self.repo,
+                                  base_dir=os.path.join(self.tmp_dir, 'base'))
+
+    def tearDown(self):
+        self.env.clean_up_env()
+        shutil.rmtree(self.tmp_dir, True)
+
+    def test_list_files(self):
+        self.env.prepare_env('v1')
+        self.assertEqual(sorted(self.env.list_files('v1')), ['src/a.c', 'src/b.c'])
+
+    def test_get_git_diff(self):
+        self.env.prepare_env('v2')
+        diff_file = self.env.get_git_diff('v1', 'v2', ['src/a.c'])
+        try:
+            with open(diff_file) as fp:
+                self.assertIn('+A', fp.read())
+        finally:
+            os.unlink(diff_file)
+
+
+class DistGitCoverageEnvTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_environ = dict(os.environ)
+        # git am commits the patches
+        for role in ('AUTHOR', 'COMMITTER'):
+            os.environ['GIT_%s_NAME' % role] = 'test'
+            os.environ['GIT_%s_EMAIL' % role] = 'test@example.com'
+        self.repo = make_git_repo(os.path.join(self.tmp_dir, 'repo'),
+                                  [('v1', {'src/a.c': 'a\n'}),
+                                   ('fix1', {'src/a.c': 'a\nfix1\n'}),
+                                   ('fix2', {'src/b.c': 'b\n'})])
+        patches = {}
+        for name, start, end in (('0001-fix1.patch', 'v1', 'fix1'),
+                                 ('0002-fix2.patch', 'fix1', 'fix2')):
+            patches[name] = run_cmd(['git', '-C', self.repo, 'format-patch', '--stdout',
+                                     '%s..%s' % (start, end)]).decode('utf-8')
+        # The context is not in the tree
+        patches['0003-bad.patch'] = patches['0001-fix1.patch'].replace('\n a\n', '\n zzz\n')
+        spec = 'Name: proj\n'
+        series = []
+        for name in sorted(patches):
+            spec += 'Patch%s: %s\n' % (name[:4], name)
+            series.append(('d%d' % (len(series) + 1), {'proj.spec': spec, name: patches[name]}))
+        self.dist_repo = make_git_repo(os.path.join(self.tmp_dir, 'dist'), series)
+        self.base_dir = os.path.join(self.tmp_dir, 'base')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.envs = []
+
+    def tearDown(self):
+        for env in self.envs:
+            env.clean_up_env()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmp_dir, True)
+
+    def prepare(self, dist_git_tag, work_dir=None, cache_dir=None):
+        env = DistGitCoverageEnv(cache_dir)
+        self.envs.append(env)
+        env.prepare_env('proj', work_dir, self.repo, 'v1', self.dist_repo, dist_git_tag,
+                        base_dir=self.base_dir)
+        return env
+
+    def read(self, env, path):
+        with open(os.path.join(env.work_dir, path)) as fp:
+            return fp.read()
+
+    def git(self, *args):
+        return run_cmd(['git', '--git-dir', os.path.join(self.base_dir, 'proj', '.git')] +
+                       list(args)).decode('utf-8')
+
+    def patched_refs(self):
+        return self.git('for-each-ref', '--format=%(refname)',
+                        'refs/coveragepool/patched/').split()
+
+    def test_cache_hit(self):
+        env = self.prepare('d1', cache_dir=self.cache_dir)
+        self.assertEqual(self.read(env, 'src/a.c'), 'a\nfix1\n')
+        self.assertFalse(os.path.exists(os.path.join(env.work_dir, 'src/b.c')))
+        path = env.work_dir
+        env.clean_up_env()
+
+        env = self.prepare('d1', cache_dir=self.cache_dir)
+        self.assertEqual(env.work_dir, path)
+        self.assertEqual(len(self.patched_refs()), 1)
+
+        # Starts from the commit of the first patch, only the second is applied
+        env2 = self.prepare('d2', cache_dir=self.cache_dir)
+        self.assertNotEqual(env2.work_dir, path)
+        self.assertEqual(self.read(env2, 'src/a.c'), 'a\nfix1\n')
+        self.assertEqual(self.read(env2, 'src/b.c'), 'b\n')
+        self.assertEqual(len(self.patched_refs()), 2)
+        self.assertEqual(run_cmd(['git', '-C', env2.work_dir, 'rev-parse', 'HEAD~1']),
+                         run_cmd(['git', '-C', path, 'rev-parse', 'HEAD']))
+
+    def test_remove(self):
+        env = self.prepare('d2', cache_dir=self.cache_dir)
+        path = env.work_dir.rstrip('/')
+        env.clean_up_env()
+        key = [k for k in env.cache._load()][0]
+        env.cache.remove(key, path)
+        self.assertFalse(os.path.exists(path))
+        self.assertNotIn(path, self.git('worktree', 'list'))
+        self.assertEqual(self.patched_refs(), [])
+
+    def test_failed_am(self):
+        self.assertRaises(Exception, self.prepare, 'd3', cache_dir=self.cache_dir)
+        cache_root = os.path.join(self.cache_dir, 'patched', 'proj')
+        self.assertEqual([i for i in os.listdir(cache_root) if not i.endswith('.lock')], [])
+        self.assertEqual(self.git('worktree', 'list').count('\n'), 1)
+        # The applied patches are kept for the next series
+        self.assertEqual(len(self.patched_refs()), 2)
+
+    def test_work_dir_of_caller(self):
+        work_dir = os.path.join(self.tmp_dir, 'work')
+        env = self.prepare('d2', work_dir=work_dir)
+        self.assertEqual(self.read(env, 'src/b.c'), 'b\n')
+        env.clean_up_env()
+        self.assertTrue(os.path.exists(os.path.join(work_dir, 'src/b.c')))
+
+    def test_private_work_dir(self):
+        env = self.prepare('d1')
+        work_dir = env.work_dir
+        self.assertEqual(self.read(env, 'src/a.c'), 'a\nfix1\n')
+        env.clean_up_env()
+        self.assertFalse(os.path.exists(work_dir))
+
+
+class FakeMergeHelper(object):
+    """
+    Merging concatenates the tracefiles, converting copies them
+    """
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.merges = []
+        self.converts = []
+
+    def merge_tracefile(self, tracefiles, output):
+        self.merges.append(list(tracefiles))
+        with open(output, 'w') as fp:
+            for tracefile in tracefiles:
+                with open(tracefile) as src:
+                    fp.write(src.read())
+
+    def convert_tracefiles(self, src_version, tgt_version, tracefiles):
+        self.converts.append((src_version, tgt_version))
+        ret = []
+        for tracefile in tracefiles:
+            output = tempfile.NamedTemporaryFile(dir=self.tmp_dir, delete=False).name
+            shutil.copy(tracefile, output)
+            ret.append(output)
+        return ret
+
+
+class MergePlannerTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.tracefiles = []
+        for i in range(3):
+            path = os.path.join(self.tmp_dir, 'upload-%d.info' % i)
+            write_tracefile(path, ['/src/proj/f%d.c' % i])
+            self.tracefiles.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def plan(self, params=None):
+        helper = FakeMergeHelper(self.tmp_dir)
+        planner = MergePlanner(helper, 'proj-2.0-1.el7.x86_64', self.cache_dir, params)
+        planner.add_tracefile('proj-1.0-1.el7.x86_64', self.tracefiles[0], 'h0')
+        planner.add_tracefile('proj-1.0-1.el7.noarch', self.tracefiles[1], 'h1')
+        planner.add_tracefile('proj-2.0-1.el7.noarch', self.tracefiles[2], 'h2')
+        try:
+            return helper, planner.prepare()
+        finally:
+            planner.clean_up()
+
+    def test_group_by_version_prefix(self):
+        helper, ret = self.plan()
+        self.assertEqual(len(helper.merges), 1)
+        self.assertEqual(helper.converts, [('proj-1.0-1.el7.noarch', 'proj-2.0-1.el7.x86_64')])
+        self.assertEqual(len(ret), 2)
+        self.assertIn(self.tracefiles[2], ret)
+
+    def test_cache_reused(self):
+        self.plan({'path_rules': 'a:b'})
+        helper, ret = self.plan({'path_rules': 'a:b'})
+        self.assertEqual(helper.merges, [])
+        self.assertEqual(helper.converts, [])
+        self.assertEqual(len(ret), 2)
+
+    def test_cache_keyed_by_settings(self):
+        self.plan({'path_rules': 'a:b'})
+        helper, ret = self.plan({'path_rules': 'a:c'})
+        self.assertEqual(len(helper.merges), 1)
+        self.assertEqual(len(helper.converts), 1)
+
+
+class ConvertTestHelper(LibvirtCoverageHelper):
+    def _extra_prepare(self, work_dir):
+        pass
+
+
+class GroupedConvertTest(SimpleTestCase):
+    """
+    The second target version has two lines more at the top of a.c
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        body = 'int a;\nint b;\nint c;\n'
+        self.repo = make_git_repo(os.path.join(self.tmp_dir, 'repo'), [
+            ('proj-1.0-1.el7', {'src/a.c': body, 'virtinst/a.py': body}),
+            ('proj-1.1-1.el7', {'src/a.c': body + 'int d;\n'}),
+            ('proj-2.0-1.el7', {'src/a.c': 'int x;\nint y;\n' + body + 'int d;\n',
+                                'virtinst/a.py': 'x = 0\ny = 0\n' + body})])
+        self.params = {'tag_fmt': '{0}-{1}-{2}', 'git_repo': self.repo,
+                       'merge_backend': 'native', 'convert_backend': 'native',
+                       'cache_dir': os.path.join(self.tmp_dir, 'cache')}
+        self.diffs = []
+        self.get_git_diff = GitCoverageEnv.get_git_diff
+        def _get_git_diff(env, src_tag, tgt_tag, paths=None):
+            self.diffs.append((src_tag, tgt_tag))
+            return self.get_git_diff(env, src_tag, tgt_tag, paths)
+        GitCoverageEnv.get_git_diff = _get_git_diff
+
+    def tearDown(self):
+        GitCoverageEnv.get_git_diff = self.get_git_diff
+        shutil.rmtree(self.tmp_dir, True)
+
+    def helper(self, cls):
+        helper = cls(self.params)
+        helper.git_base_dir = os.path.join(self.tmp_dir, 'base')
+        return helper
+
+    def tracefile(self, name, version, lines):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as fp:
+            fp.write('TN:\nSF:/mnt/coverage/BUILD/proj-%s/src/a.c\n' % version)
+            for line in lines:
+                fp.write('DA:%d,1\n' % line)
+            fp.write('end_of_record\n')
+        return path
+
+    def lines(self, tracefile):
+        data = lcov.load_tracefile(tracefile)
+        return list(list(data.tests.values())[0].values())[0].lines
+
+    def test_single_diff(self):
+        helper = self.helper(ConvertTestHelper)
+        empty = os.path.join(self.tmp_dir, 'empty.info')
+        open(empty, 'w').close()
+        tracefiles = [self.tracefile('t1.info', '1.0', [1, 3]), empty,
+                      self.tracefile('t2.info', '1.0', [2])]
+        ret = helper.convert_tracefiles('proj-1.0-1.el7.x86_64', 'proj-2.0-1.el7.x86_64',
+                                        tracefiles)
+        try:
+            self.assertEqual(self.diffs, [('proj-1.0-1.el7', 'proj-2.0-1.el7')])
+            self.assertIsNone(ret[1])
+            self.assertEqual(list(self.lines(ret[0])), [3, 5])
+            self.assertEqual(list(self.lines(ret[2])), [4])
+        finally:
+            for path in ret:
+                if path:
+                    os.unlink(path)
+
+    def test_merge_planner(self):
+        helper = self.helper(ConvertTestHelper)
+        planner = MergePlanner(helper, 'proj-2.0-1.el7.x86_64')
+        planner.add_tracefile('proj-1.0-1.el7.x86_64', self.tracefile('t1.info', '1.0', [1]))
+        planner.add_tracefile('proj-1.0-1.el7.noarch', self.tracefile('t2.info', '1.0', [3]))
+        planner.add_tracefile('proj-1.1-1.el7.x86_64', self.tracefile('t3.info', '1.1', [4]))
+        planner.add_tracefile('proj-2.0-1.el7.x86_64', self.tracefile('t4.info', '2.0', [1]))
+        merged = os.path.join(self.tmp_dir, 'merged.info')
+        try:
+            helper.merge_tracefile(planner.prepare(), merged)
+        finally:
+            planner.clean_up()
+        # One checkout and diff per source version
+        self.assertEqual(sorted(self.diffs), [('proj-1.0-1.el7', 'proj-2.0-1.el7'),
+                                              ('proj-1.1-1.el7', 'proj-2.0-1.el7')])
+        data = lcov.load_tracefile(merged)
+        self.assertEqual(sorted((path, list(record.lines))
+                                for path, record in data.merged_files().items()),
+                         [('/mnt/coverage/BUILD/proj-1.0/src/a.c', [3, 5]),
+                          ('/mnt/coverage/BUILD/proj-1.1/src/a.c', [6]),
+                          ('/mnt/coverage/BUILD/proj-2.0/src/a.c', [1])])
+
+    def test_python(self):
+        if CoverageData is None:
+            self.skipTest('No coverage.py')
+        source = '/usr/share/virt-manager/virtinst/a.py'
+        lines_tf = os.path.join(self.tmp_dir, 'lines.coverage')
+        data = CoverageData()
+        data.add_lines({source: [1, 3], '/usr/lib/other.py': [1]})
+        data.write_file(lines_tf)
+        arcs_tf = os.path.join(self.tmp_dir, 'arcs.coverage')
+        data = CoverageData()
+        data.add_arcs({source: [(-1, 1), (1, 3), (3, -1)]})
+        data.write_file(arcs_tf)
+
+        helper = self.helper(VirtinstCoverageHelper)
+        ret = helper.convert_tracefiles('proj-1.0-1.el7.noarch', 'proj-2.0-1.el7.noarch',
+                                        [lines_tf, arcs_tf])
+        try:
+            self.assertEqual(self.diffs, [('proj-1.0-1.el7', 'proj-2.0-1.el7')])
+            data = CoverageData()
+            data.read_file(ret[0])
+            self.assertEqual(sorted(data.lines(source)), [3, 5])
+            self.assertEqual(data.lines('/usr/lib/other.py'), [1])
+            data = CoverageData()
+            data.read_file(ret[1])
+            self.assertEqual(sorted(data.arcs(source)), [(-3, 3), (3, 5), (5, -3)])
+        finally:
+            for path in ret:
+                os.unlink(path)
+
+
+class CountingCache(DirCache):
+    def __init__(self, root, size_limit=0):
+        DirCache.__init__(self, root, size_limit)
+        self.populated = []
+
+    def populate(self, key, path):
+        self.populated.append(key)
+        os.makedirs(path)
+        with open(os.path.join(path, 'data'), 'w') as fp:
+            fp.write(key * 100)
+
+
+class DirCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def test_populate_once(self):
+        cache = CountingCache(self.tmp_dir)
+        with cache.lease('a') as path:
+            self.assertTrue(os.path.exists(os.path.join(path, 'data')))
+        with cache.lease('a') as path2:
+            self.assertEqual(path, path2)
+        self.assertEqual(cache.populated, ['a'])
+
+    def test_evict_unleased_lru(self):
+        # Two entries fit
+        cache = CountingCache(self.tmp_dir, 250)
+        leased = cache.acquire('a')
+        for key in ('b', 'c'):
+            with cache.lease(key):
+                pass
+        # b is the least recently used entry without lease
+        self.assertTrue(os.path.exists(leased))
+        self.assertFalse(os.path.exists(cache.entry_path('b')))
+        self.assertTrue(os.path.exists(cache.entry_path('c')))
+        cache.release('a')
+
+    def test_failed_populate(self):
+        class BrokenCache(DirCache):
+            def populate(self, key, path):
+                os.makedirs(path)
+                raise Exception('broken')
+
+        cache = BrokenCache(self.tmp_dir)
+        self.assertRaises(Exception, cache.acquire, 'a')
+        self.assertFalse(os.path.exists(cache.entry_path('a')))
+
+
+class GitCheckoutCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo = make_git_repo(os.path.join(self.tmp_dir, 'repo'),
+                                  [('v1', {'a.c': 'v1\n'}), ('v2', {'a.c': 'v2\n'})])
+        self.cache = GitCheckoutCache(os.path.join(self.tmp_dir, 'cache'), self.repo,
+                                      os.path.join(self.tmp_dir, 'base'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def read(self, path):
+        with open(os.path.join(path, 'a.c')) as fp:
+            return fp.read()
+
+    def test_worktree_per_tag(self):
+        with self.cache.lease('v1') as path1:
+            with self.cache.lease('v2') as path2:
+                self.assertEqual(self.read(path1), 'v1\n')
+                self.assertEqual(self.read(path2), 'v2\n')
+
+    def test_new_tag_fetched(self):
+        with self.cache.lease('v1'):
+            pass
+        git = ['git', '-C', self.repo, '-c', 'user.name=test',
+               '-c', 'user.email=test@example.com']
+        with open(os.path.join(self.repo, 'a.c'), 'w') as fp:
+            fp.write('v3\n')
+        run_cmd(git + ['commit', '-q', '-a', '-m', 'v3'])
+        run_cmd(git + ['tag', 'v3'])
+        with self.cache.lease('v3') as path:
+            self.assertEqual(self.read(path), 'v3\n')
+
+    def test_remove_prunes_worktree(self):
+        with self.cache.lease('v1') as path:
+            pass
+        self.cache.remove('v1', path)
+        out = run_cmd(['git', '--git-dir', self.cache.git_dir, 'worktree', 'list'])
+        self.assertNotIn(path.encode('utf-8'), out)
+
+    def test_prepare_once(self):
+        calls = []
+        def prepare(path):
+            calls.append(path)
+            with open(os.path.join(path, 'gen.h'), 'w') as fp:
+                fp.write('gen\n')
+        self.cache.prepare = prepare
+        with self.cache.lease('v1') as path1:
+            with self.cache.lease('v1') as path2:
+                self.assertEqual(path1, path2)
+                self.assertTrue(os.path.exists(os.path.join(path2, 'gen.h')))
+        self.assertEqual(calls, [path1])
+
+    def test_prepare_failed(self):
+        def prepare(path):
+            raise ValueError('gensrc')
+        self.cache.prepare = prepare
+        self.assertRaises(ValueError, self.cache.acquire, 'v1')
+        self.assertFalse(os.path.exists(self.cache.entry_path('v1')))
+        out = run_cmd(['git', '--git-dir', self.cache.git_dir, 'worktree', 'list'])
+        self.assertNotIn(self.cache.entry_path('v1').encode('utf-8'), out)
+
+
+def sh_step(script, inputs, outputs):
+    return gensrc.Step(['sh', '-c', script], inputs, outputs)
+
+
+class GenSrcTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.runs = os.path.join(self.tmp_dir, 'runs')
+        os.makedirs(self.src_dir)
+        with open(os.path.join(self.src_dir, 'a.x'), 'w') as fp:
+            fp.write('a\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def read(self, path, src_dir=None):
+        with open(os.path.join(src_dir or self.src_dir, path)) as fp:
+            return fp.read()
+
+    def counted_step(self):
+        # Every run is logged outside the source dir
+        return sh_step('echo run >> %s; tr a b < {dir}/a.x > {dir}/a.h' % self.runs,
+                       ['a.x'], ['a.h'])
+
+    def test_levels(self):
+        gen_h = sh_step('', ['a.x'], ['a.h'])
+        gen_c = sh_step('', ['a.h'], ['a.c'])
+        other = sh_step('', ['b.x'], ['b.h'])
+        both = sh_step('', ['a.c', 'b.h'], ['all.c'])
+        self.assertEqual(gensrc._levels([both, gen_c, other, gen_h]),
+                         [[other, gen_h], [gen_c], [both]])
+
+    def test_levels_cycle(self):
+        steps = [sh_step('', ['a.h'], ['b.h']), sh_step('', ['b.h'], ['a.h'])]
+        self.assertRaises(Exception, gensrc._levels, steps)
+
+    def test_dependent_steps(self):
+        steps = [sh_step('cat {dir}/a.h {dir}/a.h > {dir}/a.c', ['a.h'], ['a.c']),
+                 gensrc.Step(['cat', '{dir}/a.x'], ['a.x'], stdout='a.h')]
+        gensrc.generate(steps, self.src_dir, jobs=4)
+        self.assertEqual(self.read('a.h'), 'a\n')
+        self.assertEqual(self.read('a.c'), 'a\na\n')
+
+    def test_level_concurrent(self):
+        # Each step waits for the other one to start
+        wait = ('touch {dir}/%s.started; i=0; '
+                'while [ ! -e {dir}/%s.started ] && [ $i -lt 100 ]; do sleep 0.1; i=$((i+1)); done; '
+                'test -e {dir}/%s.started && touch {dir}/%s.out')
+        steps = [sh_step(wait % ('a', 'b', 'b', 'a'), ['a.x'], ['a.out']),
+                 sh_step(wait % ('b', 'a', 'a', 'b'), ['a.x'], ['b.out'])]
+        gensrc.generate(steps, self.src_dir, jobs=2)
+        self.assertTrue(os.path.exists(os.path.join(self.src_dir, 'a.out')))
+        self.assertTrue(os.path.exists(os.path.join(self.src_dir, 'b.out')))
+
+    def test_cached_outputs(self):
+        gensrc.generate([self.counted_step()], self.src_dir, self.cache_dir)
+        other_dir = os.path.join(self.tmp_dir, 'other')
+        os.makedirs(other_dir)
+        shutil.copy(os.path.join(self.src_dir, 'a.x'), other_dir)
+        gensrc.generate([self.counted_step()], other_dir, self.cache_dir)
+        self.assertEqual(self.read('a.h', other_dir), 'b\n')
+        self.assertEqual(self.read(self.runs), 'run\n')
+
+    def test_cache_key(self):
+        step = self.counted_step()
+        key = step.key(self.src_dir)
+        gensrc.generate([step], self.src_dir, self.cache_dir)
+        with open(os.path.join(self.src_dir, 'a.x'), 'w') as fp:
+            fp.write('aa\n')
+        self.assertNotEqual(step.key(self.src_dir), key)
+        gensrc.generate([step], self.src_dir, self.cache_dir)
+        self.assertEqual(self.read('a.h'), 'bb\n')
+        self.assertEqual(self.read(self.runs), 'run\nrun\n')
+        # Another command is another entry
+        self.assertNotEqual(sh_step('true', ['a.x'], ['a.h']).key(self.src_dir),
+                            step.key(self.src_dir))
+
+    def test_prune_cache(self):
+        gensrc.generate([self.counted_step()], self.src_dir, self.cache_dir)
+        entry = os.path.join(self.cache_dir, 'gensrc',
+                             self.counted_step().key(self.src_dir))
+        gensrc.prune_cache(self.cache_dir, 1)
+        self.assertTrue(os.path.isdir(entry))
+        old = os.path.getmtime(entry) - 2 * 24 * 3600
+        os.utime(entry, (old, old))
+        gensrc.prune_cache(self.cache_dir, 1)
+        self.assertFalse(os.path.exists(entry))
+
+
+class FakeRpmEnv(object):
+    fail = False
+    instances = []
+
+    def __init__(self, cache_dir=None, cache_size=0):
+        self.cleaned = False
+        FakeRpmEnv.instances.append(self)
+
+    def prepare_env(self, packages, path_filters=None):
+        if self.fail:
+            raise Exception('No rpm')
+        return '/tmp/rpm/'
+
+    def clean_up_env(self):
+        self.cleaned = True
+
+
+class TestLibvirtHelper(LibvirtCoverageHelper):
+    def _extra_prepare(self, work_dir):
+        pass
+
+
+class LibvirtPrepareEnvTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_env = report_helper.Rpm2cpioCoverageEnv
+        report_helper.Rpm2cpioCoverageEnv = FakeRpmEnv
+        FakeRpmEnv.instances = []
+        FakeRpmEnv.fail = False
+        repo = make_git_repo(os.path.join(self.tmp_dir, 'repo'),
+                             [('libvirt-4.5.0-10.el7', {'a.c': 'a\n'})])
+        self.helper = TestLibvirtHelper({'tag_fmt': '{0}-{1}-{2}', 'git_repo': repo,
+                                         'cache_dir': os.path.join(self.tmp_dir, 'cache')})
+
+    def tearDown(self):
+        report_helper.Rpm2cpioCoverageEnv = self.old_env
+        shutil.rmtree(self.tmp_dir, True)
+
+    def test_error_in_body(self):
+        def _run():
+            with self.helper.prepare_env('libvirt-4.5.0-10.el7.x86_64'):
+                raise ValueError('body')
+        self.assertRaises(ValueError, _run)
+        self.assertEqual(len(FakeRpmEnv.instances), 1)
+        self.assertTrue(FakeRpmEnv.instances[0].cleaned)
+
+    def test_git_fallback(self):
+        FakeRpmEnv.fail = True
+        with self.helper.prepare_env('libvirt-4.5.0-10.el7.x86_64'):
+            self.assertTrue(FakeRpmEnv.instances[0].cleaned)
+            self.assertTrue(os.path.exists(os.path.join(self.helper.new_src_dir, 'a.c')))
+            self.assertEqual(self.helper.old_src_dir, '/mnt/coverage/BUILD/libvirt-4.5.0/')
+        self.assertIsNone(self.helper.env)
+
+    def test_gensrc_in_cache(self):
+        FakeRpmEnv.fail = True
+        calls = []
+        self.helper._extra_prepare = calls.append
+        for i in range(2):
+            with self.helper.prepare_env('libvirt-4.5.0-10.el7.x86_64'):
+                src_dir = self.helper.new_src_dir
+        # Only the new worktree is prepared, the second lease reuses it
+        self.assertEqual(calls, [src_dir.rstrip('/')])
+
+
+def cpio_entry(name, data=b'', mode=0o100644):
+    name = name.encode('utf-8') + b'\x00'
+    fields = [1, mode, 0, 0, 1, 0, len(data), 0, 0, 0, 0, len(name), 0]
+    header = b'070701' + b''.join([('%08x' % f).encode('ascii') for f in fields])
+    return (header + name + b'\x00' * ((4 - (110 + len(name)) % 4) % 4) +
+            data + b'\x00' * ((4 - len(data) % 4) % 4))
+
+
+def make_rpm(path, files, compressor='xz'):
+    """
+    Write a minimal rpm package with files, a dict of name -> bytes
+    """
+    payload = b''.join([cpio_entry('./' + name, data) for name, data in files.items()])
+    payload += cpio_entry('TRAILER!!!')
+    proc = subprocess.Popen([compressor, '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    payload = proc.communicate(payload)[0]
+
+    store = compressor.encode('ascii') + b'\x00'
+    magic = rpmfile._HEADER_MAGIC + b'\x00' * 4
+    signature = magic + struct.pack('>II', 0, 0)
+    header = (magic + struct.pack('>II', 1, len(store)) +
+              struct.pack('>iiii', rpmfile._TAG_PAYLOADCOMPRESSOR, rpmfile._TYPE_STRING, 0, 1) +
+              store)
+    lead = rpmfile._LEAD_MAGIC + b'\x00' * 92
+    with open(path, 'wb') as fp:
+        fp.write(lead + signature + header + payload)
+
+
+class ExtractRpmTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpm = os.path.join(self.tmp_dir, 'test.rpm')
+        self.work_dir = os.path.join(self.tmp_dir, 'work')
+        os.mkdir(self.work_dir)
+        # Bigger than a chunk so the payload is streamed
+        self.files = {'usr/share/a.gcno': os.urandom(200 * 1024),
+                      'usr/bin/b': b'b'}
+        make_rpm(self.rpm, self.files)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def extract(self):
+        with open(self.rpm, 'rb') as fp:
+            return rpmfile.extract_rpm_stream(fp, self.work_dir, ['usr/share/'])
+
+    def check(self):
+        self.assertEqual(self.extract(), 1)
+        with open(os.path.join(self.work_dir, 'usr/share/a.gcno'), 'rb') as fp:
+            self.assertEqual(fp.read(), self.files['usr/share/a.gcno'])
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'usr/bin/b')))
+
+    def test_xz(self):
+        if rpmfile.lzma is None:
+            self.skipTest('No lzma module')
+        self.check()
+
+    def test_xz_command(self):
+        old_lzma = rpmfile.lzma
+        rpmfile.lzma = None
+        try:
+            self.check()
+        finally:
+            rpmfile.lzma = old_lzma
+
+
+class WorkspaceTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.settings = override_settings(COVERAGE_WORK_DIR=self.tmp_dir)
+        self.settings.enable()
+
+    def tearDown(self):
+        for task_id in list(workspace._locks):
+            workspace.release_task(task_id)
+        self.settings.disable()
+        shutil.rmtree(self.tmp_dir, True)
+
+    def test_task_dirs(self):
+        dir1 = workspace.task_dir('task1')
+        dir2 = workspace.task_dir('task2')
+        self.assertNotEqual(dir1, dir2)
+        self.assertEqual(workspace.task_output_dir('task1'), os.path.join(dir1, 'report'))
+        self.assertEqual(workspace.task_output_dir('task1', '/out'), '/out')
+        open(os.path.join(dir2, 'merge.tracefile'), 'w').close()
+        workspace.release_task('task1')
+        self.assertFalse(os.path.exists(dir1))
+        self.assertTrue(os.path.exists(os.path.join(dir2, 'merge.tracefile')))
+
+    def test_lock(self):
+        self.assertTrue(workspace.lock_resource('task1', 'res'))
+        self.assertFalse(workspace.lock_resource('task2', 'res', blocking=False))
+        self.assertTrue(workspace.lock_resource('task2', 'other', blocking=False))
+        workspace.release_task('task1')
+        self.assertTrue(workspace.lock_resource('task2', 'res', blocking=False))
+
+    def test_lock_released_on_failure(self):
+        report = CoverageReport.objects.create(name='report', version='1.0')
+        # Fails with the report lock held, there is no project
+        result = tasks.merge_convert_coverage_report.apply(([], None, report.id))
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertEqual(workspace._locks, {})
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'tasks')), [])
+        self.assertTrue(workspace.lock_resource('task1', 'report-%d' % report.id,
+                                                blocking=False))
+
+    def test_dropped_while_waiting(self):
+        workspace.lock_resource('task1', 'res')
+        locked = threading.Event()
+        def _wait():
+            workspace.lock_resource('task2', 'res')
+            locked.set()
+        waiter = threading.Thread(target=_wait)
+        waiter.start()
+        # task2 waits on the file which task1 removes
+        time.sleep(0.2)
+        self.assertFalse(locked.is_set())
+        workspace.drop_lock('res')
+        workspace.release_task('task1')
+        waiter.join(10)
+        self.assertTrue(locked.is_set())
+        # task2 holds the file in place, not the removed one
+        self.assertFalse(workspace.lock_resource('task3', 'res', blocking=False))
+
+
+class MergeTestBase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.settings = override_settings(COVERAGE_WORK_DIR=self.tmp_dir)
+        self.settings.enable()
+        self.report = CoverageReport.objects.create(name='report', version='1.0')
+        self.files = [CoverageFile.objects.create(name='f%d' % i, user_name='test',
+                                                  version='1.0')
+                      for i in range(3)]
+
+    def tearDown(self):
+        for task_id in list(workspace._locks):
+            workspace.release_task(task_id)
+        self.settings.disable()
+        shutil.rmtree(self.tmp_dir, True)
+
+    def queue(self, files, running_task=None, **kwargs):
+        pending = PendingMerge.objects.create(report=self.report, running=bool(running_task),
+                                              task_id=running_task, **kwargs)
+        pending.coverage_files.add(*files)
+        return pending
+
+
+class ClaimMergeTest(MergeTestBase):
+    def test_claim(self):
+        self.queue(self.files[:2])
+        self.assertEqual(sorted(claim_merge(self.report.id, 'task1')),
+                         [i.id for i in self.files[:2]])
+        pending = PendingMerge.objects.get()
+        self.assertTrue(pending.running)
+        self.assertEqual(pending.task_id, 'task1')
+
+    def test_running_merge_alive(self):
+        self.queue(self.files[:1], running_task='task0')
+        self.queue(self.files[1:])
+        workspace.lock_resource('task0', merge_lease('task0'))
+        self.assertEqual(claim_merge(self.report.id, 'task1'), [])
+        self.assertEqual(PendingMerge.objects.filter(running=True).get().task_id, 'task0')
+        self.assertFalse(PendingMerge.objects.get(running=False).task_id)
+
+    def test_running_merge_dead(self):
+        self.queue(self.files[:1], running_task='task0')
+        self.queue(self.files[1:])
+        self.assertEqual(sorted(claim_merge(self.report.id, 'task1')),
+                         [i.id for i in self.files])
+        self.assertEqual(PendingMerge.objects.get().task_id, 'task1')
+
+    def test_merged_files_skipped(self):
+        self.queue(self.files, running_task='task0')
+        self.report.coverage_files.add(self.files[0])
+        self.assertEqual(sorted(claim_merge(self.report.id, 'task1')),
+                         [i.id for i in self.files[1:]])
+
+    def test_reduced_merge_alive(self):
+        self.queue(self.files[:1], running_task='final', reduced=True)
+        self.queue(self.files[1:])
+        self.assertEqual(claim_merge(self.report.id, 'task1'), [])
+
+        old = datetime.datetime.now() - datetime.timedelta(hours=7)
+        PendingMerge.objects.filter(task_id='final').update(date=old)
+        self.assertEqual(len(claim_merge(self.report.id, 'task2')), 3)
+
+
+class ReduceHandOverTest(MergeTestBase):
+    def setUp(self):
+        super(ReduceHandOverTest, self).setUp()
+        self.queued = []
+        merge_coverage_report.delay = lambda *args: self.queued.append(args)
+
+    def tearDown(self):
+        del merge_coverage_report.delay
+        super(ReduceHandOverTest, self).tearDown()
+
+    def after_return(self, task_id):
+        merge_coverage_report.after_return('SUCCESS', [], task_id,
+                                           (None, None, self.report.id), {}, None)
+
+    def test_hand_over(self):
+        self.queue(self.files[:1], running_task='root')
+        # What the first task does when it starts the reduce
+        PendingMerge.objects.filter(task_id='root').update(task_id='final', reduced=True)
+        self.after_return('root')
+        self.assertTrue(PendingMerge.objects.filter(task_id='final').exists())
+
+        self.queue(self.files[1:])
+        self.assertEqual(claim_merge(self.report.id, 'task1'), [])
+        self.after_return('final')
+        self.assertFalse(PendingMerge.objects.filter(running=True).exists())
+        self.assertEqual(self.queued, [(None, None, self.report.id)])
+
+    def test_requeue_stale(self):
+        self.queue(self.files[1:], date=datetime.datetime.now() - datetime.timedelta(hours=7))
+        tasks.requeue_merges()
+        self.assertEqual(self.queued, [(None, None, self.report.id)])
+
+
+class DuplicateMergeTest(MergeTestBase):
+    def test_only_merged_content(self):
+        merged, dup, empty = self.files
+        CoverageFile.objects.filter(id__in=[merged.id, dup.id]).update(
+            content_hash='h1', source_count=0)
+        CoverageFile.objects.filter(id=dup.id).update(source_count=1)
+        CoverageFile.objects.filter(id=empty.id).update(source_count=0)
+        self.report.coverage_files.add(merged)
+        self.queue([dup, empty])
+
+        result = merge_coverage_report.apply(args=(None, None, self.report.id))
+        self.assertEqual(result.state, 'SUCCESS')
+        self.assertEqual(sorted(result.result), sorted([dup.id, empty.id]))
+        self.assertEqual(set(self.report.coverage_files.values_list('id', flat=True)),
+                         set(i.id for i in self.files))
+        self.assertFalse(PendingMerge.objects.exists())
+        # Not requested again
+        tasks.request_merge(self.report.id, [dup.id, empty.id])
+        self.assertFalse(PendingMerge.objects.exists())
+
+
+class ScanChunksTest(SimpleTestCase):
+    tracefile = b'TN:\nSF:/src/a.c\nDA:1,1\nDA:2,0\nend_of_record\nSF:/src/b.c\nDA:1,3\n'
+
+    def gzip(self, data):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+            fp.write(data)
+        return buf.getvalue()
+
+    def chunks(self, data, size=7):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def check(self, metadata):
+        self.assertEqual(metadata['file_format'], 'lcov')
+        self.assertEqual(metadata['source_count'], 2)
+        self.assertEqual(metadata['lines_found'], 3)
+        self.assertEqual(metadata['lines_hit'], 2)
+        self.assertEqual(metadata['content_hash'], hashlib.sha256(self.tracefile).hexdigest())
+
+    def test_plain(self):
+        self.check(scan_chunks(self.chunks(self.tracefile)))
+
+    def test_gzip(self):
+        self.check(scan_chunks(self.chunks(self.gzip(self.tracefile))))
+
+    def test_gzip_members(self):
+        data = self.gzip(self.tracefile[:30]) + self.gzip(self.tracefile[30:])
+        self.check(scan_chunks(self.chunks(data, 1)))
+
+    def test_xz(self):
+        if rpmfile.lzma is None:
+            self.skipTest('No lzma module')
+        self.check(scan_chunks(self.chunks(rpmfile.lzma.compress(self.tracefile))))
+
+    def test_short(self):
+        metadata = scan_chunks([b'SF:a'])
+        self.assertEqual(metadata['source_count'], 1)
+
+
+class MergePartialTest(TestCase):
+    def setUp(self):
+        if CoverageData is None:
+            self.skipTest('No coverage.py')
+        self.tmp_dir = tempfile.mkdtemp()
+        install_script(os.path.join(self.tmp_dir, 'bin'), 'coverage', COVERAGE_CMD)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = os.path.join(self.tmp_dir, 'bin') + os.pathsep + self.old_path
+        self.settings = override_settings(COVERAGE_WORK_DIR=self.tmp_dir)
+        self.settings.enable()
+        self.location = default_storage.location
+        default_storage.location = os.path.join(self.tmp_dir, 'media')
+        self.project = Project.objects.create(name='virtinst', pkg_name='virt-install')
+
+    def tearDown(self):
+        default_storage.location = self.location
+        self.settings.disable()
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.tmp_dir, True)
+
+    def data_file(self, name, lines):
+        data = CoverageData()
+        data.add_lines(lines)
+        path = os.path.join(self.tmp_dir, name)
+        data.write_file(path)
+        return path
+
+    def test_python_helper(self):
+        tracefiles = [self.data_file('a', {'/usr/a.py': [1, 2]}),
+                      self.data_file('b', {'/usr/a.py': [3], '/usr/b.py': [1]})]
+        result = tasks.merge_partial.apply(args=(self.project.id, tracefiles, [], 'root'))
+        self.assertEqual(result.state, 'SUCCESS')
+        merged = CoverageData()
+        merged.read_file(default_storage.path(result.result))
+        self.assertEqual(sorted(merged.measured_files()), ['/usr/a.py', '/usr/b.py'])
+        self.assertEqual(sorted(merged.lines('/usr/a.py')), [1, 2, 3])
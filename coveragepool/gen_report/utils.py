@@ -1,13 +1,85 @@
+import os
 import subprocess
 import re
 import platform
+import tempfile
 
-def run_cmd(cmd):
+def run_cmd(cmd, env=None):
+    """
+    cmd can be a string or an argument list, env is added to the
+    environment of the current process
+    """
+    if isinstance(cmd, (list, tuple)):
+        args = list(cmd)
+    else:
+        args = cmd.split()
+    if env:
+        env = dict(os.environ, **env)
     try:
-        return subprocess.check_output(cmd.split())
+        return subprocess.check_output(args, env=env)
     except subprocess.CalledProcessError as e:
         raise Exception('Fail to run cmd %s, reason: %s' % (e.cmd, e.output))
 
+def run_cmd_input(cmd, lines):
+    """
+    Run cmd and stream lines to its stdin, cmd can be a string or an
+    argument list
+    """
+    if isinstance(cmd, (list, tuple)):
+        args = list(cmd)
+    else:
+        args = cmd.split()
+
+    # Use a file for output so a blocked stdout never stalls the writer
+    out = tempfile.TemporaryFile()
+    try:
+        p = subprocess.Popen(args, stdin=subprocess.PIPE,
+                             stdout=out, stderr=subprocess.STDOUT)
+        try:
+            for line in lines:
+                if not isinstance(line, bytes):
+                    line = line.encode('utf-8')
+                p.stdin.write(line)
+        except (IOError, OSError):
+            # cmd exited early, its output tells why
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except (IOError, OSError):
+                pass
+        ret = p.wait()
+        out.seek(0)
+        output = out.read()
+    finally:
+        out.close()
+
+    if ret:
+        raise Exception('Fail to run cmd %s, reason: %s' % (args, output))
+    return output
+
+def run_cmd_output(cmd, output_file):
+    """
+    Run cmd and write its stdout to output_file without buffering it in
+    memory, cmd can be a string or an argument list
+    """
+    if isinstance(cmd, (list, tuple)):
+        args = list(cmd)
+    else:
+        args = cmd.split()
+
+    err = tempfile.TemporaryFile()
+    try:
+        with open(output_file, 'wb') as fp:
+            ret = subprocess.call(args, stdout=fp, stderr=err)
+        err.seek(0)
+        output = err.read()
+    finally:
+        err.close()
+
+    if ret:
+        raise Exception('Fail to run cmd %s, reason: %s' % (args, output))
+
 def parse_package_name(package_name):
     match = re.match(
         r"^(.+)\.([^.]+)$", package_name)
@@ -21,6 +93,13 @@ def parse_package_name(package_name):
     name, version, release = match.groups()
     return name, version, release, arch
 
+def version_prefix(version):
+    """
+    Strip the arch from a version like 'libvirt-4.5.0-10.el7.x86_64',
+    uploads of the same prefix can be merged without conversion
+    """
+    return '.'.join(version.split('.')[:-1])
+
 def check_package_version(name):
     cmd = 'rpm -q ' + name
     out = run_cmd(cmd)
@@ -0,0 +1,113 @@
+"""
+Scratch directories and resource locks of tasks
+
+Every task works in its own directory named by the task id, so tasks
+never share a temporary file. Resources which are shared between tasks,
+like a merged report, are guarded by a lock which is held until the
+task and its callbacks are done. Put the lock dir on storage shared by
+all hosts to serialize tasks running on different hosts.
+"""
+import os
+import errno
+import fcntl
+import shutil
+import tempfile
+
+from .cache import makedirs
+
+# task id -> fds of the held locks
+_locks = {}
+
+
+def _setting(name):
+    try:
+        from django.conf import settings
+        return getattr(settings, name, None)
+    except ImportError:
+        return None
+
+
+def work_root():
+    return _setting('COVERAGE_WORK_DIR') or os.path.join(tempfile.gettempdir(),
+                                                         'coveragepool')
+
+
+def lock_root():
+    return _setting('COVERAGE_LOCK_DIR') or os.path.join(work_root(), 'locks')
+
+
+def task_dir(task_id):
+    """
+    Return the scratch directory of the task, create it if needed
+    """
+    path = os.path.join(work_root(), 'tasks', task_id)
+    makedirs(path)
+    return path
+
+
+def task_output_dir(task_id, output_dir=None):
+    """
+    Tasks render to output_dir if the caller sets it, to their scratch
+    directory otherwise
+    """
+    return output_dir or os.path.join(task_dir(task_id), 'report')
+
+
+def lock_resource(task_id, name, blocking=True):
+    """
+    Block until the resource is free, the lock is held until
+    release_task() is called for task_id. If blocking is False, return
+    False instead of waiting for a busy resource
+    """
+    makedirs(lock_root())
+    path = os.path.join(lock_root(), '%s.lock' % name)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except Exception as e:
+            os.close(fd)
+            if not blocking and getattr(e, 'errno', None) in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise e
+        # The file may have been removed by drop_lock() while waiting,
+        # the new holders lock the file which replaced it
+        if _same_file(fd, path):
+            break
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    _locks.setdefault(task_id, []).append(fd)
+    return True
+
+
+def _same_file(fd, path):
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise e
+        return False
+    fst = os.fstat(fd)
+    return (fst.st_dev, fst.st_ino) == (st.st_dev, st.st_ino)
+
+
+def drop_lock(name):
+    """
+    Remove the lock file of a resource which is not used anymore, the
+    caller must hold the lock. Tasks waiting for it lock a new file
+    """
+    try:
+        os.unlink(os.path.join(lock_root(), '%s.lock' % name))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise e
+
+
+def release_task(task_id):
+    """
+    Release the locks of the task and remove its scratch directory
+    """
+    for fd in reversed(_locks.pop(task_id, [])):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    shutil.rmtree(os.path.join(work_root(), 'tasks', task_id), True)
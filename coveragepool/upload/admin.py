@@ -1,11 +1,14 @@
 from django.contrib import admin
-from .models import CoverageFile, CoverageReport, Project
+from .models import CoverageFile, CoverageReport, Project, PendingMerge, StorageUsage
+from .models import UploadSession, SheetOutbox
 
 # Register your models here.
 class CoverageFileAdmin(admin.ModelAdmin):
     list_display = ('name', 'user_name', 'version',
-                    'date', 'coveragefile', 'project')
-    list_filter = ('user_name', 'version', 'project')
+                    'date', 'coveragefile', 'project',
+                    'file_format', 'source_count', 'lines_found', 'lines_hit',
+                    'file_size')
+    list_filter = ('user_name', 'version', 'project', 'file_format')
     search_fields = ('name',)
     date_hierarchy = 'date'
 
@@ -22,6 +25,31 @@ admin.site.register(CoverageReport, CoverageReportAdmin)
 
 class ProjectAdmin(admin.ModelAdmin):
     list_display = ('name', 'base_dir', 'base_url', 'pkg_name',
-                    'tag_fmt', 'git_repo', 'gs_key', 'gs_json_file')
+                    'tag_fmt', 'git_repo', 'path_rules', 'gs_key', 'gs_json_file',
+                    'quota')
 
 admin.site.register(Project, ProjectAdmin)
+
+class PendingMergeAdmin(admin.ModelAdmin):
+    list_display = ('report', 'running', 'reduced', 'task_id', 'date')
+    list_filter = ('running',)
+
+admin.site.register(PendingMerge, PendingMergeAdmin)
+
+class StorageUsageAdmin(admin.ModelAdmin):
+    list_display = ('project', 'size')
+
+admin.site.register(StorageUsage, StorageUsageAdmin)
+
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('token', 'name', 'user_name', 'version',
+                    'size', 'offset', 'stored_size', 'codec', 'date')
+    search_fields = ('name',)
+
+admin.site.register(UploadSession, UploadSessionAdmin)
+
+class SheetOutboxAdmin(admin.ModelAdmin):
+    list_display = ('gs_key', 'sheet', 'row_key', 'update', 'date')
+    list_filter = ('gs_key', 'sheet')
+
+admin.site.register(SheetOutbox, SheetOutboxAdmin)
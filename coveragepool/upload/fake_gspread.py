@@ -0,0 +1,116 @@
+"""
+In memory stand-in of the gspread client for local runs and tests:
+
+    from upload import google_api, fake_gspread
+    fake_gspread.FakeClient.create('key', [['Id', 'Name', 'Version']], [['Id']])
+    google_api.set_client_factory(fake_gspread.FakeClient)
+    ...
+    fake_gspread.FakeClient.spreadsheets['key'].sheet1.calls
+
+Every worksheet method which is an API request with gspread is counted
+in the calls of the worksheet. inject_errors() makes the next requests
+fail like the API does, with 429 for quota errors. Cells are checked
+like gspread does, so callers must build them with the installed one.
+"""
+import collections
+
+import gspread
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code):
+        super(FakeAPIError, self).__init__('Fake API error %d' % status_code)
+        self.response = FakeResponse(status_code)
+
+
+class FakeWorksheet(object):
+    def __init__(self, values=None, rows=1000):
+        self.values = [list(row) for row in values or []]
+        self.row_count = max(rows, len(self.values))
+        self.calls = collections.Counter()
+        self.errors = []
+
+    def inject_errors(self, status_code, count=1):
+        self.errors += [status_code] * count
+
+    def _request(self, name):
+        self.calls[name] += 1
+        if self.errors:
+            raise FakeAPIError(self.errors.pop(0))
+
+    def get_all_values(self):
+        self._request('get_all_values')
+        values = list(self.values)
+        while values and not any(values[-1]):
+            values.pop()
+        width = max([len(row) for row in values] or [0])
+        return [row + [''] * (width - len(row)) for row in values]
+
+    def _set(self, row, col, value):
+        if row < 1 or col < 1 or row > self.row_count:
+            raise Exception('Cell (%d, %d) out of the grid' % (row, col))
+        while len(self.values) < row:
+            self.values.append([])
+        cells = self.values[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = str(value)
+
+    def update_cell(self, row, col, value):
+        self._request('update_cell')
+        self._set(row, col, value)
+
+    def update_cells(self, cell_list):
+        self._request('update_cells')
+        for cell in cell_list:
+            if not isinstance(cell, gspread.Cell):
+                raise TypeError('Need gspread.Cell, got %r' % cell)
+            self._set(cell.row, cell.col, cell.value)
+
+    def add_rows(self, rows):
+        self._request('add_rows')
+        self.row_count += rows
+
+
+class FakeSpreadsheet(object):
+    def __init__(self, worksheets):
+        self.worksheets = worksheets
+
+    @property
+    def sheet1(self):
+        return self.worksheets[0]
+
+    def get_worksheet(self, index):
+        if index < len(self.worksheets):
+            return self.worksheets[index]
+        return None
+
+
+class FakeClient(object):
+    """
+    Spreadsheets are kept by the class, every client of the process
+    sees the same data
+    """
+    spreadsheets = {}
+
+    def __init__(self, json_file=None):
+        self.json_file = json_file
+
+    @classmethod
+    def create(cls, key, *sheets):
+        """
+        sheets are the initial values of the worksheets, a list of rows
+        """
+        cls.spreadsheets[key] = FakeSpreadsheet([FakeWorksheet(values)
+                                                 for values in sheets or [[]]])
+        return cls.spreadsheets[key]
+
+    def open_by_key(self, key):
+        if key not in self.spreadsheets:
+            raise Exception('Spreadsheet %s not found' % key)
+        return self.spreadsheets[key]
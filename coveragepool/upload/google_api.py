@@ -1,26 +1,129 @@
+import os
+import time
+import fcntl
+import random
+import hashlib
+import threading
+
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
+# Header and row count of pooled managers are reloaded after this many
+# seconds, rows appended by other processes are found then
+CACHE_MAX_AGE = 300
+
+# Retry quota and transient errors after a random delay up to
+# BACKOFF_BASE * 2 ** retry seconds, capped by BACKOFF_MAX
+BACKOFF_BASE = 1
+BACKOFF_MAX = 64
+MAX_RETRY = 6
+
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+_AUTH_STATUS = (401, 403)
+
+
+def authorize(json_file):
+    """
+    See: http://gspread.readthedocs.io/en/latest/oauth2.html
+    """
+    scope = ['https://spreadsheets.google.com/feeds']
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(json_file, scope)
+    return gspread.authorize(credentials)
+
+
+class TokenBucket(object):
+    """
+    Token bucket kept in a file, the processes using the same file share
+    the rate. rate tokens are added per second, up to burst.
+    """
+    def __init__(self, path, rate, burst=1):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+
+    def _take(self):
+        """
+        Take a token, return the seconds to wait until it is due. Tokens
+        which are not there yet are borrowed, so waiting processes are
+        served in order instead of racing for the next token
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, stamp = [float(i) for i in os.read(fd, 64).split()]
+            except ValueError:
+                tokens, stamp = self.burst, now
+            tokens = min(self.burst, tokens + max(now - stamp, 0) * self.rate) - 1
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, ('%f %f' % (tokens, now)).encode('ascii'))
+        finally:
+            # Releases the lock
+            os.close(fd)
+        return max(-tokens / self.rate, 0)
+
+    def acquire(self):
+        wait = self._take()
+        if wait:
+            time.sleep(wait)
+
+
+def bucket_path(store_dir, key):
+    return os.path.join(store_dir, 'gsheet-%s.bucket' %
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _error_kind(error):
+    """
+    'retry' for quota and transient errors, 'auth' for authorization
+    errors, None for the others
+    """
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    text = str(error)
+    if status in _RETRY_STATUS or 'RESOURCE_EXHAUSTED' in text or 'RateLimitExceeded' in text:
+        return 'retry'
+    if status in _AUTH_STATUS or 'UNAUTHENTICATED' in text or \
+            type(error).__name__.endswith('RefreshError'):
+        return 'auth'
+    if status is None and isinstance(error, (IOError, OSError)):
+        # Connection errors
+        return 'retry'
+    return None
+
+
 class GoogleSheetMGR(object):
-    def __init__(self, key, sheet=None, json_file=None):
+    """
+    The header row and the row count are loaded once and kept up to date
+    by the writes of this manager. Rows appended by other processes are
+    not seen until the next load, so appends to a shared sheet should go
+    through upsert_rows_by_dict() by one writer, like the outbox worker.
+    client_factory(json_file) returns an authorized gspread client, see
+    upload/fake_gspread.py for a local one. Requests wait for a token of
+    limiter if it is set.
+    """
+    def __init__(self, key, sheet=None, json_file=None, client_factory=None,
+                 limiter=None):
         self.key = key
         self.sheet = sheet
         if json_file:
             self.json_file = json_file
         else:
             self.json_file = "/root/gspread2.json"
+        self.client_factory = client_factory or authorize
+        self.limiter = limiter
+        self.lock = threading.RLock()
 
         self._authorize()
 
-        self.keys = self.get_keys()
+        self.load()
 
     def _authorize(self):
-        """
-        See: http://gspread.readthedocs.io/en/latest/oauth2.html
-        """
-        scope = ['https://spreadsheets.google.com/feeds']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(self.json_file, scope)
-        gc = gspread.authorize(credentials)
+        if self.limiter:
+            self.limiter.acquire()
+        gc = self.client_factory(self.json_file)
         self.Worksheet = gc.open_by_key(self.key)
 
         if self.sheet:
@@ -28,30 +131,47 @@ class GoogleSheetMGR(object):
         else:
             self.ws_obj = self.Worksheet.sheet1
 
+    def load(self):
+        """
+        Reload the header and the row count
+        """
+        table = self._get_all_values()
+        self.keys = table[0] if table else []
+
     def get_all_values(self):
         return self._get_all_values()
 
     def _worksheet_action(self, action, *args):
         """
-        Wrap gspread worksheet actions to make sure no authorization issue
+        Wrap gspread worksheet actions to make sure no authorization issue.
+        Quota errors are retried with exponential backoff and jitter, the
+        client is authorized again on authorization errors only
         """
         retry = 0
-        max_retry = 5
         while True:
+            if self.limiter:
+                self.limiter.acquire()
             try:
                 func = getattr(self.ws_obj, action)
                 return func(*args)
             except Exception as details:
-                self._authorize()
+                kind = _error_kind(details)
                 retry += 1
-                if retry > max_retry:
+                if not kind or retry > MAX_RETRY:
                     raise details
+                if kind == 'auth':
+                    self._authorize()
+                else:
+                    time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retry)))
 
     def _get_all_values(self):
         """
-        Get all values from worksheet
+        Get all values from worksheet, the row count is refreshed
         """
-        return self._worksheet_action('get_all_values')
+        table = self._worksheet_action('get_all_values')
+        self.rows = len(table)
+        self.loaded = time.time()
+        return table
 
     def _update_cell(self, *args):
         """
@@ -59,39 +179,83 @@ class GoogleSheetMGR(object):
         """
         return self._worksheet_action('update_cell', *args)
 
+    def _update_cells(self, cells):
+        """
+        Update cells in spreadsheet with one request
+        """
+        if not cells:
+            return
+        last_row = max(cell.row for cell in cells)
+        # update_cells does not add rows to the worksheet
+        if last_row > self.ws_obj.row_count:
+            self._worksheet_action('add_rows', last_row - self.ws_obj.row_count)
+        self._worksheet_action('update_cells', cells)
+        self.rows = max(self.rows, last_row)
+
+    def _dict_cells(self, row, data_dict):
+        return [gspread.Cell(row, index + 1, data_dict[key])
+                for index, key in enumerate(self.keys) if key in data_dict.keys()]
+
     def get_keys(self):
         """
         1st row is the key
         """
-        return self._get_all_values()[0]
+        return self.keys
 
     def rework_sheet(self, data):
         old_data = self.get_all_values()
 
+        cells = []
         for i_row, row_data in enumerate(old_data):
             for i_cell, cell_data in enumerate(row_data):
                 new_val = data[i_row][i_cell]
                 if new_val != cell_data:
-                    self._update_cell(i_row, i_cell, new_val)
+                    cells.append(gspread.Cell(i_row + 1, i_cell + 1, new_val))
+        self._update_cells(cells)
 
     def add_new_row(self, row_data, row=None):
-        if row:
-            new_row = row
-        else:
-            new_row = len(self._get_all_values()) + 1
+        with self.lock:
+            new_row = row or self.rows + 1
+            self._update_cells([gspread.Cell(new_row, index + 1, cell_data)
+                                for index, cell_data in enumerate(row_data)])
 
-        for index, cell_data in enumerate(row_data):
-            self._update_cell(new_row, index + 1, cell_data)
+    def add_new_rows_by_dict(self, dict_list):
+        """
+        Append the rows with one update request
+        """
+        with self.lock:
+            cells = []
+            for index, data_dict in enumerate(dict_list):
+                cells += self._dict_cells(self.rows + 1 + index, data_dict)
+            self._update_cells(cells)
 
-    def add_new_row_by_dict(self, data_dict, row=None):
-        if row:
-            new_row = row
-        else:
-            new_row = len(self._get_all_values()) + 1
+    def upsert_rows_by_dict(self, key, dict_list, append_keys=None):
+        """
+        Write the rows with one update request. A row replaces the cells
+        of the row with the same value in column key, or is appended if
+        there is none and its value is in append_keys (any if None).
+        """
+        with self.lock:
+            table = self._get_all_values()
+            index = self.keys.index(key)
+            rows = dict((str(values[index]), i + 1) for i, values in enumerate(table)
+                        if i and len(values) > index)
+            new_row = self.rows
+            cells = []
+            for data_dict in dict_list:
+                value = str(data_dict[key])
+                if value not in rows:
+                    if append_keys is not None and value not in append_keys:
+                        continue
+                    new_row += 1
+                    rows[value] = new_row
+                cells += self._dict_cells(rows[value], data_dict)
+            self._update_cells(cells)
 
-        for index, key in enumerate(self.keys):
-            if key in data_dict.keys():
-                self._update_cell(new_row, index + 1, data_dict[key])
+    def add_new_row_by_dict(self, data_dict, row=None):
+        with self.lock:
+            new_row = row or self.rows + 1
+            self._update_cells(self._dict_cells(new_row, data_dict))
 
     def search_update_by_dict(self, search_dict, data_dict):
         table = self._get_all_values()
@@ -103,6 +267,7 @@ class GoogleSheetMGR(object):
             if key in data_dict.keys():
                 index_dict2[index] = data_dict[key]
 
+        cells = []
         for row, i in enumerate(table):
             for index, val in index_dict.items():
                 if i[index] != str(val):
@@ -115,7 +280,8 @@ class GoogleSheetMGR(object):
                 continue
 
             for key, val in index_dict2.items():
-                self._update_cell(row + 1, key + 1, val)
+                cells.append(gspread.Cell(row + 1, key + 1, val))
+        self._update_cells(cells)
 
     def search_info_by_dict(self, search_dict, table=None):
         # TODO: merge code with search_update_by_dict
@@ -145,3 +311,37 @@ class GoogleSheetMGR(object):
             ret.append(tmp)
 
         return ret
+
+
+# (key, sheet) -> GoogleSheetMGR, shared by the threads of the process
+_pool = {}
+_pool_lock = threading.Lock()
+_client_factory = None
+
+
+def set_client_factory(factory):
+    """
+    Create gspread clients with factory from now on, like
+    fake_gspread.FakeClient for local runs. Pooled managers are dropped
+    """
+    global _client_factory
+    with _pool_lock:
+        _client_factory = factory
+        _pool.clear()
+
+
+def get_gsmgr(key, sheet=None, json_file=None, limiter=None):
+    """
+    Return the pooled manager of the worksheet, authorize it on first use
+    """
+    with _pool_lock:
+        gs = _pool.get((key, sheet))
+        if gs is None or (json_file and gs.json_file != json_file):
+            gs = GoogleSheetMGR(key, sheet=sheet, json_file=json_file,
+                                client_factory=_client_factory, limiter=limiter)
+            _pool[(key, sheet)] = gs
+
+    with gs.lock:
+        if time.time() - gs.loaded > CACHE_MAX_AGE:
+            gs.load()
+    return gs
@@ -1,14 +1,22 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from django.db import models, transaction
 from django.dispatch import receiver
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_save, post_delete
 from django.core.files import File
+from .storage import tracefile_storage
 import random
 import shutil
 import datetime
 
+def blob_name(content_hash):
+    return 'coveragefile/blobs/%s' % content_hash
+
 def content_file_name(instance, filename):
+    content_hash = getattr(instance, 'content_hash', None)
+    if content_hash:
+        # Shared by uploads of the same content
+        return blob_name(content_hash)
     hash = random.getrandbits(128)
     file_name = '%032x-%s' % (hash, filename)
     return 'coveragefile/%s' % file_name
@@ -21,9 +29,13 @@ class Project(models.Model):
     base_url = models.CharField(max_length=100, null=True)
     tag_fmt = models.CharField(max_length=100, null=True)
     git_repo = models.CharField(max_length=255, null=True)
+    # 'src:tgt;src2:tgt2', see COVERAGE_PATH_RULES
+    path_rules = models.CharField(max_length=255, null=True, blank=True)
     # Google sheet db
     gs_key = models.CharField(max_length=255, null=True)
     gs_json_file = models.CharField(max_length=100, null=True)
+    # Bytes of media files of this project, null or 0 is unlimited
+    quota = models.BigIntegerField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -34,7 +46,50 @@ class CoverageFile(models.Model):
     user_name = models.CharField(max_length=100)
     version = models.CharField(max_length=100)
     date = models.DateTimeField(default=datetime.datetime.now)
-    coveragefile = models.FileField(upload_to=content_file_name)
+    # Uploads with the same content_hash share the stored file
+    coveragefile = models.FileField(upload_to=content_file_name, storage=tracefile_storage,
+                                    db_index=True)
+    # Metadata scanned at upload time, see gen_report/ingest.py
+    # null means the file was uploaded before it is supported
+    file_format = models.CharField(max_length=20, null=True, blank=True)
+    source_count = models.IntegerField(null=True, blank=True)
+    lines_found = models.IntegerField(null=True, blank=True)
+    lines_hit = models.IntegerField(null=True, blank=True)
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    path_roots = models.TextField(null=True, blank=True)
+    # Stored size, the file may be compressed
+    file_size = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        # listfile filters on these and pages by (date, id)
+        index_together = [('date', 'id'),
+                          ('project', 'date', 'id'),
+                          ('name', 'date', 'id'),
+                          ('version', 'date', 'id'),
+                          ('user_name', 'date', 'id')]
+
+    def is_empty(self):
+        return self.source_count == 0
+
+    def shares_file(self):
+        """
+        If other uploads point to the same stored file
+        """
+        return CoverageFile.objects.filter(
+            coveragefile=self.coveragefile.name).exclude(id=self.id).exists()
+
+def find_blob(content_hash):
+    """
+    Return the name of the stored file with this content, None if there
+    is none. Call it in the transaction which creates the new upload,
+    the uploads of this content stay locked until it ends.
+    """
+    if not content_hash:
+        return None
+    for obj in CoverageFile.objects.select_for_update().filter(content_hash=content_hash):
+        if obj.coveragefile and obj.coveragefile.storage.exists(obj.coveragefile.name):
+            return obj.coveragefile.name
+    return None
 
 class CoverageReport(models.Model):
     project = models.ForeignKey(Project, null=True)
@@ -43,19 +98,153 @@ class CoverageReport(models.Model):
     date = models.DateTimeField(default=datetime.datetime.now)
     path = models.CharField(max_length=100, blank=True, null=True)
     url = models.CharField(max_length=100, blank=True, null=True)
-    tracefile = models.FileField(null=True, upload_to=content_file_name)
+    tracefile = models.FileField(null=True, upload_to=content_file_name,
+                                 storage=tracefile_storage)
     rules = models.CharField(max_length=100, blank=True, null=True)
     coverage_files = models.ManyToManyField(CoverageFile)
+    tracefile_size = models.BigIntegerField(null=True, blank=True)
 
     def save_tracefile(self, tracefile):
         name = 'merged_report_%d' % self.id
-        with open(tracefile) as fp:
-            myfile = File(fp)
-            self.tracefile.save(name, myfile)
+        old_size = self.tracefile_size or 0
+        with transaction.atomic():
+            with open(tracefile, 'rb') as fp:
+                myfile = File(fp)
+                self.tracefile.save(name, myfile, save=False)
+            self.tracefile_size = self.tracefile.size
+            self.save()
+            update_storage_usage(self.project, self.tracefile_size - old_size)
+
+class UploadSession(models.Model):
+    """
+    Chunked upload in progress. Chunks are appended to the staged file
+    in the storage, each compressed as its own stream with codec, an
+    empty codec means the chunks are stored as they are
+    """
+    token = models.CharField(max_length=32, unique=True)
+    name = models.CharField(max_length=100)
+    user_name = models.CharField(max_length=100)
+    version = models.CharField(max_length=100)
+    # Announced by the client, optional
+    size = models.BigIntegerField(null=True, blank=True)
+    sha256 = models.CharField(max_length=64, null=True, blank=True)
+    # Quota of the upload, see check_storage_quota()
+    project = models.ForeignKey(Project, null=True, blank=True)
+    # Bytes received and bytes in the staged file
+    offset = models.BigIntegerField(default=0)
+    stored_size = models.BigIntegerField(default=0)
+    codec = models.CharField(max_length=20, null=True, blank=True)
+    # Last activity, idle sessions are removed by reconcile_storage_usage
+    date = models.DateTimeField(default=datetime.datetime.now)
+
+    def staged_name(self):
+        return 'coveragefile/uploads/%s' % self.token
+
+    def reserved_size(self):
+        """
+        Bytes the upload takes from the quota until it is committed
+        """
+        return max(self.size or 0, self.stored_size)
+
+@receiver(post_delete, sender=UploadSession)
+def UploadSession_post_delete_handler(sender, instance, **kwargs):
+    tracefile_storage.delete(instance.staged_name())
+
+class StorageUsage(models.Model):
+    """
+    Bytes of media files per project, project None counts the files
+    without project. Updated with the files, checked before uploads and
+    recomputed by the reconcile_storage_usage task.
+    """
+    project = models.OneToOneField(Project, null=True)
+    size = models.BigIntegerField(default=0)
+
+def update_storage_usage(project, delta):
+    if not delta:
+        return
+    with transaction.atomic():
+        usage, _ = StorageUsage.objects.get_or_create(project=project)
+        StorageUsage.objects.filter(id=usage.id).update(size=models.F('size') + delta)
+
+def check_storage_quota(project, size, media_limit=0, session=None):
+    """
+    Return the reason if size more bytes do not fit in the media limit or
+    the project quota, None otherwise. Call it in the transaction which
+    saves the file, the usage stays locked until the transaction ends.
+    Uploads in progress are counted, except session whose bytes are in
+    size.
+    """
+    usages = list(StorageUsage.objects.select_for_update())
+    sessions = UploadSession.objects.all()
+    if session:
+        sessions = sessions.exclude(id=session.id)
+    sessions = list(sessions)
+    if media_limit and (sum(i.size for i in usages) + size +
+                        sum(i.reserved_size() for i in sessions)) > media_limit:
+        return 'Media directroy size limited'
+    if project and project.quota:
+        used = sum(i.size for i in usages if i.project_id == project.id)
+        used += sum(i.reserved_size() for i in sessions if i.project_id == project.id)
+        if used + size > project.quota:
+            return 'Project %s quota exceeded' % project.name
+    return None
+
+class PendingMerge(models.Model):
+    """
+    CoverageFiles waiting to be merged in a report. A report has at most
+    one queued merge, new files are added to it. A merge which started
+    is marked running and removed when it is done.
+    """
+    report = models.ForeignKey(CoverageReport)
+    coverage_files = models.ManyToManyField(CoverageFile)
+    running = models.BooleanField(default=False)
+    task_id = models.CharField(max_length=255, blank=True, null=True)
+    # Queued date, or the date of the last step of a running merge
+    date = models.DateTimeField(default=datetime.datetime.now)
+    # Spread over workers, task_id is the final task, see reduce_merge
+    reduced = models.BooleanField(default=False)
+
+class SheetOutbox(models.Model):
+    """
+    Sheet rows waiting to be written. Added in the transaction which
+    changes the data, written by the drain_sheet_outbox task in id order
+    per spreadsheet. Rows are matched by their Id, so writing a row
+    again gives the same sheet.
+    """
+    gs_key = models.CharField(max_length=255)
+    gs_json_file = models.CharField(max_length=100, null=True, blank=True)
+    sheet = models.IntegerField(default=0)
+    row_key = models.CharField(max_length=100)
+    # json dict of column -> value
+    data = models.TextField()
+    # Only change the row if it is in the sheet
+    update = models.BooleanField(default=False)
+    date = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        index_together = [('gs_key', 'id')]
+
+@receiver(post_save, sender=CoverageFile)
+def CoverageFile_post_save_handler(sender, instance, created, **kwargs):
+    if not created:
+        return
+    # Size of the stored file, it is known after the file was saved
+    size = instance.coveragefile.size if instance.coveragefile else 0
+    if instance.file_size != size:
+        instance.file_size = size
+        CoverageFile.objects.filter(id=instance.id).update(file_size=size)
+    if instance.coveragefile and instance.shares_file():
+        # Counted by the first upload of the content
+        return
+    update_storage_usage(instance.project, size)
 
 @receiver(post_delete, sender=CoverageFile)
 def CoverageFile_post_delete_handler(sender, instance, **kwargs):
+    if instance.coveragefile and instance.shares_file():
+        # Still used by other uploads
+        return
     instance.coveragefile.delete(save=False)
+    update_storage_usage(instance.project, -(instance.file_size or 0))
 
 @receiver(post_delete, sender=CoverageReport)
 def CoverageReport_post_delete_handler(sender, instance, **kwargs):
@@ -63,3 +252,4 @@ def CoverageReport_post_delete_handler(sender, instance, **kwargs):
         shutil.rmtree(instance.path, True)
     if instance.tracefile:
         instance.tracefile.delete(save=False)
+    update_storage_usage(instance.project, -(instance.tracefile_size or 0))
@@ -0,0 +1,46 @@
+import logging
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from gen_report.codec import compress_chunks, can_compress
+
+logger = logging.getLogger(__name__)
+_warned = set()
+
+
+def storage_codec():
+    """
+    COVERAGE_STORAGE_CODEC, gzip if the codec cannot be written here,
+    like lzma on python2
+    """
+    codec = getattr(settings, 'COVERAGE_STORAGE_CODEC', None) or ''
+    if codec and not can_compress(codec):
+        if codec not in _warned:
+            _warned.add(codec)
+            logger.warning('Storage codec %s is not available, use gzip' % codec)
+        return 'gzip'
+    return codec
+
+
+class CompressedStorage(FileSystemStorage):
+    """
+    Compress files with COVERAGE_STORAGE_CODEC when they are saved.
+    Readers detect the codec, see gen_report/codec.py
+    """
+    def _save(self, name, content):
+        codec = storage_codec()
+        if not codec:
+            return super(CompressedStorage, self)._save(name, content)
+
+        tmp_file = tempfile.TemporaryFile()
+        try:
+            compress_chunks(content.chunks(), tmp_file, codec)
+            tmp_file.seek(0)
+            return super(CompressedStorage, self)._save(name, File(tmp_file))
+        finally:
+            tmp_file.close()
+
+tracefile_storage = CompressedStorage()
@@ -1,3 +1,536 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
 
-# Create your tests here.
+import io
+import gzip
+import shutil
+import hashlib
+import os
+import json
+import datetime
+import tempfile
+
+from .models import CoverageFile, Project, UploadSession, StorageUsage
+from .storage import tracefile_storage
+from . import google_api
+from .fake_gspread import FakeClient
+from gen_report import tasks
+from gen_report import codec
+from .views import sheet_row
+
+TRACEFILE = b'TN:\nSF:/src/a.c\nDA:1,1\nDA:2,0\nend_of_record\n'
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+class UploadTestBase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.settings = override_settings(COVERAGE_STORAGE_CODEC='gzip')
+        self.settings.enable()
+        # The storage location is fixed when it is created
+        self.location = tracefile_storage.location
+        tracefile_storage.location = self.tmp_dir
+
+    def tearDown(self):
+        tracefile_storage.location = self.location
+        self.settings.disable()
+        shutil.rmtree(self.tmp_dir, True)
+
+    def start(self, **kwargs):
+        data = {'name': 'test', 'version': 'libvirt-1.0-1.el7.x86_64', 'user_name': 'test'}
+        data.update(kwargs)
+        resp = self.client.post('/upload/upload/start/', data)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json()['id']
+
+    def put(self, token, offset, data):
+        return self.client.put('/upload/upload/%s/?offset=%d' % (token, offset), data,
+                               content_type='application/octet-stream')
+
+    def commit(self, token, **kwargs):
+        return self.client.post('/upload/upload/%s/commit/' % token, kwargs)
+
+    def upload(self, data, chunk_size=16):
+        token = self.start(size=len(data), sha256=hashlib.sha256(data).hexdigest())
+        for offset in range(0, len(data), chunk_size):
+            resp = self.put(token, offset, data[offset:offset + chunk_size])
+            self.assertEqual(resp.status_code, 200)
+        return token, self.commit(token)
+
+    def check_file(self):
+        cf = CoverageFile.objects.get()
+        self.assertEqual(cf.source_count, 1)
+        self.assertEqual(cf.lines_found, 2)
+        self.assertEqual(cf.content_hash, hashlib.sha256(TRACEFILE).hexdigest())
+        return cf
+
+
+class ChunkedUploadTest(UploadTestBase):
+    def test_plain_upload(self):
+        _, resp = self.upload(TRACEFILE)
+        self.assertEqual(resp.status_code, 200)
+        self.check_file()
+
+    def test_compressed_upload(self):
+        _, resp = self.upload(gzip_bytes(TRACEFILE))
+        self.assertEqual(resp.status_code, 200)
+        self.check_file()
+
+    def test_checksum_mismatch(self):
+        token = self.start(sha256=hashlib.sha256(b'other').hexdigest())
+        self.put(token, 0, TRACEFILE)
+        resp = self.commit(token)
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(CoverageFile.objects.exists())
+
+    def test_offset_mismatch(self):
+        token = self.start()
+        self.put(token, 0, TRACEFILE[:10])
+        resp = self.put(token, 0, TRACEFILE[10:])
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.json()['offset'], 10)
+
+
+class StorageCodecTest(UploadTestBase):
+    def setUp(self):
+        super(StorageCodecTest, self).setUp()
+        self.lzma = codec.lzma
+        self.codec_settings = override_settings(COVERAGE_STORAGE_CODEC='lzma')
+        self.codec_settings.enable()
+
+    def tearDown(self):
+        codec.lzma = self.lzma
+        self.codec_settings.disable()
+        super(StorageCodecTest, self).tearDown()
+
+    def stored_codec(self):
+        return codec.detect(CoverageFile.objects.get().coveragefile.path)
+
+    def test_lzma_missing(self):
+        codec.lzma = None
+        _, resp = self.upload(TRACEFILE)
+        self.assertEqual(resp.status_code, 200)
+        self.check_file()
+        self.assertEqual(self.stored_codec(), 'gzip')
+        name = tracefile_storage.save('other', ContentFile(TRACEFILE))
+        self.assertEqual(codec.detect(tracefile_storage.path(name)), 'gzip')
+
+    def test_lzma(self):
+        if not codec.lzma:
+            self.skipTest('No lzma module')
+        _, resp = self.upload(TRACEFILE)
+        self.assertEqual(resp.status_code, 200)
+        self.check_file()
+        self.assertEqual(self.stored_codec(), 'lzma')
+
+
+class UploadQuotaTest(UploadTestBase):
+    def setUp(self):
+        super(UploadQuotaTest, self).setUp()
+        self.project = Project.objects.create(name='libvirt', pkg_name='libvirt', quota=100)
+
+    def set_quota(self, quota):
+        Project.objects.filter(id=self.project.id).update(quota=quota)
+
+    def test_declared_size(self):
+        resp = self.client.post('/upload/upload/start/',
+                                {'name': 'test', 'version': 'libvirt-1.0-1.el7.x86_64',
+                                 'user_name': 'test', 'size': 200})
+        self.assertEqual(resp.status_code, 403)
+
+    def test_reserved_by_session(self):
+        self.start(size=60)
+        resp = self.client.post('/upload/upload/start/',
+                                {'name': 'test', 'version': 'libvirt-1.0-1.el7.x86_64',
+                                 'user_name': 'test', 'size': 60})
+        self.assertEqual(resp.status_code, 403)
+
+    def test_staged_bytes(self):
+        self.set_quota(len(TRACEFILE) + 10)
+        token = self.start()
+        self.assertEqual(self.put(token, 0, TRACEFILE).status_code, 200)
+        resp = self.put(token, len(TRACEFILE), TRACEFILE)
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(resp.json()['offset'], len(TRACEFILE))
+
+    def test_commit_rejected(self):
+        token = self.start()
+        self.put(token, 0, TRACEFILE)
+        self.set_quota(1)
+        self.assertEqual(self.commit(token).status_code, 403)
+        # Kept for a retry
+        self.assertEqual(self.client.get('/upload/upload/%s/' % token).json()['offset'],
+                         len(TRACEFILE))
+        self.set_quota(1000)
+        self.assertEqual(self.commit(token).status_code, 200)
+        self.check_file()
+
+    def test_abort(self):
+        token = self.start(size=60)
+        self.put(token, 0, TRACEFILE)
+        path = tracefile_storage.path(UploadSession.objects.get().staged_name())
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.client.delete('/upload/upload/%s/' % token).status_code, 200)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(path))
+        # The reserved size is free again
+        self.start(size=60)
+
+
+class BulkUploadTest(UploadTestBase):
+    def bulk_upload(self, files):
+        uploads = [SimpleUploadedFile(name, data) for name, data in files]
+        resp = self.client.post('/upload/bulkupload/',
+                                {'name': 'test', 'version': 'libvirt-1.0-1.el7.x86_64',
+                                 'user_name': 'test', 'coveragefile': uploads,
+                                 'metadata': json.dumps({'b': {'name': 'b'}})})
+        self.assertEqual(resp.status_code, 200)
+        return resp.json()['data']
+
+    def usage(self):
+        return sum(StorageUsage.objects.values_list('size', flat=True))
+
+    def test_ids(self):
+        other = TRACEFILE.replace(b'a.c', b'b.c')
+        data = self.bulk_upload([('a', TRACEFILE), ('b', other), ('c', TRACEFILE)])
+        self.assertEqual([i['file'] for i in data], ['a', 'b', 'c'])
+        objs = [CoverageFile.objects.get(id=i['id']) for i in data]
+        self.assertEqual([obj.name for obj in objs], ['test', 'b', 'test'])
+        self.assertEqual(objs[0].coveragefile.name, objs[2].coveragefile.name)
+        # Same content is counted once
+        self.assertEqual(self.usage(), objs[0].file_size + objs[1].file_size)
+
+    def test_stored_content(self):
+        first = self.bulk_upload([('a', TRACEFILE)])
+        usage = self.usage()
+        second = self.bulk_upload([('a', TRACEFILE)])
+        self.assertNotEqual(first[0]['id'], second[0]['id'])
+        self.assertEqual(self.usage(), usage)
+
+
+HEADER = ['Id', 'Name', 'User Name', 'Version', 'Date']
+
+
+class SheetTestBase(TestCase):
+    def setUp(self):
+        FakeClient.spreadsheets.clear()
+        self.spreadsheet = FakeClient.create('key', [HEADER], [['Id', 'Coverage Report']])
+        self.ws = self.spreadsheet.sheet1
+        google_api.set_client_factory(FakeClient)
+        self.settings = override_settings(COVERAGE_GS_KEY='key', COVERAGE_GS_RATE=0)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        google_api.set_client_factory(None)
+        FakeClient.spreadsheets.clear()
+
+    def row(self, i):
+        return {'Id': i, 'Name': 'n%d' % i, 'Version': 'v'}
+
+
+class GoogleSheetMGRTest(SheetTestBase):
+    def test_batched_append(self):
+        gs = google_api.get_gsmgr('key')
+        gs.add_new_rows_by_dict([self.row(i) for i in range(3)])
+        self.assertEqual(self.ws.calls['update_cells'], 1)
+        self.assertEqual([row[:2] for row in self.ws.values[1:]],
+                         [[str(i), 'n%d' % i] for i in range(3)])
+
+    def test_rows_added(self):
+        self.ws.row_count = 2
+        gs = google_api.get_gsmgr('key')
+        gs.add_new_rows_by_dict([self.row(i) for i in range(3)])
+        self.assertEqual(self.ws.calls['add_rows'], 1)
+        self.assertEqual(len(self.ws.get_all_values()), 4)
+
+    def test_upsert(self):
+        gs = google_api.get_gsmgr('key')
+        gs.add_new_rows_by_dict([self.row(1)])
+        gs.upsert_rows_by_dict('Id', [{'Id': 1, 'Name': 'new'}, self.row(2), self.row(3)],
+                               append_keys=set(['2']))
+        self.assertEqual([row[:2] for row in self.ws.get_all_values()[1:]],
+                         [['1', 'new'], ['2', 'n2']])
+
+    def test_pooled(self):
+        gs = google_api.get_gsmgr('key')
+        self.assertIs(google_api.get_gsmgr('key'), gs)
+        self.assertIsNot(google_api.get_gsmgr('key', sheet=1), gs)
+        self.assertEqual(self.ws.calls['get_all_values'], 1)
+
+    def test_row_count_reloaded(self):
+        gs = google_api.get_gsmgr('key')
+        # Appended by another process
+        self.ws.values.append(['9', 'other'])
+        self.assertEqual(google_api.get_gsmgr('key').rows, 1)
+        gs.loaded -= google_api.CACHE_MAX_AGE + 1
+        self.assertEqual(google_api.get_gsmgr('key').rows, 2)
+        gs.add_new_rows_by_dict([self.row(1)])
+        self.assertEqual(self.ws.values[1][:2], ['9', 'other'])
+        self.assertEqual(self.ws.values[2][:2], ['1', 'n1'])
+
+
+class SheetOutboxTest(SheetTestBase):
+    def drain(self):
+        tasks._drain_spreadsheet('key', 2)
+
+    def test_drain(self):
+        tasks.queue_sheet_rows(None, [self.row(i) for i in range(3)])
+        tasks.queue_sheet_rows(None, [{'Id': 1, 'Name': 'new'}], update=True)
+        tasks.queue_sheet_rows(None, [{'Id': 5, 'Name': 'missing'}], update=True)
+        tasks.queue_sheet_rows(None, [{'Id': 0, 'Coverage Report': 'url'}], sheet=1)
+        self.assertEqual(tasks.pending_sheet_rows(google_api.get_gsmgr('key')),
+                         set(['0', '1', '2', '5']))
+        self.drain()
+        self.assertFalse(tasks.pending_sheet_rows(google_api.get_gsmgr('key')))
+        self.assertEqual([row[:2] for row in self.ws.get_all_values()[1:]],
+                         [['0', 'n0'], ['1', 'new'], ['2', 'n2']])
+        self.assertEqual(self.spreadsheet.worksheets[1].get_all_values()[1], ['0', 'url'])
+
+    def test_failed_batch_kept(self):
+        tasks.queue_sheet_rows(None, [self.row(i) for i in range(3)])
+        google_api.get_gsmgr('key')
+        self.ws.inject_errors(400)
+        self.assertRaises(Exception, self.drain)
+        self.assertEqual(len(tasks.pending_sheet_rows(google_api.get_gsmgr('key'))), 3)
+        self.drain()
+        self.assertEqual(len(self.ws.get_all_values()), 4)
+
+    def test_sync_data(self):
+        for i in range(3):
+            CoverageFile.objects.create(name='f%d' % i, user_name='test', version='v')
+        self.ws.values.append(['999', 'old'])
+        self.client.get('/upload/syncdata/')
+        self.drain()
+        ids = [row[0] for row in self.ws.get_all_values()[1:]]
+        self.assertEqual(ids, ['999'] + [str(obj.id) for obj in CoverageFile.objects.order_by('id')])
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = google_api.bucket_path(self.tmp_dir, 'key')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def test_burst(self):
+        bucket = google_api.TokenBucket(self.path, 10, burst=2)
+        self.assertEqual(bucket._take(), 0)
+        self.assertEqual(bucket._take(), 0)
+        wait = bucket._take()
+        self.assertTrue(0.05 < wait <= 0.1)
+        # Borrowed tokens make the next process wait longer
+        self.assertTrue(wait + 0.05 < bucket._take() <= 0.2)
+
+    def test_shared(self):
+        google_api.TokenBucket(self.path, 1)._take()
+        self.assertTrue(0.5 < google_api.TokenBucket(self.path, 1)._take() <= 1)
+
+
+class BackoffTest(SheetTestBase):
+    def setUp(self):
+        super(BackoffTest, self).setUp()
+        self.backoff_base = google_api.BACKOFF_BASE
+        google_api.BACKOFF_BASE = 0
+        self.gs = google_api.get_gsmgr('key')
+        self.clients = []
+        def _factory(json_file):
+            self.clients.append(json_file)
+            return FakeClient(json_file)
+        self.gs.client_factory = _factory
+
+    def tearDown(self):
+        google_api.BACKOFF_BASE = self.backoff_base
+        super(BackoffTest, self).tearDown()
+
+    def write(self):
+        self.gs.add_new_rows_by_dict([self.row(1)])
+
+    def test_retry(self):
+        for status in (429, 500, 503):
+            self.ws.inject_errors(status)
+        self.write()
+        self.assertEqual(self.ws.calls['update_cells'], 4)
+        self.assertEqual(self.ws.values[1][0], '1')
+        # Not authorized again for quota errors
+        self.assertEqual(self.clients, [])
+
+    def test_auth(self):
+        self.ws.inject_errors(401)
+        self.write()
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.ws.values[1][0], '1')
+
+    def test_no_retry(self):
+        self.ws.inject_errors(400)
+        self.assertRaises(Exception, self.write)
+        self.assertEqual(self.ws.calls['update_cells'], 1)
+
+    def test_max_retry(self):
+        self.ws.inject_errors(429, google_api.MAX_RETRY + 1)
+        self.assertRaises(Exception, self.write)
+        self.assertEqual(self.ws.calls['update_cells'], google_api.MAX_RETRY + 1)
+
+
+class RescanTableTest(SheetTestBase):
+    def setUp(self):
+        super(RescanTableTest, self).setUp()
+        self.project = Project.objects.create(name='libvirt', pkg_name='libvirt', gs_key='key')
+        self.pending_sheet_rows = tasks.pending_sheet_rows
+
+    def tearDown(self):
+        tasks.pending_sheet_rows = self.pending_sheet_rows
+        super(RescanTableTest, self).tearDown()
+
+    def create(self, name):
+        cf = CoverageFile.objects.create(project=self.project, name=name,
+                                         user_name='test', version='v')
+        tasks.queue_sheet_rows(self.project, [sheet_row(cf)])
+        return cf
+
+    def test_rows(self):
+        written = self.create('written')
+        tasks._drain_spreadsheet('key', 100)
+        pending = self.create('pending')
+        removed = CoverageFile.objects.create(project=self.project, name='removed',
+                                              user_name='test', version='v')
+        tasks.rescan_table()
+        self.assertFalse(CoverageFile.objects.filter(id=removed.id).exists())
+        self.assertEqual(set(CoverageFile.objects.values_list('id', flat=True)),
+                         set([written.id, pending.id]))
+
+    def test_drained_during_rescan(self):
+        cf = self.create('test')
+        def _pending_sheet_rows(gs):
+            # The worker writes the row while the table is scanned
+            tasks._drain_spreadsheet('key', 100)
+            return self.pending_sheet_rows(gs)
+        tasks.pending_sheet_rows = _pending_sheet_rows
+        tasks.rescan_table()
+        self.assertTrue(CoverageFile.objects.filter(id=cf.id).exists())
+
+
+class ListFileTest(TestCase):
+    def setUp(self):
+        self.libvirt = Project.objects.create(name='libvirt')
+        self.virtinst = Project.objects.create(name='virtinst')
+        day = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+        # Three files share a date, their ids order them
+        dates = [day, day + datetime.timedelta(hours=1)] + \
+                [day + datetime.timedelta(days=1)] * 3 + [day + datetime.timedelta(days=2)]
+        self.objs = []
+        for i, date in enumerate(dates):
+            self.objs.append(CoverageFile.objects.create(
+                project=self.virtinst if i % 2 else self.libvirt,
+                name='f%d' % i, user_name='user%d' % (i % 3),
+                version='v%d' % (i % 2), date=date))
+
+    def get(self, status=200, **params):
+        response = self.client.get('/upload/listfile/', params)
+        self.assertEqual(response.status_code, status)
+        if status != 200:
+            return json.loads(response.content.decode('utf-8'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        content = b''.join(response.streaming_content)
+        return json.loads(content.decode('utf-8'))
+
+    def ids(self, **params):
+        return [item['id'] for item in self.get(fields='id', **params)['data']]
+
+    def test_shape(self):
+        self.maxDiff = None
+        ret = self.get(limit=1)
+        self.assertEqual(sorted(ret.keys()), ['data', 'next'])
+        item = ret['data'][0]
+        obj = self.objs[0]
+        self.assertEqual(item, {'id': obj.id, 'project': self.libvirt.id, 'name': 'f0',
+                                'user_name': 'user0', 'version': 'v0',
+                                'date': '2020-01-01 00:00:00',
+                                'coveragefile': '', 'file_format': None,
+                                'source_count': None, 'lines_found': None,
+                                'lines_hit': None, 'content_hash': None,
+                                'path_roots': None, 'file_size': 0})
+        self.assertTrue(ret['next'])
+
+        ret = self.get()
+        self.assertEqual(len(ret['data']), len(self.objs))
+        self.assertIsNone(ret['next'])
+        CoverageFile.objects.all().delete()
+        self.assertEqual(self.get(), {'data': [], 'next': None})
+
+    def test_pages(self):
+        for limit in range(1, len(self.objs) + 1):
+            ids = []
+            pages = 0
+            cursor = None
+            while True:
+                ret = self.get(fields='id', limit=limit, cursor=cursor or '')
+                ids += [item['id'] for item in ret['data']]
+                pages += 1
+                cursor = ret['next']
+                if not cursor:
+                    break
+            self.assertEqual(ids, [obj.id for obj in self.objs])
+            # No empty last page if the rows end on a page boundary
+            self.assertEqual(pages, (len(self.objs) + limit - 1) // limit)
+
+    def test_cursor_same_date(self):
+        ret = self.get(fields='id', limit=3)
+        self.assertEqual([item['id'] for item in ret['data']],
+                         [obj.id for obj in self.objs[:3]])
+        # The page ends in the middle of the files with the same date
+        self.assertEqual(ret['next'], '20200102000000000000_%d' % self.objs[2].id)
+        self.assertEqual(self.ids(limit=2, cursor=ret['next']),
+                         [obj.id for obj in self.objs[3:5]])
+
+    def test_page_size(self):
+        with override_settings(COVERAGE_LIST_PAGE_SIZE=2):
+            self.assertEqual(len(self.ids()), 2)
+            self.assertEqual(len(self.ids(limit=100)), 2)
+            self.assertEqual(len(self.ids(limit=1)), 1)
+
+    def test_bad_params(self):
+        for params in ({'cursor': 'abc'}, {'cursor': '2020_1'}, {'cursor': '20200101000000000000_x'},
+                       {'cursor': '20200101000000000000_1_2'}, {'limit': '0'}, {'limit': 'x'},
+                       {'since': 'not a date'}):
+            ret = self.get(400, **params)
+            self.assertEqual(ret['error'], 'Invalid filter or cursor')
+        ret = self.get(400, fields='id,secret')
+        self.assertIn('secret', ret['error'])
+
+    def test_filters(self):
+        objs = self.objs
+        self.assertEqual(self.ids(project='virtinst'), [obj.id for obj in objs[1::2]])
+        self.assertEqual(self.ids(name='f2'), [objs[2].id])
+        self.assertEqual(self.ids(version='v0'), [obj.id for obj in objs[::2]])
+        self.assertEqual(self.ids(user_name='user1'), [objs[1].id, objs[4].id])
+        self.assertEqual(self.ids(since='2020-01-02', until='2020-01-03'),
+                         [obj.id for obj in objs[2:5]])
+        self.assertEqual(self.ids(since='2020-01-01 01:00:00', until='2020-01-02'),
+                         [objs[1].id])
+        self.assertEqual(self.ids(since='2020-01-01T02:00:00+01:00', until='2020-01-02'),
+                         [objs[1].id])
+        self.assertEqual(self.ids(project='libvirt', version='v1'), [])
+        self.assertEqual(self.ids(project='libvirt', user_name='user2', limit=1),
+                         [objs[2].id])
+
+    def test_fields(self):
+        ret = self.get(fields='name,date', limit=2)
+        self.assertEqual(ret['data'], [{'name': 'f0', 'date': '2020-01-01 00:00:00'},
+                                       {'name': 'f1', 'date': '2020-01-01 01:00:00'}])
+        # The cursor does not depend on the returned fields
+        self.assertEqual(ret['next'], '20200101010000000000_%d' % self.objs[1].id)
+
+    def test_post(self):
+        response = self.client.post('/upload/listfile/', {'fields': 'id', 'name': 'f3'})
+        content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(content.decode('utf-8'))['data'], [{'id': self.objs[3].id}])
@@ -4,6 +4,10 @@ from . import views
 
 urlpatterns = [
     url(r'^coveragefile/$', views.coveragefile, name='coveragefile'),
+    url(r'^bulkupload/$', views.bulk_upload, name='bulk_upload'),
+    url(r'^upload/start/$', views.upload_start, name='upload_start'),
+    url(r'^upload/(?P<token>[0-9a-f]+)/$', views.upload_chunk, name='upload_chunk'),
+    url(r'^upload/(?P<token>[0-9a-f]+)/commit/$', views.upload_commit, name='upload_commit'),
     url(r'^listfile/$', views.listfile, name='listfile'),
     url(r'^syncdata/$', views.sync_data, name='sync_data'),
 ]
@@ -1,18 +1,33 @@
 from django.shortcuts import render
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.forms.models import model_to_dict
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
-import time
 import os
+import json
+import time
+import tarfile
+import uuid
+import hashlib
+import datetime
 from dateutil import parser
-from .models import CoverageFile, Project
+from .models import CoverageFile, Project, UploadSession, check_storage_quota, find_blob
+from .models import blob_name
+from django.core.files import File
+from .storage import tracefile_storage, storage_codec
 from gen_report.utils import parse_package_name
-from gen_report.tasks import prepare_gsmgr
+from gen_report.ingest import scan_chunks, scan_tracefile
+from gen_report.codec import detect_bytes, compress_chunks, open_binary
+from gen_report.cache import makedirs
+from gen_report.tasks import queue_sheet_rows
 
 # Create your views here.
 
+_CHUNK_SIZE = 64 * 1024
+
 def request_check(request, check_dict):
     for i in check_dict.keys():
         if i == 'post':
@@ -29,27 +44,68 @@ def request_check(request, check_dict):
     return 0, "Pass"
 
 
-# TODO: move to utils module
-def get_size(start_path = '.'):
+def find_projects(versions):
     """
-    Check directroy size
+    Return a dict of version -> Project, None if no project owns the package
     """
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-        for dir in dirnames:
-            dir_path = os.path.join(dirpath, dir)
-            total_size += get_size(dir_path)
-        return total_size
+    # TODO: Not all platform use rpm package system
+    pkg_names = dict((version, parse_package_name(version)[0]) for version in versions)
+    projects = {}
+    for project in Project.objects.filter(pkg_name__in=set(pkg_names.values())):
+        if project.pkg_name in projects:
+            raise Exception('Find more than one project point to one pkg %s' % project.pkg_name)
+        projects[project.pkg_name] = project
+    return dict((version, projects.get(pkg_name)) for version, pkg_name in pkg_names.items())
+
+
+def find_project(version):
+    return find_projects([version])[version]
 
-def check_media_limit():
-    media_dir = getattr(settings, "MEDIA_ROOT", None)
-    media_limit = getattr(settings, "COVERAGE_MEDIA_LIMIT_SIZE", None)
-    if not media_limit:
-        return False
-    return get_size(media_dir) > int(media_limit)
+
+def media_limit():
+    return int(getattr(settings, "COVERAGE_MEDIA_LIMIT_SIZE", 0) or 0)
+
+
+def create_coverage_file(name, user_name, version, project, metadata, size,
+                         content=None, session=None):
+    """
+    Return (CoverageFile, None), or (None, reason) if the upload is
+    rejected. The content is an uploaded file, or the staged file of the
+    UploadSession session is moved in place. Neither is stored if
+    the same content is stored already. The sheet row is queued with the
+    new row.
+    """
+    date = parser.parse(time.ctime()).replace(tzinfo=None)
+    with transaction.atomic():
+        # Same content is stored once
+        blob = find_blob(metadata['content_hash'])
+        # Checked before the file is written, the usage is locked until
+        # the new file is counted
+        reason = check_storage_quota(project, 0 if blob else size, media_limit(),
+                                     session=session)
+        if reason:
+            return None, reason
+        if not blob and session:
+            blob = blob_name(metadata['content_hash'])
+            dst = tracefile_storage.path(blob)
+            makedirs(os.path.dirname(dst))
+            os.rename(tracefile_storage.path(session.staged_name()), dst)
+        cf = CoverageFile.objects.create(name=name,
+                                         project=project,
+                                         user_name=user_name,
+                                         coveragefile=blob or content,
+                                         date=date, version=version,
+                                         **metadata)
+        queue_sheet_rows(project, [sheet_row(cf)])
+    return cf, None
+
+
+def sheet_row(cf):
+    return {"Id": cf.id,
+            "Name": cf.name,
+            "User Name": cf.user_name,
+            "Version": cf.version,
+            "Date": cf.date.strftime("%Y-%m-%d %H:%M:%S")}
 
 
 @csrf_exempt
@@ -63,71 +119,412 @@ def coveragefile(request):
     user_name = request.POST.get('user_name')
     version = request.POST.get('version')
     coveragefile = request.FILES['coveragefile']
-    # TODO: Not all platform use rpm package system
-    pkg_name, _, _, _ = parse_package_name(version)
-    projects = Project.objects.filter(pkg_name=pkg_name)
-    if len(projects) == 1:
-        project = projects[0]
-    elif len(projects) > 1:
-        raise Exception('Find more than one project point to one pkg %s' % pkg_name)
-    else:
-        project = None
+    project = find_project(version)
 
-    date = parser.parse(time.ctime()).replace(tzinfo=None)
-    cf = CoverageFile.objects.create(name=name,
-                                     project=project,
-                                     user_name=user_name,
-                                     coveragefile=request.FILES['coveragefile'],
-                                     date=date, version=version)
-    cf.save()
-    if check_media_limit():
-        cf.delete()
-        return HttpResponse("ERROR: Fail to upload file: Media directroy size limited",
+    metadata = scan_chunks(coveragefile.chunks())
+    cf, reason = create_coverage_file(name, user_name, version, project, metadata,
+                                      coveragefile.size, content=coveragefile)
+    if reason:
+        return HttpResponse("ERROR: Fail to upload file: %s" % reason,
                             content_type="text/plain; charset=utf-8")
 
-    gs = prepare_gsmgr(project)
-    if gs:
-        gs.add_new_row_by_dict({"Id": cf.id,
-                                "Name": name,
-                                "User Name": user_name,
-                                "Version": version,
-                                "Date": cf.date.strftime("%Y-%m-%d %H:%M:%S")})
-
     return HttpResponse("OK", content_type="text/plain; charset=utf-8")
 
 
+# Bulk upload of many tracefiles:
+#   POST bulkupload/ with the files as coveragefile fields, and/or tar
+#   archives (may be compressed) as archive fields. name, version and
+#   user_name apply to all files, metadata is an optional json dict of
+#   file name or archive member name -> dict overriding them
+
+def _bulk_metadata(request):
+    defaults = dict((key, request.POST[key]) for key in ('name', 'version', 'user_name')
+                    if request.POST.get(key))
+    per_file = json.loads(request.POST.get('metadata') or '{}')
+    return defaults, per_file
+
+
+@csrf_exempt
+def bulk_upload(request):
+    if request.method != 'POST':
+        return _json_error('Unsupport method %s' % request.method, 405)
+    try:
+        defaults, per_file = _bulk_metadata(request)
+    except ValueError:
+        return _json_error('Invalid metadata', 400)
+
+    archives = []
+    try:
+        # (file name, file, size)
+        uploads = [(f.name, f, f.size) for f in request.FILES.getlist('coveragefile')]
+        for archive in request.FILES.getlist('archive'):
+            try:
+                tar = tarfile.open(fileobj=archive, mode='r:*')
+            except tarfile.TarError:
+                return _json_error('Invalid archive %s' % archive.name, 400)
+            archives.append(tar)
+            for member in tar.getmembers():
+                if member.isfile():
+                    uploads.append((member.name, tar.extractfile(member), member.size))
+        if not uploads:
+            return _json_error('Need pass coveragefile or archive', 400)
+
+        entries = []
+        for file_name, fp, size in uploads:
+            info = dict(defaults)
+            info.update(per_file.get(file_name) or {})
+            for key in ('name', 'version', 'user_name'):
+                if not info.get(key):
+                    return _json_error('Need pass %s of %s' % (key, file_name), 400)
+            metadata = scan_chunks(iter(lambda: fp.read(_CHUNK_SIZE), b''))
+            fp.seek(0)
+            entries.append((file_name, fp, size, info, metadata))
+
+        projects = find_projects(set(entry[3]['version'] for entry in entries))
+        cfs, reason = _bulk_create(entries, projects)
+    finally:
+        for tar in archives:
+            tar.close()
+    if reason:
+        return _json_error('Fail to upload files: %s' % reason, 403)
+
+    return JsonResponse({'data': [{'file': entry[0], 'id': cf.id}
+                                  for entry, cf in zip(entries, cfs)]})
+
+
+def _bulk_create(entries, projects):
+    """
+    Store the files and insert the rows in one transaction, return
+    (CoverageFiles, None), or (None, reason) if the batch is rejected.
+    Rows are saved one by one so they get their ids, the post_save
+    signal counts new content in the ledger.
+    """
+    date = datetime.datetime.now()
+    with transaction.atomic():
+        # content hash -> stored name, None for new content
+        blobs = {}
+        new_sizes = {}
+        for file_name, fp, size, info, metadata in entries:
+            content_hash = metadata['content_hash']
+            if content_hash in blobs:
+                continue
+            blobs[content_hash] = find_blob(content_hash)
+            if not blobs[content_hash]:
+                project = projects[info['version']]
+                new_sizes[project] = new_sizes.get(project, 0) + size
+
+        reasons = [check_storage_quota(None, sum(new_sizes.values()), media_limit())]
+        reasons += [check_storage_quota(project, size)
+                    for project, size in new_sizes.items() if project]
+        reasons = [i for i in reasons if i]
+        if reasons:
+            return None, reasons[0]
+
+        # stored name -> size
+        stored_sizes = {}
+        objs = []
+        for file_name, fp, size, info, metadata in entries:
+            content_hash = metadata['content_hash']
+            project = projects[info['version']]
+            if not blobs[content_hash]:
+                blobs[content_hash] = tracefile_storage.save(blob_name(content_hash), File(fp))
+            name = blobs[content_hash]
+            if name not in stored_sizes:
+                stored_sizes[name] = tracefile_storage.size(name)
+            objs.append(CoverageFile.objects.create(name=info['name'],
+                                                    project=project,
+                                                    user_name=info['user_name'],
+                                                    coveragefile=name,
+                                                    date=date, version=info['version'],
+                                                    file_size=stored_sizes[name],
+                                                    **metadata))
+
+        by_project = {}
+        for obj in objs:
+            by_project.setdefault(obj.project, []).append(obj)
+        for project, project_objs in by_project.items():
+            queue_sheet_rows(project, [sheet_row(obj) for obj in project_objs])
+    return objs, None
+
+
+# Resumable upload of large tracefiles:
+#   POST upload/start/ with name, version, user_name and optional size
+#   and sha256 of the whole tracefile, returns the session id
+#   PUT upload/<id>/?offset=N with the next bytes as body, and optional
+#   X-Content-Sha256 header of the chunk. GET upload/<id>/ returns the
+#   offset to resume from, DELETE upload/<id>/ aborts the upload
+#   POST upload/<id>/commit/ to create the CoverageFile
+# The announced size is taken from the quota until the upload ends.
+
+def _json_error(msg, status, **kwargs):
+    kwargs['error'] = msg
+    return JsonResponse(kwargs, status=status)
+
+
+@csrf_exempt
+def upload_start(request):
+    if request.method != 'POST':
+        return _json_error('Unsupport method %s' % request.method, 405)
+    ret, msg = request_check(request, {'post': ['name', 'version', 'user_name']})
+    if ret == 1:
+        return _json_error(msg, 400)
+    try:
+        size = int(request.POST['size']) if request.POST.get('size') else None
+    except ValueError:
+        return _json_error('Invalid size %s' % request.POST['size'], 400)
+
+    version = request.POST.get('version')
+    project = find_project(version)
+    with transaction.atomic():
+        # The session reserves size, the stored size is checked again by
+        # the commit
+        reason = check_storage_quota(project, size or 0, media_limit())
+        if reason:
+            return _json_error('Fail to upload file: %s' % reason, 403)
+        session = UploadSession.objects.create(token=uuid.uuid4().hex,
+                                               name=request.POST.get('name'),
+                                               user_name=request.POST.get('user_name'),
+                                               version=version,
+                                               project=project,
+                                               size=size,
+                                               sha256=request.POST.get('sha256') or None)
+    return JsonResponse({'id': session.token, 'offset': 0})
+
+
+@csrf_exempt
+def upload_chunk(request, token):
+    if request.method == 'GET':
+        session = UploadSession.objects.filter(token=token).first()
+        if not session:
+            return _json_error('No upload %s' % token, 404)
+        return JsonResponse({'id': session.token, 'offset': session.offset})
+    elif request.method == 'DELETE':
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().filter(token=token).first()
+            if not session:
+                return _json_error('No upload %s' % token, 404)
+            # The staged file is removed with the session
+            session.delete()
+        return JsonResponse({'id': token})
+    elif request.method != 'PUT':
+        return _json_error('Unsupport method %s' % request.method, 405)
+
+    try:
+        offset = int(request.GET.get('offset', ''))
+    except ValueError:
+        return _json_error('Need pass offset', 400)
+    checksum = request.META.get('HTTP_X_CONTENT_SHA256') or request.GET.get('sha256')
+
+    session = UploadSession.objects.filter(token=token).first()
+    if session and session.size is None:
+        # Nothing is reserved, check the staged bytes with this chunk
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        with transaction.atomic():
+            reason = check_storage_quota(session.project, session.stored_size + length,
+                                         media_limit(), session=session)
+        if reason:
+            return _json_error('Fail to upload file: %s' % reason, 403,
+                               offset=session.offset)
+
+    with transaction.atomic():
+        # One chunk of a session is written at a time
+        session = UploadSession.objects.select_for_update().filter(token=token).first()
+        if not session:
+            return _json_error('No upload %s' % token, 404)
+        if offset != session.offset:
+            return _json_error('Offset mismatch', 409, offset=session.offset)
+
+        first = request.read(_CHUNK_SIZE)
+        if not session.offset:
+            # Compressed uploads are stored as they are
+            session.codec = '' if detect_bytes(first) else storage_codec()
+
+        sha256 = hashlib.sha256()
+        received = [0]
+        def _chunks():
+            data = first
+            while data:
+                sha256.update(data)
+                received[0] += len(data)
+                yield data
+                data = request.read(_CHUNK_SIZE)
+
+        path = tracefile_storage.path(session.staged_name())
+        makedirs(os.path.dirname(path))
+        with open(path, 'ab') as fp:
+            # Drop the rest of a chunk which failed
+            fp.truncate(session.stored_size)
+            if session.codec:
+                # Only the head of the upload is checked for compressed data
+                compress_chunks(_chunks(), fp, session.codec, keep_compressed=False)
+            else:
+                for data in _chunks():
+                    fp.write(data)
+            stored_size = fp.tell()
+
+            error = None
+            if checksum and checksum.lower() != sha256.hexdigest():
+                error = 'Checksum mismatch'
+            elif session.size is not None and offset + received[0] > session.size:
+                error = 'Upload is larger than %d bytes' % session.size
+            if error:
+                fp.truncate(session.stored_size)
+                return _json_error(error, 400, offset=session.offset)
+
+        session.offset += received[0]
+        session.stored_size = stored_size
+        session.date = datetime.datetime.now()
+        session.save()
+
+    return JsonResponse({'id': session.token, 'offset': session.offset})
+
+
+def _uploaded_sha256(session):
+    """
+    sha256 of the bytes the client sent, plain uploads may be stored
+    compressed with session.codec
+    """
+    sha256 = hashlib.sha256()
+    path = tracefile_storage.path(session.staged_name())
+    with (open_binary(path) if session.codec else open(path, 'rb')) as fp:
+        for data in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+@csrf_exempt
+def upload_commit(request, token):
+    if request.method != 'POST':
+        return _json_error('Unsupport method %s' % request.method, 405)
+
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().filter(token=token).first()
+        if not session:
+            return _json_error('No upload %s' % token, 404)
+        if session.size is not None and session.offset != session.size:
+            return _json_error('Got %d of %d bytes' % (session.offset, session.size),
+                               400, offset=session.offset)
+
+        path = tracefile_storage.path(session.staged_name())
+        makedirs(os.path.dirname(path))
+        open(path, 'ab').close()
+        checksum = request.POST.get('sha256') or session.sha256
+        if checksum and checksum.lower() != _uploaded_sha256(session):
+            # The staged file is removed with the session
+            session.delete()
+            return _json_error('Checksum mismatch', 400)
+
+        metadata = scan_tracefile(path)
+        project = find_project(session.version)
+        cf, reason = create_coverage_file(session.name, session.user_name,
+                                          session.version, project, metadata,
+                                          session.stored_size, session=session)
+        if reason:
+            # Kept for a retry of the commit, or DELETE to abort
+            return _json_error('Fail to upload file: %s' % reason, 403)
+        session.delete()
+
+    return JsonResponse({'id': cf.id})
+
+
+_LIST_FIELDS = [field.name for field in CoverageFile._meta.fields]
+_CURSOR_FMT = '%Y%m%d%H%M%S%f'
+
+
+def _aware(date, tz=None):
+    """
+    Naive dates are in tz, the current time zone by default
+    """
+    if not settings.USE_TZ:
+        return date
+    return timezone.make_aware(date, tz or timezone.get_current_timezone())
+
+
+def _parse_date(value):
+    date = parser.parse(value)
+    if timezone.is_naive(date):
+        return _aware(date)
+    return date if settings.USE_TZ else timezone.make_naive(date)
+
+
+def _list_page(rows, fields, limit):
+    """
+    Stream the json of one page, rows has one more row than the page if
+    there is a next page
+    """
+    yield '{"data": ['
+    count = 0
+    last = None
+    more = False
+    for row in rows:
+        if count == limit:
+            more = True
+            break
+        item = dict((key, row[key]) for key in fields)
+        if 'date' in item:
+            item['date'] = item['date'].strftime("%Y-%m-%d %H:%M:%S")
+        yield (', ' if count else '') + json.dumps(item)
+        count += 1
+        last = row
+    cursor = None
+    if more:
+        cursor = '%s_%d' % (last['date'].strftime(_CURSOR_FMT), last['id'])
+    yield '], "next": %s}' % json.dumps(cursor)
+
+
 def listfile(request):
-    ret = []
+    """
+    List coverage files ordered by date, a page at a time. Filters:
+    name, project (name), version, user_name, since and until (dates).
+    fields is a comma separated list of the returned fields, limit the
+    page size. Pass the returned next as cursor to get the next page,
+    it is null on the last page.
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    page_size = int(getattr(settings, 'COVERAGE_LIST_PAGE_SIZE', 0) or 1000)
 
-    if 'name' in request.POST.keys():
-        objs = CoverageFile.objects.filter(name=request.POST['name'])
-    else:
-        objs = CoverageFile.objects.all()
+    objs = CoverageFile.objects.all()
+    for key in ('name', 'version', 'user_name'):
+        if params.get(key):
+            objs = objs.filter(**{key: params[key]})
+    if params.get('project'):
+        objs = objs.filter(project__name=params['project'])
+    try:
+        if params.get('since'):
+            objs = objs.filter(date__gte=_parse_date(params['since']))
+        if params.get('until'):
+            objs = objs.filter(date__lt=_parse_date(params['until']))
+        if params.get('cursor'):
+            date, obj_id = params['cursor'].split('_')
+            # Written from the dates of the database, which are in UTC
+            date = _aware(datetime.datetime.strptime(date, _CURSOR_FMT), timezone.utc)
+            # Keyset pagination, served by the (date, id) indexes
+            objs = objs.filter(Q(date__gt=date) | Q(date=date, id__gt=int(obj_id)))
+        limit = min(int(params.get('limit') or page_size), page_size)
+        if limit < 1:
+            raise ValueError('Invalid limit %d' % limit)
+    except ValueError:
+        return _json_error('Invalid filter or cursor', 400)
 
-    for obj in objs:
-        tmp_json = model_to_dict(obj)
-        tmp_json['date'] = tmp_json['date'].strftime("%Y-%m-%d %H:%M:%S")
-        tmp_json['coveragefile'] = tmp_json['coveragefile'].name
-        ret.append(tmp_json)
+    fields = params['fields'].split(',') if params.get('fields') else _LIST_FIELDS
+    unknown = [i for i in fields if i not in _LIST_FIELDS]
+    if unknown:
+        return _json_error('Unknown fields %s' % ','.join(unknown), 400)
 
-    return JsonResponse({'data': ret})
+    rows = objs.order_by('date', 'id').values(*set(fields + ['date', 'id']))
+    return StreamingHttpResponse(_list_page(rows[:limit + 1].iterator(), fields, limit),
+                                 content_type='application/json')
 
 
 def sync_data(request):
-    projects = Project.objects.all()
-    projects.append(None)
-
-    for project in projects:
-        objs = CoverageFile.objects.filter(project=project)
-        gs = prepare_gsmgr(project)
-        if not gs:
-            # TODO:logging
-            continue
-        for i, obj in enumerate(objs):
-            gs.add_new_row_by_dict({"Id": obj.id,
-                                    "Name": obj.name,
-                                    "User Name": obj.user_name,
-                                    "Version": obj.version,
-                                    "Date": obj.date.strftime("%Y-%m-%d %H:%M:%S")}, row=i+2)
+    """
+    Write the rows of all uploads to the sheets again. The rows go
+    through the outbox, the worker updates them by Id and appends the
+    missing ones, see gen_report/tasks.py
+    """
+    for project in list(Project.objects.all()) + [None]:
+        objs = CoverageFile.objects.filter(project=project).order_by('id')
+        with transaction.atomic():
+            queue_sheet_rows(project, [sheet_row(obj) for obj in objs])
 
     return HttpResponse("Done!\n", content_type="text/plain; charset=utf-8")